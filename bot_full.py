@@ -11,7 +11,7 @@ Features included:
 - Admin commands: /admin_panel (list users, ban/unban, mute, add_balance, give_vip)
 - Donate flow: creates a local invoice ID and gives user a deep-link to @CryptoBot to pay
   (you must create a Crypto Pay token and use it locally — instructions in README)
-- Uses SQLite for storage
+- Uses SQLite for storage (or in-memory / PostgreSQL backends, see STORAGE_BACKEND)
 - Single-file: insert your BOT_TOKEN and optional ADMIN_IDS and CRYPTO_PAY settings
 Notes:
 - DO NOT share your tokens. Insert them locally before running.
@@ -20,21 +20,48 @@ Notes:
 """
 
 import asyncio
+import base64
+import bisect
+import contextvars
+import csv
+import hashlib
+import heapq
+import json
 import logging
+import multiprocessing
+import os
+import queue
 import sqlite3
 import secrets
+import struct
+import tempfile
+import threading
 import time
-from datetime import datetime, timedelta
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import NamedTuple
 
+from aiohttp import ClientSession, ClientTimeout, web
 from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command, Text
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.filters import Command
+from aiogram.types import FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+try:
+    import asyncpg  # only needed for STORAGE_BACKEND=postgres
+except ImportError:
+    asyncpg = None
 
 # ============================
 # === CONFIGURATION SECTION ==
 # ============================
 # Insert your tokens here (do NOT commit them to public repos)
-BOT_TOKEN = "YOUR_TELEGRAM_BOT_TOKEN"
+BOT_TOKEN = os.getenv("BOT_TOKEN", "YOUR_TELEGRAM_BOT_TOKEN")
 # Example of admin ids: [123456789]
 ADMIN_IDS = []  # put your Telegram numeric user id(s) here
 
@@ -43,21 +70,317 @@ ADMIN_IDS = []  # put your Telegram numeric user id(s) here
 # https://t.me/CryptoBot?start=<invoice_id>
 # When user pays via CryptoBot, you must manually (or by advanced webhook/polling) verify payment.
 CRYPTO_DEEP_LINK_BASE = "https://t.me/CryptoBot?start="
+# Automatic settlement: with a Crypto Pay API token (@CryptoBot -> Crypto Pay -> My Apps)
+# invoices are created through the API and a background worker settles paid ones.
+CRYPTO_PAY_TOKEN = os.getenv("CRYPTO_PAY_TOKEN", "")
+CRYPTO_PAY_API = os.getenv("CRYPTO_PAY_API", "https://pay.crypt.bot/api")  # testnet: https://testnet-pay.crypt.bot/api
+CRYPTO_PAY_ASSET = "USDT"
+INVOICE_TTL = 3600               # unpaid invoices expire after this many seconds
+INVOICE_POLL_INTERVAL = 15       # seconds between settlement passes
+INVOICE_POLL_BATCH = 100         # invoices per getInvoices request
 
 # Database file
-DB_FILE = "anon_chat_bot.db"
+DB_FILE = os.getenv("DB_FILE", "anon_chat_bot.db")
+# SQLite tuning (applied to every long-lived connection)
+DB_SYNCHRONOUS = "NORMAL"        # NORMAL is durable enough with WAL and avoids fsync per commit
+DB_CACHE_SIZE_KB = 20000         # page cache per connection, in KiB
+DB_MMAP_SIZE = 64 * 1024 * 1024  # memory-mapped I/O window, in bytes
+DB_BUSY_TIMEOUT_MS = 5000
+DB_STATEMENT_CACHE = 256         # prepared statements kept per connection
+# Async DB facade: reads run on a small thread pool, writes go through one writer thread
+DB_READ_WORKERS = 4
+DB_WRITE_BATCH_WINDOW_MS = 2     # how long the writer waits to group more statements into one commit
+DB_WRITE_BATCH_MAX = 200         # max statements per group commit
+# Storage backend: "sqlite" (DB_FILE, default), "memory" (nothing persists; tests and
+# benchmarks) or "postgres" (POSTGRES_DSN, needs asyncpg)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+POSTGRES_DSN = os.getenv("POSTGRES_DSN", "postgresql://localhost/anon_chat_bot")
+POSTGRES_POOL_SIZE = 10
+# Hot user-state cache (banned / muted_until / vip_until), LRU-bounded
+USER_CACHE_SIZE = 50000
+# Rendered profile cards (profile view / reveal), LRU-bounded
+PROFILE_CACHE_SIZE = 20000
+# Mirror the in-memory search queue into the `pairing` table so it survives restarts
+PAIRING_DURABLE_LOG = True
+# Chat matchmaking policy: "fifo" (oldest searcher first), "vip" (VIP searchers first) or
+# "bands" (VIP first, among searchers in nearby reputation bands; the band widens while one waits)
+MATCH_POLICY = os.getenv("MATCH_POLICY", "bands")
+MATCH_REP_BAND = 5                   # reputation points per band
+MATCH_WIDEN_SECONDS = 5              # each this long in the queue accepts one more band on each side
+MATCH_VIP_WIDEN = 2                  # VIP searchers widen this many times faster
+MATCH_SWEEP_INTERVAL = 2             # how often waiting searchers are re-paired as their bands widen
+MATCH_TRACE_FILE = os.getenv("MATCH_TRACE_FILE", "")  # record searches as JSON lines, for tools/matchsim.py
+# Outbound send scheduler (Telegram limits: ~30 msg/s per bot, ~1 msg/s per chat)
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))  # messages per second across all chats
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))        # messages per second to one chat
+OUTBOX_CHAT_BURST = float(os.getenv("OUTBOX_CHAT_BURST", "3"))      # short bursts allowed per chat
+OUTBOX_MAX_INFLIGHT = 32         # concurrent API calls
+OUTBOX_MAX_RETRIES = 3           # RetryAfter retries per message
+OUTBOX_QUEUE_LIMITS = (20000, 5000, 2000)  # max queued jobs per priority (relay, notify, bulk)
+OUTBOX_DRAIN_TIMEOUT = 5         # seconds shutdown keeps sending queued messages before dropping the rest
+# Albums arrive as one update per item; items sharing a media_group_id are relayed in one call
+ALBUM_WINDOW = 0.5               # seconds to wait for the next item before sending the album
+ALBUM_MAX_ITEMS = 10             # Telegram's album size limit; a full album goes out at once
+# Per-user flood control, checked before any handler or DB access: (updates per second,
+# burst) per update type. Excess that fits in FLOOD_MAX_DELAY waits, the rest is dropped;
+# FLOOD_STRIKES drops within FLOOD_STRIKE_WINDOW seconds mute the user, longer each time.
+FLOOD_CONTROL = os.getenv("FLOOD_CONTROL", "1") != "0"
+FLOOD_LIMITS = {"message": (3, 15), "callback_query": (2, 8)}
+FLOOD_DEFAULT_LIMIT = (1, 5)
+FLOOD_MAX_DELAY = 1.0
+FLOOD_STRIKES = 20
+FLOOD_STRIKE_WINDOW = 60
+FLOOD_MUTE_STEPS = (60, 600, 3600)   # seconds; the last step repeats
+FLOOD_IDLE_TTL = 3600                # forget users (and their strikes) idle this long
+# Maintenance reaper, every MAINTENANCE_INTERVAL seconds: ends searches older than SEARCH_TTL,
+# closes chats whose peer is gone, clears expired mutes / VIP and reclaims free DB pages.
+# Rows are handled MAINTENANCE_BATCH at a time, at most MAINTENANCE_MAX_BATCHES per kind per pass.
+MAINTENANCE_INTERVAL = 300
+MAINTENANCE_BATCH = 500
+MAINTENANCE_MAX_BATCHES = 20
+SEARCH_TTL = 1800
+MAINTENANCE_ANALYZE_EVERY = 12       # passes between ANALYZE runs
+MAINTENANCE_VACUUM_PAGES = 2000      # free SQLite pages given back to the OS per pass
+# Files created before auto_vacuum = INCREMENTAL cannot give pages back until converted, which
+# takes one full VACUUM (the bot waits for the whole file rewrite). Set to 1 for one start.
+MAINTENANCE_CONVERT_VACUUM = os.getenv("MAINTENANCE_CONVERT_VACUUM", "0") != "0"
+# Mini-games: sessions without a move for this long (and stale queue entries) are dropped
+GAME_IDLE_TTL = 300
+GAME_SWEEP_INTERVAL = 30
+# Admin user browser
+ADMIN_PAGE_SIZE = 20
+# Admin broadcasts: recipients are read BROADCAST_CHUNK ids at a time, at most
+# BROADCAST_CONCURRENCY sends wait in the outbox (which holds the global rate), and
+# progress is checkpointed and shown every BROADCAST_STATUS_INTERVAL seconds
+BROADCAST_CHUNK = 500
+BROADCAST_CONCURRENCY = 50
+BROADCAST_STATUS_INTERVAL = 3
+BROADCAST_RETRY_DELAYS = (1, 5, 15, 60)  # backoff after a storage error; then the broadcast fails
+
+# Update delivery: "polling" (default) or "webhook"
+RUN_MODE = os.getenv("RUN_MODE", "polling")
+# Public HTTPS base URL Telegram should call, e.g. https://bot.example.com
+# Leave empty if the webhook is registered elsewhere (or for local testing).
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Sent by Telegram in X-Telegram-Bot-Api-Secret-Token; requests without it get 401
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = 100        # parallel HTTPS connections Telegram may open (1-100)
+WEBHOOK_MAX_CONCURRENT_UPDATES = 256 # updates processed at once; the rest wait in memory
+# Alternative Bot API server (self-hosted telegram-bot-api or a local test stub)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "")
+# Prometheus metrics endpoint (http://METRICS_HOST:METRICS_PORT/metrics); 0 disables it
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Multi-process mode: with WORKERS > 1 one front process receives updates (polling or
+# webhook) and WORKERS worker processes run the handlers; each user is pinned to one
+# worker by a consistent hash of user_id. Workers' metrics: METRICS_PORT + 1 + worker.
+WORKERS = int(os.getenv("WORKERS", "1"))
+SHARD_VNODES = 64                    # hash ring points per worker
+SHARD_SOCKET = os.getenv("SHARD_SOCKET", "")  # front's unix socket; default: in a temp dir
+WORKER_MAX_CONCURRENT_UPDATES = 256  # updates a worker processes at once
 
 # ============================
 # === Logging configuration ==
 # ============================
-logging.basicConfig(level=logging.INFO)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
+# ============================
+# === Metrics ================
+# ============================
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13, 21)
+
+class Metrics:
+    """In-process counters and histograms, rendered in the Prometheus text format.
+
+    Series are keyed by ``(name, labels)`` where labels is a tuple of (key, value)
+    pairs. Only touched from the event loop thread.
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = {}  # (name, labels) -> [buckets, bucket counts, sum, count]
+
+    def inc(self, name: str, labels=(), value=1):
+        self.counters[(name, labels)] += value
+
+    def observe(self, name: str, value: float, labels=(), buckets=LATENCY_BUCKETS):
+        h = self.histograms.get((name, labels))
+        if h is None:
+            h = self.histograms[(name, labels)] = [buckets, [0] * (len(buckets) + 1), 0.0, 0]
+        h[1][bisect.bisect_left(h[0], value)] += 1
+        h[2] += value
+        h[3] += 1
+
+    def series(self, name: str):
+        """{labels: (count, sum, approximate p95)} for one histogram."""
+        out = {}
+        for (n, labels), (buckets, counts, total, count) in self.histograms.items():
+            if n != name:
+                continue
+            rank, seen, p95 = 0.95 * count, 0, float("inf")
+            for bound, c in zip(buckets, counts):
+                seen += c
+                if seen >= rank:
+                    p95 = bound
+                    break
+            out[labels] = (count, total, p95)
+        return out
+
+    def render(self, gauges=None):
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), (buckets, counts, total, count) in sorted(self.histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, c in zip(buckets, counts):
+                cumulative += c
+                lines.append(f"{name}_bucket{_labels(labels + (('le', repr(float(bound))),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+metrics = Metrics()
+
+# per-update accounting: the update metrics middleware puts a dict here, the DB wrappers
+# and the handler-name middleware fill it in
+current_update_stats = contextvars.ContextVar("current_update_stats", default=None)
+
+def statement_label(query):
+    if callable(query):
+        return f"transaction:{query.__name__}"
+    return " ".join(query.split())[:80]
+
+def record_db_call(query, seconds: float):
+    metrics.observe("bot_db_statement_seconds", seconds, (("statement", statement_label(query)),))
+    stats = current_update_stats.get()
+    if stats is not None:
+        stats["db_calls"] += 1
+
 # ============================
 # === Database helpers =======
 # ============================
+class SQLiteConnectionManager:
+    """Long-lived, tuned SQLite connections shared by all helpers.
+
+    Writes go through a single writer connection guarded by a lock, reads use a
+    separate query-only connection per thread, so readers never wait on writers (WAL).
+    Connections are opened lazily and kept for the whole process lifetime.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._local = threading.local()
+        self._readers = []
+
+    def _connect(self, readonly: bool = False):
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
+        conn.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT_MS)}")
+        if not readonly:
+            # only takes effect on a new database file (see check_auto_vacuum for older ones);
+            # the reaper then frees pages in small steps
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA cache_size = {-int(DB_CACHE_SIZE_KB)}")
+        conn.execute(f"PRAGMA mmap_size = {int(DB_MMAP_SIZE)}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        if readonly:
+            conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def writer(self):
+        if self._writer is None:
+            self._writer = self._connect()
+        return self._writer
+
+    def reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.writer()  # make sure the file exists and is in WAL mode first
+            conn = self._connect(readonly=True)
+            self._local.conn = conn
+            self._readers.append(conn)
+        return conn
+
+    @staticmethod
+    def is_read(query: str):
+        return query.lstrip()[:6].upper() == "SELECT"
+
+    def execute(self, query, params=(), fetch=False, many=False):
+        if not many and self.is_read(query):
+            cur = self.reader().execute(query, params)
+            return cur.fetchall() if fetch else None
+        with self._write_lock:
+            conn = self.writer()
+            try:
+                if many:
+                    conn.executemany(query, params)
+                    result = None
+                else:
+                    cur = conn.execute(query, params)
+                    result = cur.fetchall() if fetch else None
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return result
+
+    def transaction(self, fn):
+        """Run ``fn(conn)`` on the writer connection as one transaction; returns its result."""
+        with self._write_lock:
+            conn = self.writer()
+            try:
+                # IMMEDIATE takes the write lock up front: a deferred read-then-write transaction
+                # fails with SQLITE_BUSY (no busy_timeout retry) if another process wrote in between
+                conn.execute("BEGIN IMMEDIATE")
+                result = fn(conn)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return result
+
+    def close(self):
+        with self._write_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers.clear()
+            self._local = threading.local()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+db = SQLiteConnectionManager(DB_FILE)
+
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
+    # baseline (version 0) schema; later changes live in MIGRATIONS below
+    # runs once at startup, before any other thread touches the DB
+    conn = db.writer()
     cur = conn.cursor()
     # users table
     cur.execute('''
@@ -109,581 +432,3267 @@ def init_db():
             paid INTEGER DEFAULT 0
         )
     ''')
-    # games table (simple storage)
+    # finished games (sessions themselves live in memory)
     cur.execute('''
-        CREATE TABLE IF NOT EXISTS games (
-            user_id INTEGER PRIMARY KEY,
+        CREATE TABLE IF NOT EXISTS game_results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
             game_type TEXT,
-            state TEXT,
-            peer_id INTEGER
+            player1 INTEGER,
+            player2 INTEGER,
+            winner INTEGER,
+            finished_at TEXT
         )
     ''')
     conn.commit()
-    conn.close()
-
-def db_execute(query, params=(), fetch=False, many=False):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    if many:
-        cur.executemany(query, params)
-        conn.commit()
-        conn.close()
-        return None
-    cur.execute(query, params)
-    result = None
-    if fetch:
-        result = cur.fetchall()
-    conn.commit()
-    conn.close()
-    return result
 
 # ============================
-# === Utility functions ======
+# === Schema migrations ======
 # ============================
-def ensure_user(user: types.User):
-    now = datetime.utcnow().isoformat()
-    existing = db_execute("SELECT user_id FROM users WHERE user_id = ?", (user.id,), fetch=True)
-    if not existing:
-        db_execute(
-            "INSERT INTO users (user_id, username, display_name, about, created_at) VALUES (?, ?, ?, ?, ?)",
-            (user.id, user.username or "", user.full_name, "", now)
-        )
+# Ordered, append-only list of (version, name, step). A step gets the writer connection
+# and runs inside one transaction together with its schema_version row, so every
+# migration is applied exactly once, completely or not at all. Steps must be safe to
+# run against a database of any age (IF NOT EXISTS etc.): they are applied in place
+# at startup, while the bot keeps its data.
+def _sql(*statements):
+    def step(conn):
+        for statement in statements:
+            conn.execute(statement)
+    return step
 
-def is_admin(user_id: int):
-    return user_id in ADMIN_IDS
+def _epoch(column):
+    # ISO text (what older versions stored) -> epoch seconds; integers pass through
+    return (f"CASE WHEN typeof({column}) = 'integer' THEN {column} "
+            f"ELSE CAST(strftime('%s', {column}) AS INTEGER) END")
 
-def is_banned(user_id: int):
-    r = db_execute("SELECT banned FROM users WHERE user_id = ?", (user_id,), fetch=True)
-    if not r:
-        return False
-    return r[0][0] == 1
+def _rebuild_table(conn, table, create_sql, columns, converted):
+    """Recreate ``table`` from ``create_sql`` (SQLite cannot change column types in place),
+    converting the ``converted`` columns with _epoch and keeping the table's indexes."""
+    indexes = [r[0] for r in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,))]
+    conn.execute(create_sql.format(name=f"{table}_new"))
+    select = ", ".join(_epoch(c) if c in converted else c for c in columns)
+    conn.execute(f"INSERT INTO {table}_new ({', '.join(columns)}) SELECT {select} FROM {table}")
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    for sql in indexes:
+        conn.execute(sql)
 
-def is_muted(user_id: int):
-    r = db_execute("SELECT muted_until FROM users WHERE user_id = ?", (user_id,), fetch=True)
-    if not r or r[0][0] is None:
-        return False
-    try:
-        muted_until = datetime.fromisoformat(r[0][0])
-        return datetime.utcnow() < muted_until
-    except Exception:
-        return False
+def _m2_epoch_timestamps(conn):
+    _rebuild_table(conn, "users", '''
+        CREATE TABLE {name} (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            display_name TEXT,
+            about TEXT,
+            created_at INTEGER,
+            reputation INTEGER DEFAULT 0,
+            balance INTEGER DEFAULT 0,
+            vip_until INTEGER DEFAULT NULL,
+            banned INTEGER DEFAULT 0,
+            muted_until INTEGER DEFAULT NULL
+        )''', ("user_id", "username", "display_name", "about", "created_at", "reputation", "balance",
+               "vip_until", "banned", "muted_until"), ("created_at", "vip_until", "muted_until"))
+    _rebuild_table(conn, "pairing", '''
+        CREATE TABLE {name} (
+            user_id INTEGER PRIMARY KEY,
+            looking_since INTEGER
+        )''', ("user_id", "looking_since"), ("looking_since",))
+    _rebuild_table(conn, "complaints", '''
+        CREATE TABLE {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            complainer INTEGER,
+            target INTEGER,
+            reason TEXT,
+            created_at INTEGER,
+            handled INTEGER DEFAULT 0
+        )''', ("id", "complainer", "target", "reason", "created_at", "handled"), ("created_at",))
+    _rebuild_table(conn, "invoices", '''
+        CREATE TABLE {name} (
+            invoice_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            amount INTEGER,
+            created_at INTEGER,
+            paid INTEGER DEFAULT 0
+        )''', ("invoice_id", "user_id", "amount", "created_at", "paid"), ("created_at",))
+    _rebuild_table(conn, "game_results", '''
+        CREATE TABLE {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            game_type TEXT,
+            player1 INTEGER,
+            player2 INTEGER,
+            winner INTEGER,
+            finished_at INTEGER
+        )''', ("id", "game_type", "player1", "player2", "winner", "finished_at"), ("finished_at",))
+    # expiry sweeps and "VIP right now" become integer range scans over small partial indexes
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_vip_until ON users (vip_until) WHERE vip_until IS NOT NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_muted_until ON users (muted_until) WHERE muted_until IS NOT NULL")
 
-def give_vip(user_id: int, days: int):
-    r = db_execute("SELECT vip_until FROM users WHERE user_id = ?", (user_id,), fetch=True)
-    now = datetime.utcnow()
-    if r and r[0][0]:
-        try:
-            current = datetime.fromisoformat(r[0][0])
-        except Exception:
-            current = now
-        if current > now:
-            new_until = current + timedelta(days=days)
-        else:
-            new_until = now + timedelta(days=days)
-    else:
-        new_until = now + timedelta(days=days)
-    db_execute("UPDATE users SET vip_until = ? WHERE user_id = ?", (new_until.isoformat(), user_id))
+def _m3_invoice_remote_id(conn):
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(invoices)")}
+    if "remote_id" not in columns:
+        # Crypto Pay invoice id; NULL for invoices settled by hand
+        conn.execute("ALTER TABLE invoices ADD COLUMN remote_id INTEGER")
 
-def add_balance(user_id: int, amount: int):
-    db_execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
+def _m4_broadcasts(conn):
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+    if "blocked_bot" not in columns:
+        # set when a broadcast finds the user has blocked the bot, cleared by /start
+        conn.execute("ALTER TABLE users ADD COLUMN blocked_bot INTEGER NOT NULL DEFAULT 0")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            text TEXT,
+            status_chat INTEGER,
+            status_message INTEGER,
+            total INTEGER,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            state INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER,
+            finished_at INTEGER
+        )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_state ON broadcasts (state)")
 
-def get_profile_text(user_id: int):
-    r = db_execute("SELECT username, display_name, about, reputation, balance, vip_until FROM users WHERE user_id = ?", (user_id,), fetch=True)
-    if not r:
-        return "Профиль не найден."
-    username, display_name, about, reputation, balance, vip_until = r[0]
-    vip_text = vip_until if vip_until else "Нет"
-    return f"🔹 {display_name} (@{username})\n\n{about if about else '📝 Описание отсутствует'}\n\n⭐ Репутация: {reputation}\n💰 Баланс: {balance}\n👑 VIP до: {vip_text}"
+def _m5_drop_games(conn):
+    # the old per-user `games` table: sessions live in memory, nothing has written it since
+    conn.execute("DROP TABLE IF EXISTS games")
 
-# ============================
-# === Bot & Dispatcher =======
-# ============================
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+MIGRATIONS = [
+    (1, "indexes for hot lookups", _sql(
+        # startup replay of the search queue (ORDER BY looking_since), covering
+        "CREATE INDEX IF NOT EXISTS idx_pairing_looking_since ON pairing (looking_since, user_id)",
+        # per-user invoice lookups and unpaid-invoice scans
+        "CREATE INDEX IF NOT EXISTS idx_invoices_user_paid ON invoices (user_id, paid)",
+        "CREATE INDEX IF NOT EXISTS idx_invoices_paid_created ON invoices (paid, created_at)",
+        # complaints by target / by complainer
+        "CREATE INDEX IF NOT EXISTS idx_complaints_target ON complaints (target, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_complaints_complainer ON complaints (complainer, created_at)",
+        # admin browser filter `banned`: small partial index walked in user_id order
+        "CREATE INDEX IF NOT EXISTS idx_users_banned ON users (user_id) WHERE banned = 1",
+        # game history per player
+        "CREATE INDEX IF NOT EXISTS idx_game_results_player1 ON game_results (player1)",
+        "CREATE INDEX IF NOT EXISTS idx_game_results_player2 ON game_results (player2)",
+    )),
+    (2, "epoch seconds for time columns", _m2_epoch_timestamps),
+    (3, "crypto pay invoice ids", _m3_invoice_remote_id),
+    (4, "broadcasts and blocked users", _m4_broadcasts),
+    (5, "drop the unused games table", _m5_drop_games),
+]
 
-# Inline keyboards
-def main_kb():
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔎 Найти собеседника", callback_data="find")],
-        [InlineKeyboardButton(text="👤 Мой профиль", callback_data="profile"),
-         InlineKeyboardButton(text="💰 Баланс / Донат", callback_data="balance")],
-        [InlineKeyboardButton(text="🎮 Игры", callback_data="games")],
-    ])
-    return kb
+def migrate_db():
+    """Bring the schema up to the latest version; runs at startup after init_db."""
+    conn = db.writer()
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, name TEXT, applied_at TEXT)")
+    conn.commit()
+    current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    for version, name, step in MIGRATIONS:
+        if version <= current:
+            continue
 
-def inchat_kb(can_reveal=True):
-    buttons = [
-        [InlineKeyboardButton(text="✋ Отключиться", callback_data="stop")],
-        [InlineKeyboardButton(text="⚠️ Пожаловаться", callback_data="complain")]
-    ]
-    if can_reveal:
-        buttons[0:0] = [[InlineKeyboardButton(text="🔓 Раскрыть личность", callback_data="reveal")]]
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+        def apply(conn):
+            step(conn)
+            conn.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                         (version, name, datetime.utcnow().isoformat()))
 
-# ============================
-# === Command handlers =======
-# ============================
-@dp.message(Command("start"))
-async def cmd_start(msg: types.Message):
-    ensure_user(msg.from_user)
-    if is_banned(msg.from_user.id):
-        await msg.answer("Вы заблокированы.")
+        db.transaction(apply)
+        logger.info("Applied schema migration %d: %s", version, name)
+
+def check_auto_vacuum():
+    """Convert an old file to auto_vacuum = INCREMENTAL if MAINTENANCE_CONVERT_VACUUM, else say it is off."""
+    conn = db.writer()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:  # 2 = INCREMENTAL
         return
-    await msg.answer(
-        "Привет! Это анонимный чат. Нажми кнопку чтобы найти собеседника.",
-        reply_markup=main_kb()
-    )
+    if not MAINTENANCE_CONVERT_VACUUM:
+        logger.warning("%s was created without auto_vacuum = INCREMENTAL: free pages are not given back. "
+                       "Start once with MAINTENANCE_CONVERT_VACUUM=1 (full VACUUM) to convert it.", db.path)
+        return
+    t0 = time.perf_counter()
+    # the mode only changes through VACUUM, which cannot run inside a transaction
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    logger.info("Converted %s to auto_vacuum = INCREMENTAL in %.1f s.", db.path, time.perf_counter() - t0)
 
-@dp.callback_query(Text("profile"))
-async def cb_profile(query: types.CallbackQuery):
-    ensure_user(query.from_user)
-    text = get_profile_text(query.from_user.id)
-    await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton("✏️ Редактировать анкету", callback_data="edit_profile")],
-        [InlineKeyboardButton("◀️ Назад", callback_data="back_main")]
-    ]))
-
-@dp.callback_query(Text("back_main"))
-async def cb_back(query: types.CallbackQuery):
-    await query.message.edit_text("Главное меню", reply_markup=main_kb())
+def db_execute(query, params=(), fetch=False, many=False):
+    t0 = time.perf_counter()
+    try:
+        return db.execute(query, params, fetch=fetch, many=many)
+    finally:
+        record_db_call(query, time.perf_counter() - t0)
 
-@dp.callback_query(Text("balance"))
-async def cb_balance(query: types.CallbackQuery):
-    ensure_user(query.from_user)
-    r = db_execute("SELECT balance FROM users WHERE user_id = ?", (query.from_user.id,), fetch=True)
-    bal = r[0][0] if r else 0
-    text = f"💰 Ваш баланс: {bal}\nВы можете пополнить баланс кнопкой ниже."
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton("Пополнить 50", callback_data="donate_50"),
-         InlineKeyboardButton("Пополнить 100", callback_data="donate_100")],
-        [InlineKeyboardButton("◀️ Назад", callback_data="back_main")]
-    ])
-    await query.message.edit_text(text, reply_markup=kb)
+class AsyncDB:
+    """Async facade over the connection manager, so handlers never block the event loop.
 
-# Donation flow: create a local invoice and provide a deep link to @CryptoBot
-@dp.callback_query(lambda c: c.data and c.data.startswith("donate_"))
-async def cb_donate(query: types.CallbackQuery):
-    ensure_user(query.from_user)
-    amount = int(query.data.split("_")[1])
-    invoice_id = secrets.token_hex(12)
-    created = datetime.utcnow().isoformat()
-    db_execute("INSERT INTO invoices (invoice_id, user_id, amount, created_at, paid) VALUES (?, ?, ?, ?, 0)",
-               (invoice_id, query.from_user.id, amount, created))
-    link = CRYPTO_DEEP_LINK_BASE + invoice_id
-    text = f"Оплатите {amount} условных единиц через CryptoBot по ссылке ниже.\nПосле оплаты нажмите 'Проверить оплату'."
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton("Оплатить через CryptoBot", url=link)],
-        [InlineKeyboardButton("Проверить оплату", callback_data=f"checkpay_{invoice_id}")],
-        [InlineKeyboardButton("◀️ Назад", callback_data="back_main")]
-    ])
-    await query.message.edit_text(text, reply_markup=kb)
+    Reads run on a small thread pool (each worker has its own reader connection).
+    Writes are queued to a single writer thread that group-commits everything queued
+    within DB_WRITE_BATCH_WINDOW_MS; each statement runs in its own savepoint so one
+    failing statement does not undo the rest of the batch. ``transaction(fn)`` queues a
+    multi-statement unit the same way: ``fn(conn)`` runs in the writer thread inside one
+    savepoint and either applies completely or not at all.
+    """
 
-# Check payment: For a real integration you must verify with CryptoBot API/webhook.
-# Here we provide a simple manual "check" that the admin can mark as paid (or you can implement polling).
-@dp.callback_query(lambda c: c.data and c.data.startswith("checkpay_"))
-async def cb_checkpay(query: types.CallbackQuery):
-    invoice_id = query.data.split("_", 1)[1]
-    r = db_execute("SELECT paid, amount, user_id FROM invoices WHERE invoice_id = ?", (invoice_id,), fetch=True)
-    if not r:
-        await query.answer("Счёт не найден.", show_alert=True)
-        return
-    paid, amount, user_id = r[0]
-    if paid:
-        await query.message.edit_text(f"Счёт {invoice_id} уже оплачен. Пополнено {amount}.")
-        return
-    # Not paid — instruct user/admin how to mark as paid.
-    if is_admin(query.from_user.id):
-        # Admin can mark invoice paid
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton("Отметить как оплачен", callback_data=f"markpaid_{invoice_id}")],
-            [InlineKeyboardButton("◀️ Назад", callback_data="back_main")]
-        ])
-        await query.message.edit_text(f"Счёт {invoice_id} не оплачен. Сумма: {amount}", reply_markup=kb)
-    else:
-        await query.answer("Счёт не оплачен. Попросите администратора подтвердить платеж.", show_alert=True)
+    def __init__(self, manager: SQLiteConnectionManager):
+        self.manager = manager
+        self._read_pool = None
+        self._write_queue = queue.Queue()
+        self._writer_thread = None
+        self._pending_reads = 0
+        self.stats = {"reads": 0, "writes": 0, "commits": 0, "max_batch": 0, "max_write_queue": 0}
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("markpaid_"))
-async def cb_markpaid(query: types.CallbackQuery):
-    if not is_admin(query.from_user.id):
-        await query.answer("Только администратор.", show_alert=True)
-        return
-    invoice_id = query.data.split("_", 1)[1]
-    r = db_execute("SELECT paid, amount, user_id FROM invoices WHERE invoice_id = ?", (invoice_id,), fetch=True)
-    if not r:
-        await query.answer("Счёт не найден.", show_alert=True)
-        return
-    paid, amount, user_id = r[0]
-    if paid:
-        await query.answer("Уже оплачен.", show_alert=True)
-        return
-    db_execute("UPDATE invoices SET paid = 1 WHERE invoice_id = ?", (invoice_id,))
-    add_balance(user_id, amount)
-    await query.message.edit_text(f"Отмечено как оплаченное. Пользователю {user_id} начислено {amount}.")
-    try:
-        await bot.send_message(user_id, f"Ваш платёж на {amount} зачислен на баланс.")
-    except Exception:
-        pass
+    def start(self):
+        if self._writer_thread is not None:
+            return
+        self._read_pool = ThreadPoolExecutor(max_workers=DB_READ_WORKERS, thread_name_prefix="db-read")
+        self._writer_thread = threading.Thread(target=self._writer_loop, name="db-write", daemon=True)
+        self._writer_thread.start()
 
-# ============================
-# === Pairing & chat logic ===
-# ============================
-def queue_add(user_id: int):
-    now = datetime.utcnow().isoformat()
-    try:
-        db_execute("INSERT INTO pairing (user_id, looking_since) VALUES (?, ?)", (user_id, now))
-    except Exception:
-        pass
+    def stop(self):
+        if self._writer_thread is None:
+            return
+        self._write_queue.put(None)
+        self._writer_thread.join()
+        self._writer_thread = None
+        self._read_pool.shutdown(wait=True)
+        self._read_pool = None
 
-def queue_remove(user_id: int):
-    db_execute("DELETE FROM pairing WHERE user_id = ?", (user_id,))
+    async def run_read(self, fn, *args):
+        """Run ``fn(conn, *args)`` on a reader connection in the read pool (long scans, exports)."""
+        if self._read_pool is None:
+            return fn(self.manager.reader(), *args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_pool, lambda: fn(self.manager.reader(), *args))
 
-def queue_find_pair(user_id: int):
-    # naive: pick first other user in queue
-    rows = db_execute("SELECT user_id FROM pairing WHERE user_id != ? ORDER BY looking_since LIMIT 1", (user_id,), fetch=True)
-    if not rows:
-        return None
-    return rows[0][0]
+    def metrics(self):
+        return dict(self.stats, write_queue=self._write_queue.qsize(), pending_reads=self._pending_reads)
 
-def create_chat(user1: int, user2: int):
-    db_execute("INSERT OR REPLACE INTO chats (user_id, peer_id) VALUES (?, ?)", (user1, user2))
-    db_execute("INSERT OR REPLACE INTO chats (user_id, peer_id) VALUES (?, ?)", (user2, user1))
+    async def execute(self, query, params=(), fetch=False, many=False):
+        if self._writer_thread is None:
+            # not started (scripts, startup): fall back to the synchronous path
+            return self.manager.execute(query, params, fetch=fetch, many=many)
+        loop = asyncio.get_running_loop()
+        if not many and self.manager.is_read(query):
+            self.stats["reads"] += 1
+            self._pending_reads += 1
+            try:
+                return await loop.run_in_executor(self._read_pool, self.manager.execute, query, params, fetch, False)
+            finally:
+                self._pending_reads -= 1
+        fut = loop.create_future()
+        self._write_queue.put((query, params, fetch, many, fut, loop))
+        depth = self._write_queue.qsize()
+        if depth > self.stats["max_write_queue"]:
+            self.stats["max_write_queue"] = depth
+        return await fut
 
-def end_chat(user_id: int):
-    r = db_execute("SELECT peer_id FROM chats WHERE user_id = ?", (user_id,), fetch=True)
-    if not r:
-        return None
-    peer = r[0][0]
-    db_execute("DELETE FROM chats WHERE user_id = ?", (user_id,))
-    db_execute("DELETE FROM chats WHERE user_id = ?", (peer,))
-    return peer
+    async def transaction(self, fn):
+        if self._writer_thread is None:
+            return self.manager.transaction(fn)
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._write_queue.put((fn, None, False, False, fut, loop))
+        return await fut
 
-def get_peer(user_id: int):
-    r = db_execute("SELECT peer_id FROM chats WHERE user_id = ?", (user_id,), fetch=True)
-    if not r:
-        return None
-    return r[0][0]
+    def execute_nowait(self, query, params=(), many=False):
+        """Queue a write without waiting for it; failures are logged, not raised."""
+        if self._writer_thread is None:
+            try:
+                self.manager.execute(query, params, many=many)
+            except Exception:
+                logger.exception("DB write failed: %s", query)
+            return
+        self._write_queue.put((query, params, False, many, None, None))
 
-@dp.callback_query(Text("find"))
-async def cb_find(query: types.CallbackQuery):
-    uid = query.from_user.id
-    ensure_user(query.from_user)
-    if is_banned(uid):
-        await query.answer("Вы заблокированы.", show_alert=True)
-        return
-    if is_muted(uid):
-        await query.answer("Вам временно запрещено искать собеседников.", show_alert=True)
-        return
-    # if already in chat:
-    if get_peer(uid):
-        await query.answer("Вы уже в чате. Нажмите Отключиться.", show_alert=True)
+    def _writer_loop(self):
+        window = DB_WRITE_BATCH_WINDOW_MS / 1000.0
+        stopping = False
+        while not stopping:
+            item = self._write_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + window
+            while len(batch) < DB_WRITE_BATCH_MAX:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._write_queue.get(timeout=timeout) if timeout > 0 else self._write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        results = []
+        with self.manager._write_lock:
+            conn = self.manager.writer()
+            try:
+                conn.execute("BEGIN IMMEDIATE")  # see SQLiteConnectionManager.transaction
+                for query, params, fetch, many, fut, loop in batch:
+                    conn.execute("SAVEPOINT stmt")
+                    try:
+                        if callable(query):
+                            result = query(conn)
+                        elif many:
+                            conn.executemany(query, params)
+                            result = None
+                        else:
+                            cur = conn.execute(query, params)
+                            result = cur.fetchall() if fetch else None
+                        conn.execute("RELEASE stmt")
+                        results.append((fut, loop, result, None))
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO stmt")
+                        conn.execute("RELEASE stmt")
+                        results.append((fut, loop, None, e))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logger.exception("DB group commit failed")
+                results = [(fut, loop, None, e) for _, _, _, _, fut, loop in batch]
+        self.stats["writes"] += len(batch)
+        self.stats["commits"] += 1
+        if len(batch) > self.stats["max_batch"]:
+            self.stats["max_batch"] = len(batch)
+        for fut, loop, result, exc in results:
+            if fut is None:
+                if exc is not None:
+                    logger.warning("Background DB write failed: %s", exc)
+                continue
+            loop.call_soon_threadsafe(_resolve_future, fut, result, exc)
+
+def _resolve_future(fut, result, exc):
+    if fut.cancelled():
         return
-    queue_add(uid)
-    pair = queue_find_pair(uid)
-    if pair:
-        # form chat
-        queue_remove(uid)
-        queue_remove(pair)
-        create_chat(uid, pair)
-        try:
-            await bot.send_message(uid, "Собеседник найден! Можно общаться. Чтобы раскрыть личность или пожаловаться нажми кнопку.", reply_markup=inchat_kb())
-        except Exception:
-            pass
-        try:
-            await bot.send_message(pair, "Собеседник найден! Можно общаться. Чтобы раскрыть личность или пожаловаться нажми кнопку.", reply_markup=inchat_kb())
-        except Exception:
-            pass
+    if exc is not None:
+        fut.set_exception(exc)
     else:
-        await query.message.edit_text("🔎 Ищем собеседника... Нажмите снова, если захотите отменить.", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton("Отменить поиск", callback_data="cancel_search")],
-            [InlineKeyboardButton("◀️ Назад", callback_data="back_main")]
-        ]))
-
-@dp.callback_query(Text("cancel_search"))
-async def cb_cancel_search(query: types.CallbackQuery):
-    queue_remove(query.from_user.id)
-    await query.message.edit_text("Поиск отменён.", reply_markup=main_kb())
+        fut.set_result(result)
 
-@dp.callback_query(Text("stop"))
-async def cb_stop(query: types.CallbackQuery):
-    peer = end_chat(query.from_user.id)
-    if peer:
-        try:
-            await bot.send_message(peer, "Собеседник отключился.", reply_markup=main_kb())
-        except Exception:
-            pass
-    await query.message.edit_text("Вы отключены.", reply_markup=main_kb())
+adb = AsyncDB(db)
 
-@dp.callback_query(Text("reveal"))
-async def cb_reveal(query: types.CallbackQuery):
-    uid = query.from_user.id
-    peer = get_peer(uid)
-    if not peer:
-        await query.answer("Вы не в чате.", show_alert=True)
-        return
-    # fetch profile of uid and send to peer
-    text = get_profile_text(uid)
+async def adb_execute(query, params=(), fetch=False, many=False):
+    t0 = time.perf_counter()
     try:
-        await bot.send_message(peer, f"Пользователь раскрыл личность:\n\n{text}")
-        await query.answer("Анкета отправлена собеседнику.", show_alert=True)
-    except Exception:
-        await query.answer("Не удалось отправить.", show_alert=True)
-
-@dp.callback_query(Text("complain"))
-async def cb_complain(query: types.CallbackQuery):
-    uid = query.from_user.id
-    peer = get_peer(uid)
-    if not peer:
-        await query.answer("Вы не в чате.", show_alert=True)
-        return
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton("Оскорбления", callback_data=f"compl_{peer}_insult")],
-        [InlineKeyboardButton("Спам / реклама", callback_data=f"compl_{peer}_spam")],
-        [InlineKeyboardButton("Другое", callback_data=f"compl_{peer}_other")],
-        [InlineKeyboardButton("◀️ Назад", callback_data="inchat_back")]
-    ])
-    await query.message.edit_text("Выберите причину жалобы:", reply_markup=kb)
+        return await adb.execute(query, params, fetch=fetch, many=many)
+    finally:
+        record_db_call(query, time.perf_counter() - t0)
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("compl_"))
-async def cb_compl_reason(query: types.CallbackQuery):
-    parts = query.data.split("_", 2)
-    target = int(parts[1])
-    reason = parts[2] if len(parts) > 2 else "Не указано"
-    db_execute("INSERT INTO complaints (complainer, target, reason, created_at) VALUES (?, ?, ?, ?)",
-               (query.from_user.id, target, reason, datetime.utcnow().isoformat()))
-    # auto-increase complaint count impacts reputation
-    db_execute("UPDATE users SET reputation = reputation - 1 WHERE user_id = ?", (target,))
-    # notify admins
-    for admin in ADMIN_IDS:
-        try:
-            await bot.send_message(admin, f"Новая жалоба на {target} от {query.from_user.id}. Причина: {reason}")
-        except Exception:
-            pass
-    await query.message.edit_text("Жалоба отправлена админам.", reply_markup=main_kb())
+async def adb_transaction(fn):
+    t0 = time.perf_counter()
+    try:
+        return await adb.transaction(fn)
+    finally:
+        record_db_call(fn, time.perf_counter() - t0)
 
 # ============================
-# === Message routing ========
+# === Storage backends =======
 # ============================
-@dp.message()
-async def handle_messages(msg: types.Message):
-    uid = msg.from_user.id
-    ensure_user(msg.from_user)
-    # if user is admin and sends commands in private chat, allow admin panel
-    if msg.text and msg.text.startswith("/admin"):
-        if not is_admin(uid):
-            await msg.reply("Недостаточно прав.")
-            return
-    # if user is in a chat, forward message to peer (text and simple media)
-    peer = get_peer(uid)
-    if peer:
-        if is_muted(uid):
-            await msg.reply("Вы временно заблокированы и не можете отправлять сообщения.")
-            return
-        # forward text
-        if msg.text:
-            await bot.send_message(peer, msg.text)
-        # forward stickers, photos, voice, etc. (basic)
-        elif msg.sticker:
-            await bot.send_sticker(peer, msg.sticker.file_id)
-        elif msg.photo:
-            await bot.send_photo(peer, msg.photo[-1].file_id, caption=msg.caption)
-        elif msg.voice:
-            await bot.send_voice(peer, msg.voice.file_id)
-        elif msg.video:
-            await bot.send_video(peer, msg.video.file_id, caption=msg.caption)
-        else:
-            await msg.reply("Этот тип сообщений пока не поддерживается.")
-        return
+# Handlers only talk to `storage`: storage.users / pairing / chats / games / complaints /
+# invoices. Rows are plain tuples in the column order each method documents.
+# STORAGE_BACKEND picks SQLiteStorage, MemoryStorage or PostgresStorage.
 
-    # if not in chat — interpret commands
-    text = msg.text or ""
-    if text.startswith("/profile_edit"):
-        # quick inline edit: "/profile_edit меня зовут Вася|25|про меня"
-        try:
-            _, payload = text.split(" ", 1)
-            parts = payload.split("|", 2)
-            display = parts[0]
-            about = parts[1] if len(parts) > 1 else ""
-            db_execute("UPDATE users SET display_name = ?, about = ? WHERE user_id = ?", (display, about, uid))
-            await msg.reply("Профиль обновлён.")
-        except Exception:
-            await msg.reply("Неправильный формат. Пример: /profile_edit Вася|Про меня")
-        return
+# invoices.paid states
+INVOICE_PENDING = 0
+INVOICE_PAID = 1
+INVOICE_EXPIRED = 2
 
-    if text.startswith("/start") and not peer:
-        await msg.reply("Используйте кнопки меню.", reply_markup=main_kb())
-        return
+# broadcasts.state
+BROADCAST_RUNNING = 0
+BROADCAST_DONE = 1
+BROADCAST_STOPPED = 2
+BROADCAST_FAILED = 3  # gave up after BROADCAST_RETRY_DELAYS
 
-    # If user typed "игры" etc — show games menu
-    if text.lower().startswith("игры") or text.lower().startswith("/games"):
-        await msg.reply("Игры меню:", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton("Камень-Ножницы-Бумага (1v1)", callback_data="game_rps")],
-            [InlineKeyboardButton("Угадай число (1v1)", callback_data="game_guess")],
-            [InlineKeyboardButton("◀️ Назад", callback_data="back_main")]
-        ]))
-        return
+USER_EXPORT_COLUMNS = ("user_id", "username", "display_name", "about", "created_at", "reputation", "balance",
+                       "vip_until", "banned", "muted_until")
 
-    # Fallback
-    await msg.reply("Чтобы начать — нажми 'Найти собеседника'.", reply_markup=main_kb())
+class UserFilter(NamedTuple):
+    """Admin browser / export filter, decoded from the compact code of parse_user_filter."""
+    banned: bool = False
+    vip: bool = False
+    rep_min: int = None
+    rep_max: int = None
 
-# ============================
-# === Mini-games (1v1) ======
-# ============================
-@dp.callback_query(Text("games"))
-async def cb_games_main(query: types.CallbackQuery):
-    await query.message.edit_text("Игры меню:", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton("Камень-Ножницы-Бумага (1v1)", callback_data="game_rps")],
-        [InlineKeyboardButton("Угадай число (1v1)", callback_data="game_guess")],
-        [InlineKeyboardButton("◀️ Назад", callback_data="back_main")]
-    ]))
+    @classmethod
+    def from_code(cls, code: str):
+        flt = cls()
+        for part in filter(None, code.split(",")):
+            if part == "b":
+                flt = flt._replace(banned=True)
+            elif part == "v":
+                flt = flt._replace(vip=True)
+            elif part.startswith("r"):
+                lo, hi = part[1:].split(":")
+                flt = flt._replace(rep_min=int(lo) if lo else None, rep_max=int(hi) if hi else None)
+        return flt
 
-@dp.callback_query(Text("game_rps"))
-async def cb_game_rps(query: types.CallbackQuery):
-    # join queue for RPS by reusing pairing table but with special marker
-    await query.message.edit_text("Нажми 'Найти соперника' чтобы играть в RPS (ставка может быть добавлена).",
-                                  reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                                      [InlineKeyboardButton("Найти соперника RPS", callback_data="find_rps")],
-                                      [InlineKeyboardButton("◀️ Назад", callback_data="cb_games_main")]
-                                  ]))
+    def matches(self, row: dict, now: int):
+        return ((not self.banned or row["banned"] == 1)
+                and (not self.vip or (row["vip_until"] or 0) > now)
+                and (self.rep_min is None or row["reputation"] >= self.rep_min)
+                and (self.rep_max is None or row["reputation"] <= self.rep_max))
 
-@dp.callback_query(Text("find_rps"))
-async def cb_find_rps(query: types.CallbackQuery):
-    uid = query.from_user.id
-    # add to games queue by using games table with game_type='rps'
-    try:
-        db_execute("INSERT OR REPLACE INTO games (user_id, game_type, state, peer_id) VALUES (?, ?, ?, ?)",
-                   (uid, "rps", "", None))
-    except Exception:
-        pass
-    # find other rps player
-    r = db_execute("SELECT user_id FROM games WHERE game_type = 'rps' AND user_id != ? LIMIT 1", (uid,), fetch=True)
-    if r:
-        peer = r[0][0]
-        # pair them
-        db_execute("UPDATE games SET peer_id = ? WHERE user_id = ?", (peer, uid))
-        db_execute("UPDATE games SET peer_id = ? WHERE user_id = ?", (uid, peer))
-        # initial state - waiting for moves
-        db_execute("UPDATE games SET state = ? WHERE user_id IN (?, ?)", ("waiting", uid, peer))
-        try:
-            await bot.send_message(uid, "Соперник найден! Отправь: камень / ножницы / бумага")
-            await bot.send_message(peer, "Соперник найден! Отправь: камень / ножницы / бумага")
-        except Exception:
-            pass
-    else:
-        await query.answer("Добавлено в очередь RPS. Подождите соперника.", show_alert=True)
+def user_filter_sql(flt: UserFilter):
+    clauses, params = [], []
+    if flt.banned:
+        clauses.append("banned = 1")
+    if flt.vip:
+        clauses.append("vip_until > ?")
+        params.append(now_ts())
+    if flt.rep_min is not None:
+        clauses.append("reputation >= ?")
+        params.append(flt.rep_min)
+    if flt.rep_max is not None:
+        clauses.append("reputation <= ?")
+        params.append(flt.rep_max)
+    return "".join(f" AND {c}" for c in clauses), params
 
-@dp.callback_query(Text("game_guess"))
-async def cb_game_guess(query: types.CallbackQuery):
-    await query.message.edit_text("Найди соперника для 'Угадай число' (1-10).", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton("Найти соперника Guess", callback_data="find_guess")],
-        [InlineKeyboardButton("◀️ Назад", callback_data="cb_games_main")]
-    ]))
+class Broadcast(NamedTuple):
+    """A broadcast and its checkpoint: every recipient up to ``last_user_id`` has been handled."""
+    id: int
+    admin_id: int
+    text: str
+    status_chat: int
+    status_message: int
+    total: int
+    last_user_id: int = 0
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
 
-@dp.callback_query(Text("find_guess"))
-async def cb_find_guess(query: types.CallbackQuery):
-    uid = query.from_user.id
-    try:
-        db_execute("INSERT OR REPLACE INTO games (user_id, game_type, state, peer_id) VALUES (?, ?, ?, ?)",
-                   (uid, "guess", "", None))
-    except Exception:
-        pass
-    r = db_execute("SELECT user_id FROM games WHERE game_type = 'guess' AND user_id != ? LIMIT 1", (uid,), fetch=True)
-    if r:
-        peer = r[0][0]
-        db_execute("UPDATE games SET peer_id = ? WHERE user_id = ?", (peer, uid))
-        db_execute("UPDATE games SET peer_id = ? WHERE user_id = ?", (uid, peer))
-        secret = secrets.randbelow(10) + 1
-        # store secret in state of one player (the setter)
-        db_execute("UPDATE games SET state = ? WHERE user_id = ?", (str(secret), uid))
-        db_execute("UPDATE games SET state = ? WHERE user_id = ?", ("guessing", peer))
-        try:
-            await bot.send_message(uid, f"Вы загадали число (секрет установлен). Соперник должен угадать.")
-            await bot.send_message(peer, "Соперник загадал число от 1 до 10. Отправьте вашу догадку (число).")
-        except Exception:
+BROADCAST_COLUMNS = "id, admin_id, text, status_chat, status_message, total, last_user_id, sent, failed, blocked"
+
+class UserRepository(ABC):
+    @abstractmethod
+    async def get_state(self, user_id: int):
+        """(banned, muted_until, vip_until, reputation, blocked_bot), or None if there is no such user."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def create(self, user_id: int, username: str, display_name: str, created_at: int):
+        """Insert the user unless they already exist."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_profile(self, user_id: int):
+        """(username, display_name, about, reputation, balance, vip_until), or None."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_balance(self, user_id: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update_profile(self, user_id: int, display_name: str, about: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add_balance(self, user_id: int, amount: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_vip_until(self, user_id: int, until: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_banned(self, user_id: int, banned: bool):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_muted_until(self, user_id: int, until: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_blocked_bot(self, user_id: int, blocked: bool):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def clear_expired(self, now: int, limit: int):
+        """Reset up to ``limit`` mutes and ``limit`` VIP periods that ended before ``now``;
+        returns (mutes, vips) cleared."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def page(self, flt: UserFilter, limit: int, after: int = None, before: int = None):
+        """Up to ``limit`` users with ids > after (ascending) or < before (descending):
+        (user_id, username, display_name, reputation, balance, vip_until, banned)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def export_csv(self, flt: UserFilter, path: str):
+        """Write USER_EXPORT_COLUMNS of the matching users to ``path``; returns the row count."""
+        raise NotImplementedError
+
+class PairingRepository(ABC):
+    """Durability log of the search queue; MatchmakingQueue in memory is authoritative."""
+
+    @abstractmethod
+    def add(self, user_id: int, since: int):
+        """Queue the write without waiting for it (the queue itself is already updated)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove(self, *user_ids: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def load(self):
+        """User ids, longest waiting first."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def stale(self, cutoff: int, limit: int):
+        """Up to ``limit`` user ids queued before ``cutoff``, longest waiting first."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def clear(self):
+        raise NotImplementedError
+
+class ChatRepository(ABC):
+    """Persistent copy of active_chats, read only at startup."""
+
+    @abstractmethod
+    async def load(self):
+        """[(user_id, peer_id)], one row per chat side."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def create(self, user1: int, user2: int):
+        """Store both sides at once, so a crash can never leave a half-open chat."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete(self, user1: int, user2: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def abandoned(self, after: int, limit: int):
+        """Up to ``limit`` chat sides with user_id > after, ascending, whose peer is gone:
+        no such user, banned, blocked the bot, or no longer in a chat with them.
+        [(user_id, peer_id)]."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete_sides(self, sides):
+        """Delete exactly these (user_id, peer_id) rows; other chats of the same users stay."""
+        raise NotImplementedError
+
+class ComplaintRepository(ABC):
+    @abstractmethod
+    async def create(self, complainer: int, target: int, reason: str, created_at: int):
+        """Store the complaint and take one reputation point from ``target``, atomically."""
+        raise NotImplementedError
+
+class GameRepository(ABC):
+    @abstractmethod
+    async def record_result(self, game_type: str, player1: int, player2: int, winner, finished_at: int):
+        """Store a finished game and give the winner (if any) a reputation point, atomically."""
+        raise NotImplementedError
+
+class InvoiceRepository(ABC):
+    @abstractmethod
+    async def create(self, invoice_id: str, user_id: int, amount: int, created_at: int, remote_id: int = None):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get(self, invoice_id: str):
+        """(paid, amount, user_id), or None."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def settle(self, invoice_id: str, include_expired: bool = False):
+        """Mark the invoice paid and credit the balance, atomically.
+
+        Returns (user_id, amount), or None if it was already settled / not found. The
+        status guard makes repeated settlement (double clicks, overlapping passes) a no-op.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def pending_remote(self, after, limit: int):
+        """Pending invoices with a Crypto Pay id, keyset-paged by (created_at, invoice_id) > after:
+        [(created_at, invoice_id, remote_id)]."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def apply_remote(self, paid, expired):
+        """Settle the ``paid`` invoice ids and expire the ``expired`` ones in one transaction;
+        returns the settled [(user_id, amount)]."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def expire_older_than(self, cutoff: int):
+        """Expire pending invoices created before ``cutoff``; returns how many."""
+        raise NotImplementedError
+
+class BroadcastRepository(ABC):
+    @abstractmethod
+    async def create(self, admin_id: int, text: str, status_chat: int, status_message: int, created_at: int):
+        """Store a new running broadcast to every user who has not blocked the bot; returns the Broadcast."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def unfinished(self):
+        """[Broadcast] still running (interrupted by a restart, or in progress)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def recipients(self, after: int, limit: int):
+        """Up to ``limit`` ids of users who have not blocked the bot, > after, ascending."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def checkpoint(self, broadcast: Broadcast, blocked_users):
+        """Save the progress and mark ``blocked_users`` as having blocked the bot, atomically.
+
+        Returns False if the broadcast is no longer running (stopped by an admin).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def finish(self, broadcast_id: int, state: int, finished_at: int):
+        """Move a running broadcast to ``state``; returns False if it was not running."""
+        raise NotImplementedError
+
+class Storage(ABC):
+    users: UserRepository
+    pairing: PairingRepository
+    chats: ChatRepository
+    complaints: ComplaintRepository
+    games: GameRepository
+    invoices: InvoiceRepository
+    broadcasts: BroadcastRepository
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def optimize(self, analyze: bool = False):
+        """Periodic housekeeping (free space, planner statistics); returns what it did."""
+        return {}
+
+    def metrics(self):
+        return {}
+
+# --- SQLite (default): AsyncDB group-commit writer + pooled readers ---
+class SQLiteUsers(UserRepository):
+    async def get_state(self, user_id):
+        r = await adb_execute("SELECT banned, muted_until, vip_until, reputation, blocked_bot FROM users WHERE user_id = ?",
+                              (user_id,), fetch=True)
+        return r[0] if r else None
+
+    async def create(self, user_id, username, display_name, created_at):
+        await adb_execute(
+            "INSERT OR IGNORE INTO users (user_id, username, display_name, about, created_at) VALUES (?, ?, ?, ?, ?)",
+            (user_id, username, display_name, "", created_at))
+
+    async def get_profile(self, user_id):
+        r = await adb_execute("SELECT username, display_name, about, reputation, balance, vip_until FROM users WHERE user_id = ?",
+                              (user_id,), fetch=True)
+        return r[0] if r else None
+
+    async def get_balance(self, user_id):
+        r = await adb_execute("SELECT balance FROM users WHERE user_id = ?", (user_id,), fetch=True)
+        return r[0][0] if r else None
+
+    async def update_profile(self, user_id, display_name, about):
+        await adb_execute("UPDATE users SET display_name = ?, about = ? WHERE user_id = ?", (display_name, about, user_id))
+
+    async def add_balance(self, user_id, amount):
+        await adb_execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
+
+    async def set_vip_until(self, user_id, until):
+        await adb_execute("UPDATE users SET vip_until = ? WHERE user_id = ?", (until, user_id))
+
+    async def set_banned(self, user_id, banned):
+        await adb_execute("UPDATE users SET banned = ? WHERE user_id = ?", (int(banned), user_id))
+
+    async def set_muted_until(self, user_id, until):
+        await adb_execute("UPDATE users SET muted_until = ? WHERE user_id = ?", (until, user_id))
+
+    async def set_blocked_bot(self, user_id, blocked):
+        await adb_execute("UPDATE users SET blocked_bot = ? WHERE user_id = ? AND blocked_bot <> ?",
+                          (int(blocked), user_id, int(blocked)))
+
+    async def clear_expired(self, now, limit):
+        # both walk the partial indexes on muted_until / vip_until
+        def clear_expired_flags(conn):
+            return tuple(conn.execute(
+                f"UPDATE users SET {column} = NULL WHERE user_id IN "
+                f"(SELECT user_id FROM users WHERE {column} <= ? LIMIT ?)", (now, limit)).rowcount
+                for column in ("muted_until", "vip_until"))
+
+        return await adb_transaction(clear_expired_flags)
+
+    async def page(self, flt, limit, after=None, before=None):
+        where, params = user_filter_sql(flt)
+        cols = "user_id, username, display_name, reputation, balance, vip_until, banned"
+        if before is not None:
+            return await adb_execute(f"SELECT {cols} FROM users WHERE user_id < ?{where} ORDER BY user_id DESC LIMIT ?",
+                                     (before, *params, limit), fetch=True)
+        return await adb_execute(f"SELECT {cols} FROM users WHERE user_id > ?{where} ORDER BY user_id LIMIT ?",
+                                 (after or 0, *params, limit), fetch=True)
+
+    async def export_csv(self, flt, path):
+        # rows are streamed from the cursor to disk in a DB thread
+        return await adb.run_read(_write_users_csv, path, flt)
+
+def _write_users_csv(conn, path: str, flt: UserFilter):
+    where, params = user_filter_sql(flt)
+    cur = conn.execute(f"SELECT {', '.join(USER_EXPORT_COLUMNS)} FROM users WHERE 1 = 1{where} ORDER BY user_id", params)
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(USER_EXPORT_COLUMNS)
+        while True:
+            rows = cur.fetchmany(1000)
+            if not rows:
+                break
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+class SQLitePairing(PairingRepository):
+    def add(self, user_id, since):
+        adb.execute_nowait("INSERT OR REPLACE INTO pairing (user_id, looking_since) VALUES (?, ?)", (user_id, since))
+
+    def remove(self, *user_ids):
+        adb.execute_nowait(f"DELETE FROM pairing WHERE user_id IN ({', '.join('?' * len(user_ids))})", user_ids)
+
+    async def load(self):
+        rows = await adb_execute("SELECT user_id FROM pairing ORDER BY looking_since", fetch=True)
+        return [user_id for (user_id,) in rows]
+
+    async def stale(self, cutoff, limit):
+        rows = await adb_execute("SELECT user_id FROM pairing WHERE looking_since < ? ORDER BY looking_since LIMIT ?",
+                                 (cutoff, limit), fetch=True)
+        return [user_id for (user_id,) in rows]
+
+    async def clear(self):
+        await adb_execute("DELETE FROM pairing")
+
+class SQLiteChats(ChatRepository):
+    async def load(self):
+        return await adb_execute("SELECT user_id, peer_id FROM chats", fetch=True)
+
+    async def create(self, user1, user2):
+        await adb_execute("INSERT OR REPLACE INTO chats (user_id, peer_id) VALUES (?, ?)",
+                          [(user1, user2), (user2, user1)], many=True)
+
+    async def delete(self, user1, user2):
+        await adb_execute("DELETE FROM chats WHERE user_id IN (?, ?)", (user1, user2))
+
+    async def abandoned(self, after, limit):
+        return await adb_execute(
+            "SELECT c.user_id, c.peer_id FROM chats c "
+            "LEFT JOIN users u ON u.user_id = c.peer_id LEFT JOIN chats p ON p.user_id = c.peer_id "
+            "WHERE c.user_id > ? AND (u.user_id IS NULL OR u.banned = 1 OR u.blocked_bot = 1 OR p.peer_id IS NOT c.user_id) "
+            "ORDER BY c.user_id LIMIT ?", (after, limit), fetch=True)
+
+    async def delete_sides(self, sides):
+        await adb_execute("DELETE FROM chats WHERE user_id = ? AND peer_id = ?", list(sides), many=True)
+
+class SQLiteComplaints(ComplaintRepository):
+    async def create(self, complainer, target, reason, created_at):
+        def record_complaint(conn):
+            conn.execute("INSERT INTO complaints (complainer, target, reason, created_at) VALUES (?, ?, ?, ?)",
+                         (complainer, target, reason, created_at))
+            conn.execute("UPDATE users SET reputation = reputation - 1 WHERE user_id = ?", (target,))
+
+        await adb_transaction(record_complaint)
+
+class SQLiteGames(GameRepository):
+    async def record_result(self, game_type, player1, player2, winner, finished_at):
+        def record_game(conn):
+            conn.execute("INSERT INTO game_results (game_type, player1, player2, winner, finished_at) VALUES (?, ?, ?, ?, ?)",
+                         (game_type, player1, player2, winner, finished_at))
+            if winner is not None:
+                conn.execute("UPDATE users SET reputation = reputation + 1 WHERE user_id = ?", (winner,))
+
+        await adb_transaction(record_game)
+
+def _settle_invoice(conn, invoice_id: str, include_expired: bool = False):
+    states = (INVOICE_PENDING, INVOICE_EXPIRED) if include_expired else (INVOICE_PENDING,)
+    row = conn.execute(
+        f"UPDATE invoices SET paid = {INVOICE_PAID} WHERE invoice_id = ? AND paid IN ({', '.join(map(str, states))}) "
+        "RETURNING user_id, amount", (invoice_id,)).fetchone()
+    if row is not None:
+        conn.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (row[1], row[0]))
+    return row
+
+class SQLiteInvoices(InvoiceRepository):
+    async def create(self, invoice_id, user_id, amount, created_at, remote_id=None):
+        await adb_execute("INSERT INTO invoices (invoice_id, user_id, amount, created_at, paid, remote_id) VALUES (?, ?, ?, ?, 0, ?)",
+                          (invoice_id, user_id, amount, created_at, remote_id))
+
+    async def get(self, invoice_id):
+        r = await adb_execute("SELECT paid, amount, user_id FROM invoices WHERE invoice_id = ?", (invoice_id,), fetch=True)
+        return r[0] if r else None
+
+    async def settle(self, invoice_id, include_expired=False):
+        def settle_invoice(conn):
+            return _settle_invoice(conn, invoice_id, include_expired)
+
+        return await adb_transaction(settle_invoice)
+
+    async def pending_remote(self, after, limit):
+        return await adb_execute(
+            f"SELECT created_at, invoice_id, remote_id FROM invoices WHERE paid = {INVOICE_PENDING} "
+            "AND (created_at, invoice_id) > (?, ?) AND remote_id IS NOT NULL ORDER BY created_at, invoice_id LIMIT ?",
+            (*after, limit), fetch=True)
+
+    async def apply_remote(self, paid, expired):
+        def apply_invoice_statuses(conn):
+            settled = [row for row in (_settle_invoice(conn, invoice_id) for invoice_id in paid) if row]
+            conn.executemany(f"UPDATE invoices SET paid = {INVOICE_EXPIRED} WHERE invoice_id = ? AND paid = {INVOICE_PENDING}",
+                             [(invoice_id,) for invoice_id in expired])
+            return settled
+
+        return await adb_transaction(apply_invoice_statuses)
+
+    async def expire_older_than(self, cutoff):
+        def expire_invoices(conn):
+            return conn.execute(f"UPDATE invoices SET paid = {INVOICE_EXPIRED} WHERE paid = {INVOICE_PENDING} AND created_at < ?",
+                                (cutoff,)).rowcount
+
+        return await adb_transaction(expire_invoices)
+
+class SQLiteBroadcasts(BroadcastRepository):
+    async def create(self, admin_id, text, status_chat, status_message, created_at):
+        # counted on a reader first: the total is only shown in the status, the scan stays off the writer
+        total = (await adb_execute("SELECT COUNT(*) FROM users WHERE blocked_bot = 0", fetch=True))[0][0]
+
+        def create_broadcast(conn):
+            return conn.execute(
+                "INSERT INTO broadcasts (admin_id, text, status_chat, status_message, total, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (admin_id, text, status_chat, status_message, total, created_at)).lastrowid
+
+        broadcast_id = await adb_transaction(create_broadcast)
+        return Broadcast(broadcast_id, admin_id, text, status_chat, status_message, total)
+
+    async def unfinished(self):
+        rows = await adb_execute(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE state = {BROADCAST_RUNNING} ORDER BY id",
+                                 fetch=True)
+        return [Broadcast(*row) for row in rows]
+
+    async def recipients(self, after, limit):
+        rows = await adb_execute("SELECT user_id FROM users WHERE user_id > ? AND blocked_bot = 0 ORDER BY user_id LIMIT ?",
+                                 (after, limit), fetch=True)
+        return [user_id for (user_id,) in rows]
+
+    async def checkpoint(self, broadcast, blocked_users):
+        def checkpoint_broadcast(conn):
+            conn.executemany("UPDATE users SET blocked_bot = 1 WHERE user_id = ?", [(uid,) for uid in blocked_users])
+            return conn.execute(
+                f"UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, blocked = ? WHERE id = ? AND state = {BROADCAST_RUNNING}",
+                (broadcast.last_user_id, broadcast.sent, broadcast.failed, broadcast.blocked, broadcast.id)).rowcount > 0
+
+        return await adb_transaction(checkpoint_broadcast)
+
+    async def finish(self, broadcast_id, state, finished_at):
+        def finish_broadcast(conn):
+            return conn.execute(f"UPDATE broadcasts SET state = ?, finished_at = ? WHERE id = ? AND state = {BROADCAST_RUNNING}",
+                                (state, finished_at, broadcast_id)).rowcount > 0
+
+        return await adb_transaction(finish_broadcast)
+
+class SQLiteStorage(Storage):
+    def __init__(self):
+        self.users = SQLiteUsers()
+        self.pairing = SQLitePairing()
+        self.chats = SQLiteChats()
+        self.complaints = SQLiteComplaints()
+        self.games = SQLiteGames()
+        self.invoices = SQLiteInvoices()
+        self.broadcasts = SQLiteBroadcasts()
+
+    async def open(self):
+        init_db()
+        migrate_db()
+        check_auto_vacuum()
+        adb.start()
+
+    async def close(self):
+        adb.stop()
+        db.close()
+
+    async def optimize(self, analyze=False):
+        def optimize_db(conn):
+            # the writer batch runs under BEGIN IMMEDIATE, so reading the freelist first cannot
+            # make the incremental_vacuum writes below fail on a lock upgrade
+            before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            # a no-op unless auto_vacuum = INCREMENTAL (see check_auto_vacuum); sqlite3 steps a
+            # statement without result columns once, and each step frees a single page
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                for _ in range(min(before, MAINTENANCE_VACUUM_PAGES)):
+                    conn.execute("PRAGMA incremental_vacuum")
+            if analyze:
+                conn.execute("PRAGMA optimize")  # ANALYZE where the statistics went stale
+            return {"freed_pages": before - conn.execute("PRAGMA freelist_count").fetchone()[0], "analyzed": analyze}
+
+        return await adb_transaction(optimize_db)
+
+    def metrics(self):
+        return adb.metrics()
+
+# --- In memory: tests and benchmarks, nothing survives a restart ---
+# Every method finishes without awaiting, so multi-row changes are atomic on the event loop.
+class MemoryUsers(UserRepository):
+    def __init__(self):
+        self.rows = {}  # user_id -> {column: value}
+        self.ids = []   # sorted user ids, for keyset pages
+
+    async def get_state(self, user_id):
+        row = self.rows.get(user_id)
+        return (row["banned"], row["muted_until"], row["vip_until"], row["reputation"], row["blocked_bot"]) if row else None
+
+    async def create(self, user_id, username, display_name, created_at):
+        if user_id in self.rows:
+            return
+        self.rows[user_id] = {"user_id": user_id, "username": username, "display_name": display_name, "about": "",
+                              "created_at": created_at, "reputation": 0, "balance": 0, "vip_until": None,
+                              "banned": 0, "muted_until": None, "blocked_bot": 0}
+        bisect.insort(self.ids, user_id)
+
+    async def get_profile(self, user_id):
+        row = self.rows.get(user_id)
+        if row is None:
+            return None
+        return tuple(row[c] for c in ("username", "display_name", "about", "reputation", "balance", "vip_until"))
+
+    async def get_balance(self, user_id):
+        row = self.rows.get(user_id)
+        return row["balance"] if row else None
+
+    def _set(self, user_id, **fields):
+        row = self.rows.get(user_id)
+        if row is not None:
+            row.update(fields)
+
+    def _add(self, user_id, column, delta):
+        row = self.rows.get(user_id)
+        if row is not None:
+            row[column] += delta
+
+    async def update_profile(self, user_id, display_name, about):
+        self._set(user_id, display_name=display_name, about=about)
+
+    async def add_balance(self, user_id, amount):
+        self._add(user_id, "balance", amount)
+
+    async def set_vip_until(self, user_id, until):
+        self._set(user_id, vip_until=until)
+
+    async def set_banned(self, user_id, banned):
+        self._set(user_id, banned=int(banned))
+
+    async def set_muted_until(self, user_id, until):
+        self._set(user_id, muted_until=until)
+
+    async def set_blocked_bot(self, user_id, blocked):
+        self._set(user_id, blocked_bot=int(blocked))
+
+    async def clear_expired(self, now, limit):
+        cleared = []
+        for column in ("muted_until", "vip_until"):
+            rows = [row for row in self.rows.values() if row[column] is not None and row[column] <= now][:limit]
+            for row in rows:
+                row[column] = None
+            cleared.append(len(rows))
+        return tuple(cleared)
+
+    def _scan(self, flt, limit, after, before):
+        now = now_ts()
+        if before is not None:
+            ids = (self.ids[i] for i in range(bisect.bisect_left(self.ids, before) - 1, -1, -1))
+        else:
+            ids = (self.ids[i] for i in range(bisect.bisect_right(self.ids, after or 0), len(self.ids)))
+        rows = []
+        for user_id in ids:
+            row = self.rows[user_id]
+            if flt.matches(row, now):
+                rows.append(row)
+                if limit is not None and len(rows) == limit:
+                    break
+        return rows
+
+    async def page(self, flt, limit, after=None, before=None):
+        cols = ("user_id", "username", "display_name", "reputation", "balance", "vip_until", "banned")
+        return [tuple(row[c] for c in cols) for row in self._scan(flt, limit, after, before)]
+
+    async def export_csv(self, flt, path):
+        rows = self._scan(flt, None, None, None)
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(USER_EXPORT_COLUMNS)
+            writer.writerows(tuple(row[c] for c in USER_EXPORT_COLUMNS) for row in rows)
+        return len(rows)
+
+class MemoryPairing(PairingRepository):
+    def __init__(self):
+        self.since = {}
+
+    def add(self, user_id, since):
+        self.since[user_id] = since
+
+    def remove(self, *user_ids):
+        for user_id in user_ids:
+            self.since.pop(user_id, None)
+
+    async def load(self):
+        return sorted(self.since, key=self.since.get)
+
+    async def stale(self, cutoff, limit):
+        return sorted((u for u, since in self.since.items() if since < cutoff), key=self.since.get)[:limit]
+
+    async def clear(self):
+        self.since.clear()
+
+class MemoryChats(ChatRepository):
+    def __init__(self, users: MemoryUsers):
+        self.users = users
+        self.peers = {}
+
+    async def load(self):
+        return list(self.peers.items())
+
+    async def create(self, user1, user2):
+        self.peers[user1] = user2
+        self.peers[user2] = user1
+
+    async def delete(self, user1, user2):
+        self.peers.pop(user1, None)
+        self.peers.pop(user2, None)
+
+    async def abandoned(self, after, limit):
+        sides = []
+        for user_id in sorted(u for u in self.peers if u > after):
+            peer = self.peers[user_id]
+            row = self.users.rows.get(peer)
+            if row is None or row["banned"] == 1 or row["blocked_bot"] or self.peers.get(peer) != user_id:
+                sides.append((user_id, peer))
+                if len(sides) == limit:
+                    break
+        return sides
+
+    async def delete_sides(self, sides):
+        for user_id, peer in sides:
+            if self.peers.get(user_id) == peer:
+                del self.peers[user_id]
+
+class MemoryComplaints(ComplaintRepository):
+    def __init__(self, users: MemoryUsers):
+        self.users = users
+        self.rows = []
+
+    async def create(self, complainer, target, reason, created_at):
+        self.rows.append((complainer, target, reason, created_at))
+        self.users._add(target, "reputation", -1)
+
+class MemoryGames(GameRepository):
+    def __init__(self, users: MemoryUsers):
+        self.users = users
+        self.results = []
+
+    async def record_result(self, game_type, player1, player2, winner, finished_at):
+        self.results.append((game_type, player1, player2, winner, finished_at))
+        if winner is not None:
+            self.users._add(winner, "reputation", 1)
+
+class MemoryInvoices(InvoiceRepository):
+    def __init__(self, users: MemoryUsers):
+        self.users = users
+        self.rows = {}  # invoice_id -> {column: value}
+
+    async def create(self, invoice_id, user_id, amount, created_at, remote_id=None):
+        if invoice_id in self.rows:
+            raise ValueError(f"duplicate invoice id {invoice_id}")
+        self.rows[invoice_id] = {"user_id": user_id, "amount": amount, "created_at": created_at,
+                                 "paid": INVOICE_PENDING, "remote_id": remote_id}
+
+    async def get(self, invoice_id):
+        row = self.rows.get(invoice_id)
+        return (row["paid"], row["amount"], row["user_id"]) if row else None
+
+    def _settle(self, invoice_id, include_expired=False):
+        row = self.rows.get(invoice_id)
+        if row is None or row["paid"] not in ((INVOICE_PENDING, INVOICE_EXPIRED) if include_expired else (INVOICE_PENDING,)):
+            return None
+        row["paid"] = INVOICE_PAID
+        self.users._add(row["user_id"], "balance", row["amount"])
+        return row["user_id"], row["amount"]
+
+    async def settle(self, invoice_id, include_expired=False):
+        return self._settle(invoice_id, include_expired)
+
+    async def pending_remote(self, after, limit):
+        rows = sorted((row["created_at"], invoice_id, row["remote_id"]) for invoice_id, row in self.rows.items()
+                      if row["paid"] == INVOICE_PENDING and row["remote_id"] is not None
+                      and (row["created_at"], invoice_id) > tuple(after))
+        return rows[:limit]
+
+    async def apply_remote(self, paid, expired):
+        settled = [row for row in (self._settle(invoice_id) for invoice_id in paid) if row]
+        for invoice_id in expired:
+            row = self.rows.get(invoice_id)
+            if row is not None and row["paid"] == INVOICE_PENDING:
+                row["paid"] = INVOICE_EXPIRED
+        return settled
+
+    async def expire_older_than(self, cutoff):
+        count = 0
+        for row in self.rows.values():
+            if row["paid"] == INVOICE_PENDING and row["created_at"] < cutoff:
+                row["paid"] = INVOICE_EXPIRED
+                count += 1
+        return count
+
+class MemoryBroadcasts(BroadcastRepository):
+    def __init__(self, users: MemoryUsers):
+        self.users = users
+        self.rows = {}  # id -> (Broadcast, state)
+
+    async def create(self, admin_id, text, status_chat, status_message, created_at):
+        total = sum(1 for row in self.users.rows.values() if not row["blocked_bot"])
+        broadcast = Broadcast(len(self.rows) + 1, admin_id, text, status_chat, status_message, total)
+        self.rows[broadcast.id] = (broadcast, BROADCAST_RUNNING)
+        return broadcast
+
+    async def unfinished(self):
+        return [b for b, state in self.rows.values() if state == BROADCAST_RUNNING]
+
+    async def recipients(self, after, limit):
+        ids = self.users.ids
+        result = []
+        for i in range(bisect.bisect_right(ids, after), len(ids)):
+            if not self.users.rows[ids[i]]["blocked_bot"]:
+                result.append(ids[i])
+                if len(result) == limit:
+                    break
+        return result
+
+    async def checkpoint(self, broadcast, blocked_users):
+        for user_id in blocked_users:
+            self.users._set(user_id, blocked_bot=1)
+        if self.rows[broadcast.id][1] != BROADCAST_RUNNING:
+            return False
+        self.rows[broadcast.id] = (broadcast, BROADCAST_RUNNING)
+        return True
+
+    async def finish(self, broadcast_id, state, finished_at):
+        broadcast, current = self.rows[broadcast_id]
+        if current != BROADCAST_RUNNING:
+            return False
+        self.rows[broadcast_id] = (broadcast, state)
+        return True
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.users = MemoryUsers()
+        self.pairing = MemoryPairing()
+        self.chats = MemoryChats(self.users)
+        self.complaints = MemoryComplaints(self.users)
+        self.games = MemoryGames(self.users)
+        self.invoices = MemoryInvoices(self.users)
+        self.broadcasts = MemoryBroadcasts(self.users)
+
+    def metrics(self):
+        return {"users": len(self.users.rows), "invoices": len(self.invoices.rows)}
+
+# --- PostgreSQL (optional, needs asyncpg) ---
+# Queries are written with "?" placeholders like the SQLite ones and numbered ($1, $2, ...)
+# once per distinct statement.
+POSTGRES_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        display_name TEXT,
+        about TEXT,
+        created_at BIGINT,
+        reputation INTEGER NOT NULL DEFAULT 0,
+        balance BIGINT NOT NULL DEFAULT 0,
+        vip_until BIGINT,
+        banned SMALLINT NOT NULL DEFAULT 0,
+        muted_until BIGINT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS pairing (
+        user_id BIGINT PRIMARY KEY,
+        looking_since BIGINT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS chats (
+        user_id BIGINT PRIMARY KEY,
+        peer_id BIGINT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS complaints (
+        id BIGSERIAL PRIMARY KEY,
+        complainer BIGINT,
+        target BIGINT,
+        reason TEXT,
+        created_at BIGINT,
+        handled SMALLINT NOT NULL DEFAULT 0
+    )''',
+    '''CREATE TABLE IF NOT EXISTS invoices (
+        invoice_id TEXT PRIMARY KEY,
+        user_id BIGINT,
+        amount BIGINT,
+        created_at BIGINT,
+        paid SMALLINT NOT NULL DEFAULT 0,
+        remote_id BIGINT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS game_results (
+        id BIGSERIAL PRIMARY KEY,
+        game_type TEXT,
+        player1 BIGINT,
+        player2 BIGINT,
+        winner BIGINT,
+        finished_at BIGINT
+    )''',
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_bot SMALLINT NOT NULL DEFAULT 0",
+    '''CREATE TABLE IF NOT EXISTS broadcasts (
+        id BIGSERIAL PRIMARY KEY,
+        admin_id BIGINT,
+        text TEXT,
+        status_chat BIGINT,
+        status_message BIGINT,
+        total BIGINT,
+        last_user_id BIGINT NOT NULL DEFAULT 0,
+        sent BIGINT NOT NULL DEFAULT 0,
+        failed BIGINT NOT NULL DEFAULT 0,
+        blocked BIGINT NOT NULL DEFAULT 0,
+        state SMALLINT NOT NULL DEFAULT 0,
+        created_at BIGINT,
+        finished_at BIGINT
+    )''',
+    "CREATE INDEX IF NOT EXISTS idx_pairing_looking_since ON pairing (looking_since, user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_invoices_user_paid ON invoices (user_id, paid)",
+    "CREATE INDEX IF NOT EXISTS idx_invoices_paid_created ON invoices (paid, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_complaints_target ON complaints (target, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_complaints_complainer ON complaints (complainer, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_users_banned ON users (user_id) WHERE banned = 1",
+    "CREATE INDEX IF NOT EXISTS idx_users_vip_until ON users (vip_until) WHERE vip_until IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_users_muted_until ON users (muted_until) WHERE muted_until IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_game_results_player1 ON game_results (player1)",
+    "CREATE INDEX IF NOT EXISTS idx_game_results_player2 ON game_results (player2)",
+    "CREATE INDEX IF NOT EXISTS idx_broadcasts_state ON broadcasts (state)",
+]
+
+_pg_queries = {}
+
+def _pg_query(query: str):
+    numbered = _pg_queries.get(query)
+    if numbered is None:
+        parts = query.split("?")
+        numbered = parts[0] + "".join(f"${i}{part}" for i, part in enumerate(parts[1:], 1))
+        _pg_queries[query] = numbered
+    return numbered
+
+class PostgresStorage(Storage):
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.pool = None
+        self._pending = set()  # fire-and-forget writes (pairing log)
+        self.users = PostgresUsers(self)
+        self.pairing = PostgresPairing(self)
+        self.chats = PostgresChats(self)
+        self.complaints = PostgresComplaints(self)
+        self.games = PostgresGames(self)
+        self.invoices = PostgresInvoices(self)
+        self.broadcasts = PostgresBroadcasts(self)
+
+    async def open(self):
+        if asyncpg is None:
+            raise RuntimeError("STORAGE_BACKEND=postgres needs asyncpg: pip install asyncpg")
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=POSTGRES_POOL_SIZE)
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                for statement in POSTGRES_SCHEMA:
+                    await conn.execute(statement)
+
+    async def close(self):
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def optimize(self, analyze=False):
+        # autovacuum reclaims space on its own; refresh the planner statistics on schedule
+        if analyze:
+            await self.execute("ANALYZE")
+        return {"analyzed": analyze}
+
+    def metrics(self):
+        if self.pool is None:
+            return {}
+        return {"pool_size": self.pool.get_size(), "pool_idle": self.pool.get_idle_size(),
+                "pending_writes": len(self._pending)}
+
+    async def fetch(self, query, *args):
+        t0 = time.perf_counter()
+        try:
+            return await self.pool.fetch(_pg_query(query), *args)
+        finally:
+            record_db_call(query, time.perf_counter() - t0)
+
+    async def execute(self, query, *args):
+        """Run one statement; returns the number of rows it touched."""
+        t0 = time.perf_counter()
+        try:
+            status = await self.pool.execute(_pg_query(query), *args)
+        finally:
+            record_db_call(query, time.perf_counter() - t0)
+        tail = status.rsplit(" ", 1)[-1]
+        return int(tail) if tail.isdigit() else 0
+
+    async def transaction(self, fn):
+        """Run ``await fn(conn)`` inside one transaction; use ``_pg_query`` for its statements."""
+        t0 = time.perf_counter()
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    return await fn(conn)
+        finally:
+            record_db_call(fn, time.perf_counter() - t0)
+
+    def execute_nowait(self, query, *args):
+        async def write():
+            try:
+                await self.execute(query, *args)
+            except Exception as e:
+                logger.warning("Background DB write failed: %s", e)
+
+        task = asyncio.get_running_loop().create_task(write())
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+class PostgresUsers(UserRepository):
+    def __init__(self, pg: PostgresStorage):
+        self.pg = pg
+
+    async def get_state(self, user_id):
+        rows = await self.pg.fetch("SELECT banned, muted_until, vip_until, reputation, blocked_bot FROM users WHERE user_id = ?",
+                                   user_id)
+        return tuple(rows[0]) if rows else None
+
+    async def create(self, user_id, username, display_name, created_at):
+        await self.pg.execute(
+            "INSERT INTO users (user_id, username, display_name, about, created_at) VALUES (?, ?, ?, '', ?) "
+            "ON CONFLICT (user_id) DO NOTHING", user_id, username, display_name, created_at)
+
+    async def get_profile(self, user_id):
+        rows = await self.pg.fetch(
+            "SELECT username, display_name, about, reputation, balance, vip_until FROM users WHERE user_id = ?", user_id)
+        return tuple(rows[0]) if rows else None
+
+    async def get_balance(self, user_id):
+        rows = await self.pg.fetch("SELECT balance FROM users WHERE user_id = ?", user_id)
+        return rows[0][0] if rows else None
+
+    async def update_profile(self, user_id, display_name, about):
+        await self.pg.execute("UPDATE users SET display_name = ?, about = ? WHERE user_id = ?", display_name, about, user_id)
+
+    async def add_balance(self, user_id, amount):
+        await self.pg.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", amount, user_id)
+
+    async def set_vip_until(self, user_id, until):
+        await self.pg.execute("UPDATE users SET vip_until = ? WHERE user_id = ?", until, user_id)
+
+    async def set_banned(self, user_id, banned):
+        await self.pg.execute("UPDATE users SET banned = ? WHERE user_id = ?", int(banned), user_id)
+
+    async def set_muted_until(self, user_id, until):
+        await self.pg.execute("UPDATE users SET muted_until = ? WHERE user_id = ?", until, user_id)
+
+    async def set_blocked_bot(self, user_id, blocked):
+        await self.pg.execute("UPDATE users SET blocked_bot = ? WHERE user_id = ? AND blocked_bot <> ?",
+                              int(blocked), user_id, int(blocked))
+
+    async def clear_expired(self, now, limit):
+        mutes = await self.pg.execute("UPDATE users SET muted_until = NULL WHERE user_id IN "
+                                      "(SELECT user_id FROM users WHERE muted_until <= ? LIMIT ?)", now, limit)
+        vips = await self.pg.execute("UPDATE users SET vip_until = NULL WHERE user_id IN "
+                                     "(SELECT user_id FROM users WHERE vip_until <= ? LIMIT ?)", now, limit)
+        return mutes, vips
+
+    async def page(self, flt, limit, after=None, before=None):
+        where, params = user_filter_sql(flt)
+        cols = "user_id, username, display_name, reputation, balance, vip_until, banned"
+        if before is not None:
+            rows = await self.pg.fetch(f"SELECT {cols} FROM users WHERE user_id < ?{where} ORDER BY user_id DESC LIMIT ?",
+                                       before, *params, limit)
+        else:
+            rows = await self.pg.fetch(f"SELECT {cols} FROM users WHERE user_id > ?{where} ORDER BY user_id LIMIT ?",
+                                       after or 0, *params, limit)
+        return [tuple(r) for r in rows]
+
+    async def export_csv(self, flt, path):
+        # COPY streams the rows straight into the file
+        where, params = user_filter_sql(flt)
+        query = _pg_query(f"SELECT {', '.join(USER_EXPORT_COLUMNS)} FROM users WHERE 1 = 1{where} ORDER BY user_id")
+        async with self.pg.pool.acquire() as conn:
+            status = await conn.copy_from_query(query, *params, output=path, format="csv", header=True)
+        return int(status.rsplit(" ", 1)[-1])
+
+class PostgresPairing(PairingRepository):
+    def __init__(self, pg: PostgresStorage):
+        self.pg = pg
+
+    def add(self, user_id, since):
+        self.pg.execute_nowait(
+            "INSERT INTO pairing (user_id, looking_since) VALUES (?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET looking_since = EXCLUDED.looking_since", user_id, since)
+
+    def remove(self, *user_ids):
+        self.pg.execute_nowait("DELETE FROM pairing WHERE user_id = ANY(?::bigint[])", list(user_ids))
+
+    async def load(self):
+        return [r[0] for r in await self.pg.fetch("SELECT user_id FROM pairing ORDER BY looking_since")]
+
+    async def stale(self, cutoff, limit):
+        rows = await self.pg.fetch("SELECT user_id FROM pairing WHERE looking_since < ? ORDER BY looking_since LIMIT ?",
+                                   cutoff, limit)
+        return [r[0] for r in rows]
+
+    async def clear(self):
+        await self.pg.execute("DELETE FROM pairing")
+
+class PostgresChats(ChatRepository):
+    def __init__(self, pg: PostgresStorage):
+        self.pg = pg
+
+    async def load(self):
+        return [tuple(r) for r in await self.pg.fetch("SELECT user_id, peer_id FROM chats")]
+
+    async def create(self, user1, user2):
+        await self.pg.execute(
+            "INSERT INTO chats (user_id, peer_id) VALUES (?, ?), (?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET peer_id = EXCLUDED.peer_id", user1, user2, user2, user1)
+
+    async def delete(self, user1, user2):
+        await self.pg.execute("DELETE FROM chats WHERE user_id IN (?, ?)", user1, user2)
+
+    async def abandoned(self, after, limit):
+        rows = await self.pg.fetch(
+            "SELECT c.user_id, c.peer_id FROM chats c "
+            "LEFT JOIN users u ON u.user_id = c.peer_id LEFT JOIN chats p ON p.user_id = c.peer_id "
+            "WHERE c.user_id > ? AND (u.user_id IS NULL OR u.banned = 1 OR u.blocked_bot = 1 "
+            "OR p.peer_id IS DISTINCT FROM c.user_id) ORDER BY c.user_id LIMIT ?", after, limit)
+        return [tuple(r) for r in rows]
+
+    async def delete_sides(self, sides):
+        users, peers = zip(*sides) if sides else ((), ())
+        await self.pg.execute("DELETE FROM chats WHERE (user_id, peer_id) IN "
+                              "(SELECT * FROM unnest(?::bigint[], ?::bigint[]))", list(users), list(peers))
+
+class PostgresComplaints(ComplaintRepository):
+    def __init__(self, pg: PostgresStorage):
+        self.pg = pg
+
+    async def create(self, complainer, target, reason, created_at):
+        async def record_complaint(conn):
+            await conn.execute(_pg_query("INSERT INTO complaints (complainer, target, reason, created_at) VALUES (?, ?, ?, ?)"),
+                               complainer, target, reason, created_at)
+            await conn.execute(_pg_query("UPDATE users SET reputation = reputation - 1 WHERE user_id = ?"), target)
+
+        await self.pg.transaction(record_complaint)
+
+class PostgresGames(GameRepository):
+    def __init__(self, pg: PostgresStorage):
+        self.pg = pg
+
+    async def record_result(self, game_type, player1, player2, winner, finished_at):
+        async def record_game(conn):
+            await conn.execute(_pg_query(
+                "INSERT INTO game_results (game_type, player1, player2, winner, finished_at) VALUES (?, ?, ?, ?, ?)"),
+                game_type, player1, player2, winner, finished_at)
+            if winner is not None:
+                await conn.execute(_pg_query("UPDATE users SET reputation = reputation + 1 WHERE user_id = ?"), winner)
+
+        await self.pg.transaction(record_game)
+
+async def _pg_settle_invoice(conn, invoice_id: str, include_expired: bool = False):
+    states = (INVOICE_PENDING, INVOICE_EXPIRED) if include_expired else (INVOICE_PENDING,)
+    row = await conn.fetchrow(_pg_query(
+        f"UPDATE invoices SET paid = {INVOICE_PAID} WHERE invoice_id = ? AND paid IN ({', '.join(map(str, states))}) "
+        "RETURNING user_id, amount"), invoice_id)
+    if row is None:
+        return None
+    await conn.execute(_pg_query("UPDATE users SET balance = balance + ? WHERE user_id = ?"), row[1], row[0])
+    return tuple(row)
+
+class PostgresInvoices(InvoiceRepository):
+    def __init__(self, pg: PostgresStorage):
+        self.pg = pg
+
+    async def create(self, invoice_id, user_id, amount, created_at, remote_id=None):
+        await self.pg.execute("INSERT INTO invoices (invoice_id, user_id, amount, created_at, paid, remote_id) VALUES (?, ?, ?, ?, 0, ?)",
+                              invoice_id, user_id, amount, created_at, remote_id)
+
+    async def get(self, invoice_id):
+        rows = await self.pg.fetch("SELECT paid, amount, user_id FROM invoices WHERE invoice_id = ?", invoice_id)
+        return tuple(rows[0]) if rows else None
+
+    async def settle(self, invoice_id, include_expired=False):
+        async def settle_invoice(conn):
+            return await _pg_settle_invoice(conn, invoice_id, include_expired)
+
+        return await self.pg.transaction(settle_invoice)
+
+    async def pending_remote(self, after, limit):
+        rows = await self.pg.fetch(
+            f"SELECT created_at, invoice_id, remote_id FROM invoices WHERE paid = {INVOICE_PENDING} "
+            "AND (created_at, invoice_id) > (?, ?) AND remote_id IS NOT NULL ORDER BY created_at, invoice_id LIMIT ?",
+            *after, limit)
+        return [tuple(r) for r in rows]
+
+    async def apply_remote(self, paid, expired):
+        async def apply_invoice_statuses(conn):
+            settled = []
+            for invoice_id in paid:
+                row = await _pg_settle_invoice(conn, invoice_id)
+                if row:
+                    settled.append(row)
+            await conn.executemany(_pg_query(
+                f"UPDATE invoices SET paid = {INVOICE_EXPIRED} WHERE invoice_id = ? AND paid = {INVOICE_PENDING}"),
+                [(invoice_id,) for invoice_id in expired])
+            return settled
+
+        return await self.pg.transaction(apply_invoice_statuses)
+
+    async def expire_older_than(self, cutoff):
+        return await self.pg.execute(
+            f"UPDATE invoices SET paid = {INVOICE_EXPIRED} WHERE paid = {INVOICE_PENDING} AND created_at < ?", cutoff)
+
+class PostgresBroadcasts(BroadcastRepository):
+    def __init__(self, pg: PostgresStorage):
+        self.pg = pg
+
+    async def create(self, admin_id, text, status_chat, status_message, created_at):
+        total = (await self.pg.fetch("SELECT COUNT(*) FROM users WHERE blocked_bot = 0"))[0][0]
+        rows = await self.pg.fetch(
+            "INSERT INTO broadcasts (admin_id, text, status_chat, status_message, total, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?) RETURNING id", admin_id, text, status_chat, status_message, total, created_at)
+        return Broadcast(rows[0][0], admin_id, text, status_chat, status_message, total)
+
+    async def unfinished(self):
+        rows = await self.pg.fetch(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE state = {BROADCAST_RUNNING} ORDER BY id")
+        return [Broadcast(*row) for row in rows]
+
+    async def recipients(self, after, limit):
+        rows = await self.pg.fetch("SELECT user_id FROM users WHERE user_id > ? AND blocked_bot = 0 ORDER BY user_id LIMIT ?",
+                                   after, limit)
+        return [r[0] for r in rows]
+
+    async def checkpoint(self, broadcast, blocked_users):
+        async def checkpoint_broadcast(conn):
+            if blocked_users:
+                await conn.execute(_pg_query("UPDATE users SET blocked_bot = 1 WHERE user_id = ANY(?::bigint[])"),
+                                   list(blocked_users))
+            status = await conn.execute(_pg_query(
+                f"UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, blocked = ? WHERE id = ? AND state = {BROADCAST_RUNNING}"),
+                broadcast.last_user_id, broadcast.sent, broadcast.failed, broadcast.blocked, broadcast.id)
+            return status != "UPDATE 0"
+
+        return await self.pg.transaction(checkpoint_broadcast)
+
+    async def finish(self, broadcast_id, state, finished_at):
+        return await self.pg.execute(
+            f"UPDATE broadcasts SET state = ?, finished_at = ? WHERE id = ? AND state = {BROADCAST_RUNNING}",
+            state, finished_at, broadcast_id) > 0
+
+def create_storage(backend: str):
+    if backend == "sqlite":
+        return SQLiteStorage()
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "postgres":
+        return PostgresStorage(POSTGRES_DSN)
+    raise ValueError(f"unknown STORAGE_BACKEND {backend!r} (sqlite, memory or postgres)")
+
+storage = create_storage(STORAGE_BACKEND)
+
+# ============================
+# === User state cache =======
+# ============================
+class UserStateCache:
+    """Write-through LRU cache of per-user values.
+
+    ``user_cache`` entries hold the flags checked on every update (``exists``,
+    ``banned``, ``muted_until``, ``vip_until``, ``blocked_bot``) and the ``reputation``
+    the search queue ranks by; ``profile_cards`` holds rendered texts.
+    Writers call ``update``/``invalidate`` after the DB write; a load that races with
+    such a write is not stored, so the cache never resurrects a stale value.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._loading = {}  # user_id -> number of loads in flight
+        self._stamps = {}   # user_id -> writes seen while a load was in flight
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: int):
+        state = self._data.get(user_id)
+        if state is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(user_id)
+        self.hits += 1
+        return state
+
+    def begin_load(self, user_id: int):
+        self._loading[user_id] = self._loading.get(user_id, 0) + 1
+        return self._stamps.get(user_id, 0)
+
+    def finish_load(self, user_id: int, stamp: int, state=None):
+        if state is not None and self._stamps.get(user_id, 0) == stamp and user_id not in self._data:
+            self._data[user_id] = state
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        left = self._loading[user_id] - 1
+        if left:
+            self._loading[user_id] = left
+        else:
+            del self._loading[user_id]
+            self._stamps.pop(user_id, None)
+
+    def _touched(self, user_id: int):
+        if user_id in self._loading:
+            self._stamps[user_id] = self._stamps.get(user_id, 0) + 1
+
+    def update(self, user_id: int, **fields):
+        self._touched(user_id)
+        state = self._data.get(user_id)
+        if state is not None:
+            state.update(fields)
+
+    def add(self, user_id: int, field: str, delta: int):
+        """Apply an increment the DB already made (the new value is not known here)."""
+        self._touched(user_id)
+        state = self._data.get(user_id)
+        if state is not None:
+            state[field] += delta
+
+    def invalidate(self, user_id: int):
+        self._touched(user_id)
+        self._data.pop(user_id, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+user_cache = UserStateCache(USER_CACHE_SIZE)
+
+def _user_state(row):
+    banned, muted_until, vip_until, reputation, blocked_bot = row or (0, None, None, 0, 0)
+    return {
+        "exists": row is not None,
+        "banned": banned or 0,
+        "muted_until": muted_until,
+        "vip_until": vip_until,
+        "reputation": reputation or 0,
+        "blocked_bot": blocked_bot or 0,
+    }
+
+async def get_user_state(user_id: int):
+    if shard_link is not None and not shard_link.owns(user_id):
+        # cached by the worker that owns the user; read through so its writes are never missed
+        return _user_state(await storage.users.get_state(user_id))
+    state = user_cache.get(user_id)
+    if state is not None:
+        return state
+    stamp = user_cache.begin_load(user_id)
+    try:
+        state = _user_state(await storage.users.get_state(user_id))
+    except Exception:
+        user_cache.finish_load(user_id, stamp)
+        raise
+    user_cache.finish_load(user_id, stamp, state)
+    return state
+
+# ============================
+# === Utility functions ======
+# ============================
+def now_ts():
+    """Current time as integer epoch seconds (the format of every time column)."""
+    return int(time.time())
+
+def fmt_ts(ts):
+    return datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d %H:%M UTC") if ts else "Нет"
+
+async def ensure_user(user: types.User):
+    # a cache hit for users seen recently, so the hot paths skip the profile upsert entirely
+    state = await get_user_state(user.id)
+    if not state["exists"]:
+        await storage.users.create(user.id, user.username or "", user.full_name, now_ts())
+        user_cache.update(user.id, exists=True)
+
+def is_admin(user_id: int):
+    return user_id in ADMIN_IDS
+
+async def is_banned(user_id: int):
+    state = await get_user_state(user_id)
+    return state["banned"] == 1
+
+async def is_muted(user_id: int):
+    state = await get_user_state(user_id)
+    return state["muted_until"] is not None and state["muted_until"] > now_ts()
+
+async def give_vip(user_id: int, days: int):
+    state = await get_user_state(user_id)
+    # extend a running VIP period, otherwise start from now
+    new_until = max(state["vip_until"] or 0, now_ts()) + days * 86400
+    await storage.users.set_vip_until(user_id, new_until)
+    user_event(user_id, "state", vip_until=new_until)
+    user_event(user_id, "profile")
+
+async def add_balance(user_id: int, amount: int):
+    await storage.users.add_balance(user_id, amount)
+    user_event(user_id, "profile")
+
+# Rendered profile texts. Same LRU / load-stamp logic as the user state cache; every
+# write to a displayed field (profile edit, reputation, balance, VIP) invalidates the card.
+profile_cards = UserStateCache(PROFILE_CACHE_SIZE)
+
+async def get_profile_text(user_id: int):
+    card = profile_cards.get(user_id)
+    if card is not None:
+        return card
+    stamp = profile_cards.begin_load(user_id)
+    try:
+        r = await storage.users.get_profile(user_id)
+    except Exception:
+        profile_cards.finish_load(user_id, stamp)
+        raise
+    if r is None:
+        profile_cards.finish_load(user_id, stamp)
+        return "Профиль не найден."
+    username, display_name, about, reputation, balance, vip_until = r
+    vip_text = fmt_ts(vip_until)
+    card = f"🔹 {display_name} (@{username})\n\n{about if about else '📝 Описание отсутствует'}\n\n⭐ Репутация: {reputation}\n💰 Баланс: {balance}\n👑 VIP до: {vip_text}"
+    profile_cards.finish_load(user_id, stamp, card)
+    return card
+
+# ============================
+# === Bot & Dispatcher =======
+# ============================
+if TELEGRAM_API_BASE:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE)))
+else:
+    bot = Bot(token=BOT_TOKEN)
+dp = Dispatcher()
+
+async def update_metrics_middleware(handler, event: types.Update, data):
+    """Outer middleware: update counts by type, latency / errors / DB calls by handler."""
+    stats = {"handler": "unhandled", "db_calls": 0}
+    token = current_update_stats.set(stats)
+    t0 = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        metrics.inc("bot_handler_errors_total", (("handler", stats["handler"]),))
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        current_update_stats.reset(token)
+        labels = (("handler", stats["handler"]),)
+        metrics.inc("bot_updates_total", (("type", event.event_type),))
+        metrics.observe("bot_handler_seconds", elapsed, labels)
+        metrics.observe("bot_db_calls_per_update", stats["db_calls"], labels, buckets=COUNT_BUCKETS)
+
+async def handler_name_middleware(handler, event, data):
+    stats = current_update_stats.get()
+    if stats is not None:
+        stats["handler"] = data["handler"].callback.__name__
+    return await handler(event, data)
+
+dp.update.outer_middleware(update_metrics_middleware)
+dp.message.middleware(handler_name_middleware)
+dp.callback_query.middleware(handler_name_middleware)
+
+# ============================
+# === Outbound scheduler =====
+# ============================
+PRIORITY_RELAY = 0   # chat messages between peers
+PRIORITY_NOTIFY = 1  # match found, game events, admin/user notifications
+PRIORITY_BULK = 2    # mass mailings
+
+class OutboxFull(Exception):
+    pass
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def reserve(self, now: float):
+        """Take one token (possibly borrowing) and return how long to wait before using it."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def penalize(self, seconds: float, now: float):
+        self.tokens = min(self.tokens, -seconds * self.rate)
+        self.stamp = now
+
+class _OutboundJob:
+    __slots__ = ("priority", "seq", "chat_id", "method", "args", "kwargs", "future", "reserved", "attempts")
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class OutboundScheduler:
+    """Single funnel for outbound Bot API calls.
+
+    Jobs are ordered by priority class, then FIFO. Each job must pass its chat's
+    token bucket and the global one; jobs for a throttled chat are parked in a
+    delayed heap instead of blocking other chats. TelegramRetryAfter pauses the
+    chat and requeues the job. Queues are bounded per priority; overflow is dropped
+    and counted, and so is whatever is still queued when ``stop`` gives up draining.
+    """
+
+    def __init__(self, global_rate: float = None):
+        global_rate = global_rate or OUTBOX_GLOBAL_RATE
+        self._ready = []
+        self._delayed = []   # (ready_at, seq, job)
+        self._buckets = {}
+        self._global = TokenBucket(global_rate, global_rate)
+        self._pending = [0, 0, 0]
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._sem = None
+        self._task = None
+        self._inflight = set()
+        self._last_prune = time.monotonic()
+        self.stats = {"sent": 0, "failed": 0, "retried": 0, "dropped": [0, 0, 0]}
+
+    def start(self):
+        if self._task is None:
+            self._sem = asyncio.Semaphore(OUTBOX_MAX_INFLIGHT)
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, drain: float = None):
+        """Keep sending queued jobs for up to ``drain`` seconds, then drop the rest.
+
+        Dropped jobs are counted like overflow; their ``submit`` futures fail with OutboxFull.
+        """
+        if self._task is None:
+            return
+        deadline = time.monotonic() + (OUTBOX_DRAIN_TIMEOUT if drain is None else drain)
+        # _pending covers ready, delayed and in-flight jobs
+        while any(self._pending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
             pass
+        self._task = None
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+        left = self._ready + [entry[2] for entry in self._delayed]  # includes RetryAfter requeues
+        self._ready, self._delayed = [], []
+        for job in left:
+            self._pending[job.priority] -= 1
+            self.stats["dropped"][job.priority] += 1
+            if job.future is not None and not job.future.done():
+                job.future.set_exception(OutboxFull("outbound queue stopped"))
+        if left:
+            logger.warning("Outbox stopped with %d unsent messages dropped.", len(left))
+
+    def metrics(self):
+        return {
+            "queued_relay": self._pending[PRIORITY_RELAY],
+            "queued_notify": self._pending[PRIORITY_NOTIFY],
+            "queued_bulk": self._pending[PRIORITY_BULK],
+            "delayed": len(self._delayed),
+            "inflight": len(self._inflight),
+            "sent": self.stats["sent"],
+            "failed": self.stats["failed"],
+            "retried": self.stats["retried"],
+            "dropped_relay": self.stats["dropped"][PRIORITY_RELAY],
+            "dropped_notify": self.stats["dropped"][PRIORITY_NOTIFY],
+            "dropped_bulk": self.stats["dropped"][PRIORITY_BULK],
+        }
+
+    def submit(self, priority: int, method, chat_id: int, *args, **kwargs):
+        """Queue ``method(chat_id, *args, **kwargs)``; returns a future with the API result."""
+        fut = asyncio.get_running_loop().create_future()
+        self._enqueue(priority, method, chat_id, args, kwargs, fut)
+        return fut
+
+    def post(self, priority: int, method, chat_id: int, *args, **kwargs):
+        """Fire-and-forget variant of ``submit``; failures only show up in the metrics."""
+        self._enqueue(priority, method, chat_id, args, kwargs, None)
+
+    def _enqueue(self, priority, method, chat_id, args, kwargs, fut):
+        if self._pending[priority] >= OUTBOX_QUEUE_LIMITS[priority]:
+            self.stats["dropped"][priority] += 1
+            if fut is not None:
+                fut.set_exception(OutboxFull(f"outbound queue {priority} is full"))
+            return
+        job = _OutboundJob()
+        self._seq += 1
+        job.priority, job.seq, job.chat_id = priority, self._seq, chat_id
+        job.method, job.args, job.kwargs, job.future = method, args, kwargs, fut
+        job.reserved, job.attempts = False, 0
+        self._pending[priority] += 1
+        heapq.heappush(self._ready, job)
+        self._wakeup.set()
+
+    def _bucket(self, chat_id: int):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+        return bucket
+
+    def _prune_buckets(self, now: float):
+        # a bucket idle long enough to be full again is equivalent to a fresh one
+        idle = OUTBOX_CHAT_BURST / OUTBOX_CHAT_RATE
+        for chat_id in [c for c, b in self._buckets.items() if now - b.stamp > idle]:
+            del self._buckets[chat_id]
+        self._last_prune = now
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                heapq.heappush(self._ready, heapq.heappop(self._delayed)[2])
+            if now - self._last_prune > 60:
+                self._prune_buckets(now)
+            if not self._ready:
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job = heapq.heappop(self._ready)
+            if job.future is not None and job.future.cancelled():
+                self._pending[job.priority] -= 1  # the caller gave up waiting (stopped broadcast)
+                continue
+            if not job.reserved:
+                wait = self._bucket(job.chat_id).reserve(now)
+                if wait > 0:
+                    job.reserved = True
+                    heapq.heappush(self._delayed, (now + wait, job.seq, job))
+                    continue
+            wait = self._global.reserve(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._sem.acquire()
+            task = asyncio.get_running_loop().create_task(self._send(job))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _send(self, job):
+        try:
+            result = await job.method(job.chat_id, *job.args, **job.kwargs)
+        except TelegramRetryAfter as e:
+            job.attempts += 1
+            if job.attempts <= OUTBOX_MAX_RETRIES:
+                self.stats["retried"] += 1
+                now = time.monotonic()
+                self._bucket(job.chat_id).penalize(e.retry_after, now)
+                job.reserved = True
+                heapq.heappush(self._delayed, (now + e.retry_after, job.seq, job))
+                self._wakeup.set()
+                return
+            self._finish(job, exc=e)
+        except Exception as e:
+            self._finish(job, exc=e)
+        else:
+            self._finish(job, result=result)
+        finally:
+            self._sem.release()
+
+    def _finish(self, job, result=None, exc=None):
+        self._pending[job.priority] -= 1
+        if exc is None:
+            self.stats["sent"] += 1
+        else:
+            self.stats["failed"] += 1
+            if job.future is None:
+                logger.debug("Outbound %s to %s failed: %s", getattr(job.method, "__name__", job.method), job.chat_id, exc)
+        if job.future is not None and not job.future.done():
+            if exc is None:
+                job.future.set_result(result)
+            else:
+                job.future.set_exception(exc)
+
+outbox = OutboundScheduler()
+
+# ============================
+# === Flood control ==========
+# ============================
+class _FloodState:
+    __slots__ = ("buckets", "strikes", "strikes_since", "mutes", "muted_until", "seen")
+
+    def __init__(self, now: float):
+        self.buckets = {}
+        self.strikes = 0
+        self.strikes_since = now
+        self.mutes = 0
+        self.muted_until = 0.0
+        self.seen = now
+
+class FloodControl:
+    """Per-user token buckets by update type.
+
+    ``admit`` says how long an update must wait (None: drop it). Dropped updates are
+    strikes; ``strike`` returns the mute length once a user collects FLOOD_STRIKES of
+    them inside FLOOD_STRIKE_WINDOW, stepping through FLOOD_MUTE_STEPS each time the
+    user floods again after a mute ran out.
+    Only touched from the event loop thread.
+    """
+
+    def __init__(self):
+        self._users = {}
+        self._last_prune = time.monotonic()
+
+    def __len__(self):
+        return len(self._users)
+
+    def admit(self, user_id: int, update_type: str, now: float):
+        if now - self._last_prune > 60:
+            self._prune(now)
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = _FloodState(now)
+        state.seen = now
+        bucket = state.buckets.get(update_type)
+        if bucket is None:
+            rate, burst = FLOOD_LIMITS.get(update_type, FLOOD_DEFAULT_LIMIT)
+            bucket = state.buckets[update_type] = TokenBucket(rate, burst)
+        wait = bucket.reserve(now)
+        if wait > FLOOD_MAX_DELAY:
+            bucket.tokens += 1  # dropped updates do not use up the allowance
+            return None
+        return wait
+
+    def strike(self, user_id: int, now: float):
+        state = self._users[user_id]
+        if now < state.muted_until:
+            return 0
+        if now - state.strikes_since > FLOOD_STRIKE_WINDOW:
+            state.strikes, state.strikes_since = 0, now
+        state.strikes += 1
+        if state.strikes < FLOOD_STRIKES:
+            return 0
+        state.strikes, state.strikes_since = 0, now
+        state.mutes += 1
+        seconds = FLOOD_MUTE_STEPS[min(state.mutes, len(FLOOD_MUTE_STEPS)) - 1]
+        state.muted_until = now + seconds
+        return seconds
+
+    def _prune(self, now: float):
+        for user_id in [u for u, st in self._users.items() if now - st.seen > FLOOD_IDLE_TTL]:
+            del self._users[user_id]
+        self._last_prune = now
+
+flood = FloodControl()
+
+async def flood_mute(user_id: int, seconds: int):
+    until = now_ts() + seconds
+    state = await get_user_state(user_id)
+    if state["muted_until"] is not None and state["muted_until"] >= until:
+        return  # already muted for longer (e.g. by an admin)
+    await storage.users.set_muted_until(user_id, until)
+    user_event(user_id, "state", muted_until=until)
+    metrics.inc("bot_flood_mutes_total")
+    logger.info("Flood control muted %s for %ss", user_id, seconds)
+    outbox.post(PRIORITY_NOTIFY, bot.send_message, user_id,
+                f"Слишком много действий подряд. Вы временно заблокированы на {max(1, seconds // 60)} мин.")
+
+async def flood_control_middleware(handler, event: types.Update, data):
+    """Outer middleware: throttle each user before any handler (and DB access) runs."""
+    user = data.get("event_from_user")
+    if user is None or is_admin(user.id):
+        return await handler(event, data)
+    now = time.monotonic()
+    wait = flood.admit(user.id, event.event_type, now)
+    if wait is None:
+        metrics.inc("bot_flood_dropped_total", (("type", event.event_type),))
+        seconds = flood.strike(user.id, now)
+        if seconds:
+            await flood_mute(user.id, seconds)
+        return None
+    if wait > 0:
+        metrics.inc("bot_flood_delayed_total", (("type", event.event_type),))
+        await asyncio.sleep(wait)
+    return await handler(event, data)
+
+# after the metrics middleware, so shed updates are still counted; in sharded mode this
+# runs in the worker owning the user, which keeps the front's hand-off loop from sleeping
+if FLOOD_CONTROL:
+    dp.update.outer_middleware(flood_control_middleware)
+
+# ============================
+# === Callback routing =======
+# ============================
+# callback_data is "<prefix>" or "<prefix>:<payload>". Payload types pack themselves
+# into a compact string (binary + base64url where it pays off) to stay well under
+# Telegram's 64-byte callback_data limit, and are decoded once before the handler runs.
+CALLBACK_DATA_LIMIT = 64
+
+def _b64(raw: bytes):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+def _unb64(text: str):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+class Donation(NamedTuple):
+    amount: int
+
+    def pack(self):
+        return str(self.amount)
+
+    @classmethod
+    def unpack(cls, text: str):
+        return cls(int(text))
+
+class InvoiceRef(NamedTuple):
+    invoice_id: str  # local invoice ids are hex (secrets.token_hex)
+
+    def pack(self):
+        return _b64(bytes.fromhex(self.invoice_id))
+
+    @classmethod
+    def unpack(cls, text: str):
+        return cls(_unb64(text).hex())
+
+COMPLAINT_REASONS = ("insult", "spam", "other")
+
+class ComplaintTarget(NamedTuple):
+    target: int
+    reason: str
+
+    def pack(self):
+        return _b64(struct.pack(">qB", self.target, COMPLAINT_REASONS.index(self.reason)))
+
+    @classmethod
+    def unpack(cls, text: str):
+        target, reason = struct.unpack(">qB", _unb64(text))
+        return cls(target, COMPLAINT_REASONS[reason])
+
+class UserPage(NamedTuple):
+    cursor: int
+    code: str  # admin user filter, see parse_user_filter
+
+    def pack(self):
+        return f"{self.cursor}:{self.code}"
+
+    @classmethod
+    def unpack(cls, text: str):
+        cursor, _, code = text.partition(":")
+        return cls(int(cursor), code)
+
+def cb_data(prefix: str, payload=None):
+    data = prefix if payload is None else f"{prefix}:{payload.pack()}"
+    if len(data.encode()) > CALLBACK_DATA_LIMIT:
+        raise ValueError(f"callback_data too long: {data!r}")
+    return data
+
+class CallbackRouter:
+    """Routes callback queries by prefix with one dict lookup.
+
+    ``route(prefix, payload_type)`` registers ``handler(query)``, or
+    ``handler(query, payload)`` when a payload type is given.
+    """
+
+    def __init__(self):
+        self.routes = {}
+
+    def route(self, prefix: str, payload_type=None):
+        def register(handler):
+            if prefix in self.routes:
+                raise ValueError(f"callback prefix {prefix!r} is already routed")
+            self.routes[prefix] = (handler, payload_type)
+            return handler
+        return register
+
+    async def dispatch(self, query: types.CallbackQuery):
+        prefix, _, raw = (query.data or "").partition(":")
+        route = self.routes.get(prefix)
+        if route is None:
+            # e.g. buttons on messages sent by an older version of the bot
+            await query.answer("Кнопка устарела. Откройте меню заново.")
+            return
+        handler, payload_type = route
+        stats = current_update_stats.get()
+        if stats is not None:
+            stats["handler"] = handler.__name__
+        if payload_type is None:
+            return await handler(query)
+        try:
+            payload = payload_type.unpack(raw)
+        except (ValueError, IndexError, struct.error):
+            logger.debug("Malformed callback payload %r", query.data)
+            await query.answer("Кнопка устарела. Откройте меню заново.")
+            return
+        return await handler(query, payload)
+
+callbacks = CallbackRouter()
+
+@dp.callback_query()
+async def route_callback(query: types.CallbackQuery):
+    await callbacks.dispatch(query)
+
+# Inline keyboards. Static ones are built once: aiogram types are frozen pydantic models,
+# so the same instance can be reused for every reply.
+def keyboard(*rows):
+    """Build a markup from rows of (text, callback_data) pairs."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=text, callback_data=data) for text, data in row] for row in rows
+    ])
+
+BACK_MAIN = ("◀️ Назад", "back_main")
+MAIN_KB = keyboard(
+    [("🔎 Найти собеседника", "find")],
+    [("👤 Мой профиль", "profile"), ("💰 Баланс / Донат", "balance")],
+    [("🎮 Игры", "games")],
+)
+INCHAT_KB = keyboard(
+    [("🔓 Раскрыть личность", "reveal")],
+    [("✋ Отключиться", "stop")],
+    [("⚠️ Пожаловаться", "complain")],
+)
+SEARCH_KB = keyboard([("Отменить поиск", "cancel_search")], [BACK_MAIN])
+PROFILE_KB = keyboard([("✏️ Редактировать анкету", "edit_profile")], [BACK_MAIN])
+BALANCE_KB = keyboard(
+    [("Пополнить 50", cb_data("d", Donation(50))), ("Пополнить 100", cb_data("d", Donation(100)))],
+    [BACK_MAIN],
+)
+GAMES_KB = keyboard(
+    [("Камень-Ножницы-Бумага (1v1)", "game_rps")],
+    [("Угадай число (1v1)", "game_guess")],
+    [BACK_MAIN],
+)
+RPS_KB = keyboard([("Найти соперника RPS", "find_rps")], [("◀️ Назад", "games")])
+GUESS_KB = keyboard([("Найти соперника Guess", "find_guess")], [("◀️ Назад", "games")])
+
+# ============================
+# === Chat relay fast path ===
+# ============================
+class AlbumRelay:
+    """Buffers album items per sender chat and relays each album with one copyMessages call.
+
+    An album reaches the bot as separate updates a few ms apart, possibly handled out
+    of order. Items wait until ALBUM_WINDOW passes without a new one (or the album is
+    full), then go out sorted by message id, so the peer gets one grouped album and
+    the chat's outbound rate is spent once instead of per item.
+    """
+
+    def __init__(self):
+        self._pending = {}  # chat_id -> [media_group_id, peer, message ids, timer, first message]
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, msg: types.Message, peer: int):
+        chat_id = msg.chat.id
+        entry = self._pending.get(chat_id)
+        if entry is not None and (entry[0] != msg.media_group_id or entry[1] != peer):
+            self.flush(chat_id)
+            entry = None
+        if entry is None:
+            entry = self._pending[chat_id] = [msg.media_group_id, peer, [], None, msg]
+        else:
+            entry[3].cancel()
+        entry[2].append(msg.message_id)
+        if len(entry[2]) >= ALBUM_MAX_ITEMS:
+            self.flush(chat_id)
+        else:
+            entry[3] = asyncio.get_running_loop().call_later(ALBUM_WINDOW, self.flush, chat_id)
+
+    def flush(self, chat_id: int):
+        """Queue the chat's pending album (if any) for sending right now."""
+        entry = self._pending.pop(chat_id, None)
+        if entry is None:
+            return
+        _, peer, message_ids, timer, first = entry
+        if timer is not None:
+            timer.cancel()
+        metrics.inc("bot_albums_relayed_total")
+        metrics.inc("bot_album_items_total", value=len(message_ids))
+        fut = outbox.submit(PRIORITY_RELAY, bot.copy_messages, peer, chat_id, sorted(message_ids))
+        fut.add_done_callback(lambda f: self._sent(f, first))
+
+    def flush_all(self):
+        for chat_id in list(self._pending):
+            self.flush(chat_id)
+
+    @staticmethod
+    def _sent(fut, first: types.Message):
+        if fut.cancelled():  # nothing to report, and fut.exception() would raise CancelledError
+            return
+        exc = fut.exception()
+        if isinstance(exc, TelegramBadRequest):
+            outbox.post(PRIORITY_NOTIFY, bot.send_message, first.chat.id, "Этот тип сообщений пока не поддерживается.",
+                        reply_to_message_id=first.message_id)
+        elif isinstance(exc, OutboxFull):
+            outbox.post(PRIORITY_NOTIFY, bot.send_message, first.chat.id, "Собеседник сейчас перегружен, сообщение не доставлено. Попробуйте ещё раз.",
+                        reply_to_message_id=first.message_id)
+        elif exc is not None:
+            logger.warning("Album relay from %s failed: %s", first.chat.id, exc)
+
+albums = AlbumRelay()
+
+async def relay_to_peer(msg: types.Message, peer: int):
+    if msg.media_group_id:
+        albums.add(msg, peer)
+        return
+    # an album still being collected was sent before this message; keep that order
+    albums.flush(msg.chat.id)
+    # copy_message covers every content type (text, media, polls...) in one call
+    try:
+        await outbox.submit(PRIORITY_RELAY, bot.copy_message, peer, msg.chat.id, msg.message_id)
+    except TelegramBadRequest:
+        await msg.reply("Этот тип сообщений пока не поддерживается.")
+    except OutboxFull:
+        # the relay queue is at its limit; the notice goes through the separate notify queue
+        outbox.post(PRIORITY_NOTIFY, bot.send_message, msg.chat.id, "Собеседник сейчас перегружен, сообщение не доставлено. Попробуйте ещё раз.",
+                    reply_to_message_id=msg.message_id)
+
+def in_active_chat(msg: types.Message):
+    # commands keep going through the regular handlers below, and a running game gets its
+    # moves even if the player is also in a chat
+    if msg.from_user is None or (msg.text or "").startswith("/"):
+        return False
+    uid = msg.from_user.id
+    return uid in active_chats and uid not in games.sessions and uid not in remote_games
+
+# Registered before every other message handler: ~95% of traffic is chat relay and
+# it needs no DB access for users whose state is in user_cache.
+@dp.message(in_active_chat)
+async def relay_message(msg: types.Message):
+    uid = msg.from_user.id
+    peer = active_chats.get(uid)
+    if peer is None:
+        return
+    await ensure_user(msg.from_user)
+    if await is_muted(uid):
+        await msg.reply("Вы временно заблокированы и не можете отправлять сообщения.")
+        return
+    await relay_to_peer(msg, peer)
+
+# ============================
+# === Payments (Crypto Pay) ==
+# ============================
+class CryptoPayError(Exception):
+    pass
+
+class CryptoPayClient:
+    """Minimal async client for the Crypto Pay API (createInvoice / getInvoices)."""
+
+    def __init__(self, token: str, base_url: str):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self._session = None
+
+    async def _call(self, method: str, **params):
+        if self._session is None:
+            self._session = ClientSession(timeout=ClientTimeout(total=15),
+                                          headers={"Crypto-Pay-API-Token": self.token})
+        try:
+            async with self._session.post(f"{self.base_url}/{method}", json=params) as resp:
+                data = await resp.json(content_type=None)
+        except Exception as e:
+            raise CryptoPayError(f"{method}: {e}") from e
+        if not data.get("ok"):
+            raise CryptoPayError(f"{method}: {data.get('error')}")
+        return data["result"]
+
+    async def create_invoice(self, amount: int, payload: str):
+        return await self._call("createInvoice", asset=CRYPTO_PAY_ASSET, amount=str(amount),
+                                payload=payload, expires_in=INVOICE_TTL)
+
+    async def get_invoices(self, invoice_ids):
+        """Statuses of the given Crypto Pay invoices: {invoice_id: status}."""
+        result = await self._call("getInvoices", invoice_ids=",".join(map(str, invoice_ids)),
+                                  count=len(invoice_ids))
+        return {item["invoice_id"]: item["status"] for item in result.get("items", [])}
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+crypto_pay = CryptoPayClient(CRYPTO_PAY_TOKEN, CRYPTO_PAY_API) if CRYPTO_PAY_TOKEN else None
+
+def notify_settled(settled):
+    for user_id, amount in settled:
+        user_event(user_id, "profile")
+        outbox.post(PRIORITY_NOTIFY, bot.send_message, user_id, f"Ваш платёж на {amount} зачислен на баланс.")
+
+async def sync_invoices_with_crypto_pay():
+    """Ask Crypto Pay about every pending invoice, in batches; settle paid ones and
+    expire the ones Crypto Pay expired. Returns (settled, expired) counts."""
+    settled_total, expired_total = 0, 0
+    cursor = (-1, "")
+    while True:
+        rows = await storage.invoices.pending_remote(cursor, INVOICE_POLL_BATCH)
+        if not rows:
+            break
+        cursor = rows[-1][:2]
+        statuses = await crypto_pay.get_invoices([remote_id for _, _, remote_id in rows])
+        paid = [invoice_id for _, invoice_id, remote_id in rows if statuses.get(remote_id) == "paid"]
+        gone = [invoice_id for _, invoice_id, remote_id in rows if statuses.get(remote_id) == "expired"]
+        if not paid and not gone:
+            continue
+        settled = await storage.invoices.apply_remote(paid, gone)
+        notify_settled(settled)
+        settled_total += len(settled)
+        expired_total += len(gone)
+    return settled_total, expired_total
+
+async def invoice_settler():
+    while True:
+        await asyncio.sleep(INVOICE_POLL_INTERVAL)
+        try:
+            settled, expired = (0, 0)
+            if crypto_pay is not None:
+                settled, expired = await sync_invoices_with_crypto_pay()
+            # only after the remote check, so an invoice paid right before its TTL still counts
+            expired += await storage.invoices.expire_older_than(now_ts() - INVOICE_TTL)
+        except Exception:
+            logger.exception("Invoice settlement pass failed")
+            continue
+        if settled or expired:
+            logger.info("Invoices: settled %d, expired %d.", settled, expired)
+
+# ============================
+# === Command handlers =======
+# ============================
+@dp.message(Command("start"))
+async def cmd_start(msg: types.Message):
+    await ensure_user(msg.from_user)
+    if await is_banned(msg.from_user.id):
+        await msg.answer("Вы заблокированы.")
+        return
+    # whoever blocked the bot and came back gets broadcasts again; the flag is cached, so
+    # the usual /start costs no write
+    if (await get_user_state(msg.from_user.id))["blocked_bot"]:
+        await storage.users.set_blocked_bot(msg.from_user.id, False)
+        user_event(msg.from_user.id, "state", blocked_bot=0)
+    await msg.answer(
+        "Привет! Это анонимный чат. Нажми кнопку чтобы найти собеседника.",
+        reply_markup=MAIN_KB
+    )
+
+@callbacks.route("profile")
+async def cb_profile(query: types.CallbackQuery):
+    await ensure_user(query.from_user)
+    text = await get_profile_text(query.from_user.id)
+    await query.message.edit_text(text, reply_markup=PROFILE_KB)
+
+@callbacks.route("edit_profile")
+async def cb_edit_profile(query: types.CallbackQuery):
+    await query.answer("Отправьте: /profile_edit Имя|О себе", show_alert=True)
+
+@callbacks.route("back_main")
+async def cb_back(query: types.CallbackQuery):
+    await query.message.edit_text("Главное меню", reply_markup=MAIN_KB)
+
+@callbacks.route("balance")
+async def cb_balance(query: types.CallbackQuery):
+    await ensure_user(query.from_user)
+    bal = await storage.users.get_balance(query.from_user.id) or 0
+    text = f"💰 Ваш баланс: {bal}\nВы можете пополнить баланс кнопкой ниже."
+    await query.message.edit_text(text, reply_markup=BALANCE_KB)
+
+# Donation flow: create a local invoice and provide a deep link to @CryptoBot
+@callbacks.route("d", Donation)
+async def cb_donate(query: types.CallbackQuery, donation: Donation):
+    await ensure_user(query.from_user)
+    amount = donation.amount
+    invoice_id = secrets.token_hex(12)
+    created = now_ts()
+    remote_id = None
+    link = CRYPTO_DEEP_LINK_BASE + invoice_id
+    if crypto_pay is not None:
+        try:
+            remote = await crypto_pay.create_invoice(amount, payload=invoice_id)
+        except CryptoPayError as e:
+            logger.warning("Crypto Pay createInvoice failed: %s", e)
+            await query.answer("Платёжный сервис временно недоступен. Попробуйте позже.", show_alert=True)
+            return
+        remote_id = remote["invoice_id"]
+        link = remote.get("bot_invoice_url") or remote.get("pay_url") or link
+    await storage.invoices.create(invoice_id, query.from_user.id, amount, created, remote_id)
+    text = f"Оплатите {amount} условных единиц через CryptoBot по ссылке ниже.\nПосле оплаты нажмите 'Проверить оплату'."
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Оплатить через CryptoBot", url=link)],
+        [InlineKeyboardButton(text="Проверить оплату", callback_data=cb_data("cp", InvoiceRef(invoice_id)))],
+        [InlineKeyboardButton(text="◀️ Назад", callback_data="back_main")]
+    ])
+    await query.message.edit_text(text, reply_markup=kb)
+
+# Check payment: with CRYPTO_PAY_TOKEN set, invoice_settler marks paid invoices on its own;
+# otherwise an admin marks them paid by hand.
+@callbacks.route("cp", InvoiceRef)
+async def cb_checkpay(query: types.CallbackQuery, ref: InvoiceRef):
+    invoice_id = ref.invoice_id
+    r = await storage.invoices.get(invoice_id)
+    if r is None:
+        await query.answer("Счёт не найден.", show_alert=True)
+        return
+    paid, amount, user_id = r
+    if paid == INVOICE_PAID:
+        await query.message.edit_text(f"Счёт {invoice_id} уже оплачен. Пополнено {amount}.")
+        return
+    if paid == INVOICE_EXPIRED and not is_admin(query.from_user.id):
+        await query.message.edit_text("Срок действия счёта истёк. Создайте новый.", reply_markup=BALANCE_KB)
+        return
+    if crypto_pay is not None and not is_admin(query.from_user.id):
+        await query.answer("Оплата ещё не поступила. Баланс пополнится автоматически в течение минуты после оплаты.",
+                           show_alert=True)
+        return
+    # Not paid — instruct user/admin how to mark as paid.
+    if is_admin(query.from_user.id):
+        # Admin can mark invoice paid
+        kb = keyboard([("Отметить как оплачен", cb_data("mp", InvoiceRef(invoice_id)))], [BACK_MAIN])
+        await query.message.edit_text(f"Счёт {invoice_id} не оплачен. Сумма: {amount}", reply_markup=kb)
+    else:
+        await query.answer("Счёт не оплачен. Попросите администратора подтвердить платеж.", show_alert=True)
+
+@callbacks.route("mp", InvoiceRef)
+async def cb_markpaid(query: types.CallbackQuery, ref: InvoiceRef):
+    if not is_admin(query.from_user.id):
+        await query.answer("Только администратор.", show_alert=True)
+        return
+    invoice_id = ref.invoice_id
+    # an admin's confirmation also overrides the TTL expiry
+    settled = await storage.invoices.settle(invoice_id, include_expired=True)
+    if settled is None:
+        existing = await storage.invoices.get(invoice_id)
+        await query.answer("Уже оплачен." if existing else "Счёт не найден.", show_alert=True)
+        return
+    user_id, amount = settled
+    await query.message.edit_text(f"Отмечено как оплаченное. Пользователю {user_id} начислено {amount}.")
+    notify_settled([settled])
+
+# ============================
+# === Pairing & chat logic ===
+# ============================
+class MatchPolicy(NamedTuple):
+    """How the chat search queue ranks and filters candidates."""
+    vip_first: bool
+    band: int = 0             # reputation points per band; 0 puts everyone in one band
+    widen_seconds: float = 0  # waiting this long accepts one more band on each side (0: never)
+    vip_widen: float = 1      # VIPs widen this many times faster
+
+MATCH_POLICIES = {
+    "fifo": MatchPolicy(False),
+    "vip": MatchPolicy(True),
+    "bands": MatchPolicy(True, MATCH_REP_BAND, MATCH_WIDEN_SECONDS, MATCH_VIP_WIDEN),
+}
+
+class Searcher(NamedTuple):
+    ticket: int
+    rank: int       # 0 for VIPs when the policy prefers them, else 1
+    band: int
+    since: float    # monotonic time the search started
+
+class MatchmakingQueue:
+    """In-memory chat search queue; join and match are O(log n) (amortized).
+
+    Searchers are bucketed by reputation band. Each bucket is a heap ordered by
+    (rank, ticket), so VIPs come first and then the longest waiting; ``_bands`` keeps
+    the non-empty band numbers sorted, so nearby bands are found by bisection. A
+    searcher accepts bands up to ``reach`` away, and the reach grows with the time
+    spent waiting; two searchers match once either one's reach covers the distance
+    between their bands, and ``sweep`` pairs waiting searchers as their reaches grow.
+    Leaving only drops the ``_members`` entry; stale heap entries are skipped lazily.
+    """
+
+    def __init__(self, policy: MatchPolicy = None):
+        if policy is None:
+            if MATCH_POLICY not in MATCH_POLICIES:
+                raise ValueError(f"unknown MATCH_POLICY {MATCH_POLICY!r} ({', '.join(MATCH_POLICIES)})")
+            policy = MATCH_POLICIES[MATCH_POLICY]
+        self.policy = policy
+        self._members = {}          # user_id -> Searcher
+        self._buckets = {}          # band -> heap of (rank, ticket, user_id)
+        self._bands = []            # sorted bands that have a bucket
+        self._arrivals = deque()    # (ticket, user_id) in arrival order
+        self._stale = 0             # heap entries of users no longer searching
+        self._next_ticket = 0
+        self.lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, user_id):
+        return user_id in self._members
+
+    def _band(self, reputation: int):
+        return reputation // self.policy.band if self.policy.band else 0
+
+    def _reach(self, searcher: Searcher, now: float):
+        if not self.policy.widen_seconds:
+            return 0
+        speed = self.policy.vip_widen if searcher.rank == 0 else 1
+        return int((now - searcher.since) * speed / self.policy.widen_seconds)
+
+    def _live(self, user_id: int, ticket: int):
+        searcher = self._members.get(user_id)
+        return searcher is not None and searcher.ticket == ticket
+
+    def add(self, user_id: int, vip: bool = False, reputation: int = 0, now: float = None):
+        if user_id in self._members:
+            return False
+        self._next_ticket += 1
+        rank = 0 if vip and self.policy.vip_first else 1
+        searcher = Searcher(self._next_ticket, rank, self._band(reputation),
+                            time.monotonic() if now is None else now)
+        self._members[user_id] = searcher
+        bucket = self._buckets.get(searcher.band)
+        if bucket is None:
+            bucket = self._buckets[searcher.band] = []
+            bisect.insort(self._bands, searcher.band)
+        heapq.heappush(bucket, (rank, searcher.ticket, user_id))
+        self._arrivals.append((searcher.ticket, user_id))
+        return True
+
+    def remove(self, user_id: int):
+        if self._members.pop(user_id, None) is None:
+            return False
+        self._drop()
+        return True
+
+    def _drop(self):
+        """Count one more stale entry; rebuild the index once they outnumber live ones."""
+        self._stale += 1
+        if self._stale > len(self._members) + 1024:
+            live = sorted(self._members.items(), key=lambda item: item[1].ticket)
+            buckets = defaultdict(list)
+            for user_id, searcher in live:
+                buckets[searcher.band].append((searcher.rank, searcher.ticket, user_id))
+            for bucket in buckets.values():
+                heapq.heapify(bucket)
+            self._buckets = dict(buckets)
+            self._bands = sorted(self._buckets)
+            self._arrivals = deque((searcher.ticket, user_id) for user_id, searcher in live)
+            self._stale = 0
+
+    def waiting_since(self, before: float, limit: int):
+        """Up to ``limit`` searchers who joined before ``before``, longest waiting first."""
+        found = []
+        for ticket, user_id in self._arrivals:
+            if not self._live(user_id, ticket):
+                continue
+            if len(found) == limit or self._members[user_id].since >= before:
+                break
+            found.append(user_id)
+        return found
+
+    def _oldest(self):
+        while self._arrivals and not self._live(self._arrivals[0][1], self._arrivals[0][0]):
+            self._arrivals.popleft()
+        return self._members[self._arrivals[0][1]] if self._arrivals else None
+
+    def _head(self, band: int, exclude: int):
+        """Best live searcher of ``band`` other than ``exclude``, as (rank, ticket, user_id)."""
+        bucket = self._buckets[band]
+        skipped = None
+        while bucket:
+            rank, ticket, uid = bucket[0]
+            if not self._live(uid, ticket):
+                heapq.heappop(bucket)
+            elif uid == exclude and skipped is None:
+                skipped = heapq.heappop(bucket)
+            else:
+                break
+        head = bucket[0] if bucket and bucket[0][2] != exclude else None
+        if skipped is not None:
+            heapq.heappush(bucket, skipped)
+        if not bucket:
+            del self._buckets[band]
+            self._bands.pop(bisect.bisect_left(self._bands, band))
+        return head
+
+    def pop_partner(self, user_id: int, vip: bool = False, reputation: int = 0, now: float = None):
+        """Take the best searcher within reach of ``user_id``, or None.
+
+        A pair is accepted when the band distance fits the wider of the two reaches, so a
+        newcomer (reach 0) can still take a long waiter whose band has widened to it.
+        A user already in the queue is matched with their queued band and waiting time.
+        """
+        now = time.monotonic() if now is None else now
+        own = self._members.get(user_id)
+        band = own.band if own else self._band(reputation)
+        reach = self._reach(own, now) if own else 0
+        oldest = self._oldest()
+        if oldest is None:
+            return None
+        # nobody reaches further than the longest-waiting searcher would as a VIP
+        limit = max(reach, self._reach(oldest._replace(rank=0), now))
+        best = None
+        lo = bisect.bisect_left(self._bands, band - limit)
+        hi = bisect.bisect_right(self._bands, band + limit)
+        for candidate_band in self._bands[lo:hi]:
+            head = self._head(candidate_band, user_id)
+            if head is None:
+                continue
+            distance = abs(candidate_band - band)
+            if distance > max(reach, self._reach(self._members[head[2]], now)):
+                continue
+            key = (head[0], distance, head[1])
+            if best is None or key < best[0]:
+                best = (key, head[2])
+        if best is None:
+            return None
+        del self._members[best[1]]
+        self._drop()
+        return best[1]
+
+    def sweep(self, now: float = None):
+        """Pair waiting searchers now within reach of one another (see pop_partner); returns the pairs."""
+        now = time.monotonic() if now is None else now
+        pairs = []
+        waiting = sorted(self._members.items(), key=lambda item: (item[1].rank, item[1].ticket))
+        for user_id, searcher in waiting:
+            if self._members.get(user_id) is not searcher:
+                continue  # paired earlier in this sweep
+            partner = self.pop_partner(user_id, now=now)
+            if partner is not None:
+                del self._members[user_id]
+                self._drop()
+                pairs.append((user_id, partner))
+        return pairs
+
+matchmaker = MatchmakingQueue()
+
+# Search arrivals and cancellations as JSON lines, replayable with tools/matchsim.py
+match_trace = logging.getLogger(__name__ + ".match_trace")
+match_trace.propagate = False
+if MATCH_TRACE_FILE:
+    match_trace.setLevel(logging.INFO)
+    match_trace.addHandler(logging.FileHandler(MATCH_TRACE_FILE))
+
+def trace_search(event: str, user_id: int, **fields):
+    if match_trace.handlers:
+        match_trace.info(json.dumps({"t": round(time.time(), 3), "event": event, "user": user_id, **fields}))
+
+async def search_profile(user_id: int):
+    """(vip, reputation) the chat search queue ranks ``user_id`` by."""
+    state = await get_user_state(user_id)
+    vip = bool(state["vip_until"] and state["vip_until"] > now_ts())
+    return vip, state["reputation"] if matchmaker.policy.band else 0
+
+async def queue_add(user_id: int, vip: bool = False, reputation: int = 0):
+    if matchmaker.add(user_id, vip, reputation) and PAIRING_DURABLE_LOG:
+        storage.pairing.add(user_id, now_ts())
+
+async def queue_remove(user_id: int):
+    if matchmaker.remove(user_id):
+        trace_search("leave", user_id)
+        if PAIRING_DURABLE_LOG:
+            storage.pairing.remove(user_id)
+
+async def queue_match(user_id: int, vip: bool = False, reputation: int = 0):
+    """Atomically pair ``user_id`` with the best waiting searcher, or enqueue them.
+
+    Returns the partner id, or None if the user is now waiting in the queue.
+    """
+    trace_search("search", user_id, vip=vip, rep=reputation)
+    async with matchmaker.lock:
+        partner = matchmaker.pop_partner(user_id, vip, reputation)
+        if partner is None:
+            await queue_add(user_id, vip, reputation)
+            return None
+        matchmaker.remove(user_id)
+    if PAIRING_DURABLE_LOG:
+        storage.pairing.remove(user_id, partner)
+    return partner
+
+async def search_sweeper():
+    """Pair searchers whose reputation bands have widened enough to accept each other."""
+    while True:
+        await asyncio.sleep(MATCH_SWEEP_INTERVAL)
+        async with matchmaker.lock:
+            pairs = matchmaker.sweep()
+        for user1, user2 in pairs:
+            if PAIRING_DURABLE_LOG:
+                storage.pairing.remove(user1, user2)
+            await open_chat(user1, user2)
+        if pairs:
+            logger.debug("Search sweep paired %d chats.", len(pairs))
+
+def start_search_sweeper():
+    if matchmaker.policy.band and matchmaker.policy.widen_seconds:
+        start_background(search_sweeper(), "search-sweeper")
+
+async def load_pairing_queue():
+    """Restore the search queue from the durability log after a restart."""
+    if not PAIRING_DURABLE_LOG:
+        await storage.pairing.clear()
+        return
+    rows = await storage.pairing.load()
+    for user_id in rows:
+        matchmaker.add(user_id, *await search_profile(user_id))
+    if rows:
+        logger.info("Restored %d users into the search queue.", len(rows))
+
+# Active chats, user_id -> peer_id. Authoritative in memory; storage.chats is the
+# persistent copy and is only read at startup.
+active_chats = {}
+
+async def load_active_chats():
+    rows = await storage.chats.load()
+    if shard_link is not None:
+        rows = [row for row in rows if shard_link.owns(row[0])]
+    active_chats.clear()
+    active_chats.update(rows)
+    if rows:
+        logger.info("Restored %d active chat sides.", len(rows))
+
+async def create_chat(user1: int, user2: int):
+    user_event(user1, "chat_open", peer=user2)
+    user_event(user2, "chat_open", peer=user1)
+    await storage.chats.create(user1, user2)
+
+async def open_chat(user1: int, user2: int):
+    await create_chat(user1, user2)
+    for uid in (user1, user2):
+        outbox.post(PRIORITY_NOTIFY, bot.send_message, uid, "Собеседник найден! Можно общаться. Чтобы раскрыть личность или пожаловаться нажми кнопку.", reply_markup=INCHAT_KB)
+
+async def end_chat(user_id: int):
+    peer = active_chats.pop(user_id, None)
+    if peer is None:
+        return None
+    user_event(peer, "chat_close", peer=user_id)
+    await storage.chats.delete(user_id, peer)
+    return peer
+
+async def get_peer(user_id: int):
+    return active_chats.get(user_id)
+
+@callbacks.route("find")
+async def cb_find(query: types.CallbackQuery):
+    uid = query.from_user.id
+    await ensure_user(query.from_user)
+    if await is_banned(uid):
+        await query.answer("Вы заблокированы.", show_alert=True)
+        return
+    if await is_muted(uid):
+        await query.answer("Вам временно запрещено искать собеседников.", show_alert=True)
+        return
+    # if already in chat:
+    if await get_peer(uid):
+        await query.answer("Вы уже в чате. Нажмите Отключиться.", show_alert=True)
+        return
+    pair = await matchmake("chat", uid)
+    if pair:
+        # form chat
+        await open_chat(uid, pair)
+    else:
+        await query.message.edit_text("🔎 Ищем собеседника... Нажмите снова, если захотите отменить.", reply_markup=SEARCH_KB)
+
+@callbacks.route("cancel_search")
+async def cb_cancel_search(query: types.CallbackQuery):
+    await leave_search(query.from_user.id)
+    await query.message.edit_text("Поиск отменён.", reply_markup=MAIN_KB)
+
+@callbacks.route("stop")
+async def cb_stop(query: types.CallbackQuery):
+    peer = await end_chat(query.from_user.id)
+    if peer:
+        outbox.post(PRIORITY_NOTIFY, bot.send_message, peer, "Собеседник отключился.", reply_markup=MAIN_KB)
+    await query.message.edit_text("Вы отключены.", reply_markup=MAIN_KB)
+
+@callbacks.route("reveal")
+async def cb_reveal(query: types.CallbackQuery):
+    uid = query.from_user.id
+    peer = await get_peer(uid)
+    if not peer:
+        await query.answer("Вы не в чате.", show_alert=True)
+        return
+    # fetch profile of uid and send to peer
+    text = await get_profile_text(uid)
+    try:
+        await outbox.submit(PRIORITY_NOTIFY, bot.send_message, peer, f"Пользователь раскрыл личность:\n\n{text}")
+        await query.answer("Анкета отправлена собеседнику.", show_alert=True)
+    except Exception:
+        await query.answer("Не удалось отправить.", show_alert=True)
+
+@callbacks.route("complain")
+async def cb_complain(query: types.CallbackQuery):
+    uid = query.from_user.id
+    peer = await get_peer(uid)
+    if not peer:
+        await query.answer("Вы не в чате.", show_alert=True)
+        return
+    kb = keyboard(
+        [("Оскорбления", cb_data("c", ComplaintTarget(peer, "insult")))],
+        [("Спам / реклама", cb_data("c", ComplaintTarget(peer, "spam")))],
+        [("Другое", cb_data("c", ComplaintTarget(peer, "other")))],
+        [("◀️ Назад", "inchat_back")],
+    )
+    await query.message.edit_text("Выберите причину жалобы:", reply_markup=kb)
+
+@callbacks.route("inchat_back")
+async def cb_inchat_back(query: types.CallbackQuery):
+    if await get_peer(query.from_user.id):
+        await query.message.edit_text("Вы в чате с собеседником.", reply_markup=INCHAT_KB)
+    else:
+        await query.message.edit_text("Главное меню", reply_markup=MAIN_KB)
+
+@callbacks.route("c", ComplaintTarget)
+async def cb_compl_reason(query: types.CallbackQuery, complaint: ComplaintTarget):
+    target, reason = complaint
+    # every complaint also costs the target a reputation point
+    await storage.complaints.create(query.from_user.id, target, reason, now_ts())
+    user_event(target, "reputation", delta=-1)
+    user_event(target, "profile")
+    # notify admins
+    for admin in ADMIN_IDS:
+        outbox.post(PRIORITY_NOTIFY, bot.send_message, admin, f"Новая жалоба на {target} от {query.from_user.id}. Причина: {reason}")
+    await query.message.edit_text("Жалоба отправлена админам.", reply_markup=MAIN_KB)
+
+# ============================
+# === Mini-games (1v1) ======
+# ============================
+@callbacks.route("games")
+async def cb_games_main(query: types.CallbackQuery):
+    await query.message.edit_text("Игры меню:", reply_markup=GAMES_KB)
+
+@callbacks.route("game_rps")
+async def cb_game_rps(query: types.CallbackQuery):
+    # join queue for RPS by reusing pairing table but with special marker
+    await query.message.edit_text("Нажми 'Найти соперника' чтобы играть в RPS (ставка может быть добавлена).",
+                                  reply_markup=RPS_KB)
+
+class GameSession:
+    __slots__ = ("game_type", "players", "moves", "secret", "guesser", "touched")
+
+    def __init__(self, game_type: str, first: int, second: int):
+        self.game_type = game_type
+        self.players = (first, second)
+        self.moves = {}       # rps: user_id -> move
+        self.secret = None    # guess: the hidden number
+        self.guesser = None   # guess: the player who has to find it
+        self.touched = time.monotonic()
+
+    def peer_of(self, user_id: int):
+        first, second = self.players
+        return second if user_id == first else first
+
+class GameManager:
+    """In-memory 1v1 game sessions.
+
+    Each game type has its own FIFO waiting queue; paired players share one
+    ``GameSession`` indexed by both user ids, so moves resolve without DB reads.
+    Sessions idle for longer than ``ttl`` seconds (and stale queue entries) are
+    expired by ``expire``. Only final results are written to the DB.
+    """
+
+    def __init__(self, game_types, ttl: float):
+        self.ttl = ttl
+        self.queues = {game_type: MatchmakingQueue() for game_type in game_types}
+        self.waiting_since = {}  # user_id -> (game_type, monotonic time)
+        self.sessions = {}       # user_id -> GameSession
+
+    def leave_queues(self, user_id: int):
+        entry = self.waiting_since.pop(user_id, None)
+        if entry is not None:
+            self.queues[entry[0]].remove(user_id)
+
+    def pair(self, game_type: str, user_id: int):
+        """Take the oldest waiting player of ``game_type``, or queue ``user_id``. Returns the peer or None."""
+        peer = self.queues[game_type].pop_partner(user_id)
+        if peer is None:
+            self.leave_queues(user_id)
+            self.queues[game_type].add(user_id)
+            self.waiting_since[user_id] = (game_type, time.monotonic())
+            return None
+        self.waiting_since.pop(peer, None)
+        self.leave_queues(user_id)
+        return peer
+
+    def start(self, game_type: str, first: int, second: int):
+        session = GameSession(game_type, first, second)
+        self.sessions[first] = session
+        self.sessions[second] = session
+        return session
+
+    def end(self, session: GameSession):
+        for player in session.players:
+            if self.sessions.get(player) is session:
+                del self.sessions[player]
+
+    def expire(self, now: float):
+        """Drop idle sessions and stale waiters; returns (sessions, waiting user ids)."""
+        stale_sessions = {id(s): s for s in self.sessions.values() if now - s.touched > self.ttl}
+        for session in stale_sessions.values():
+            self.end(session)
+        stale_waiters = [uid for uid, (_, since) in self.waiting_since.items() if now - since > self.ttl]
+        for uid in stale_waiters:
+            self.leave_queues(uid)
+        return list(stale_sessions.values()), stale_waiters
+
+games = GameManager(("rps", "guess"), GAME_IDLE_TTL)
+
+RPS_MOVES = ("камень", "ножницы", "бумага")
+RPS_BEATS = {"камень": "ножницы", "ножницы": "бумага", "бумага": "камень"}
+
+async def record_game_result(session: GameSession, winner=None):
+    """Persist a finished game: result row and winner's reputation in one transaction."""
+    first, second = session.players
+    await storage.games.record_result(session.game_type, first, second, winner, now_ts())
+    if winner is not None:
+        user_event(winner, "reputation", delta=1)
+        user_event(winner, "profile")
+
+async def game_sweeper():
+    while True:
+        await asyncio.sleep(GAME_SWEEP_INTERVAL)
+        sessions, waiters = games.expire(time.monotonic())
+        for session in sessions:
+            release_players(session)
+            for player in session.players:
+                outbox.post(PRIORITY_NOTIFY, bot.send_message, player, "Игра завершена из-за неактивности.")
+        if sessions or waiters:
+            logger.info("Expired %d idle games and %d stale game queue entries.", len(sessions), len(waiters))
+
+@callbacks.route("find_rps")
+async def cb_find_rps(query: types.CallbackQuery):
+    uid = query.from_user.id
+    if uid in games.sessions or uid in remote_games:
+        await query.answer("Вы уже в игре.", show_alert=True)
+        return
+    if uid in active_chats:
+        await query.answer("Вы в чате. Сначала отключитесь.", show_alert=True)
+        return
+    # join the rps queue or pair with a waiting player; both then send their moves
+    peer = await matchmake("rps", uid)
+    if peer:
+        start_game("rps", uid, peer)
+        outbox.post(PRIORITY_NOTIFY, bot.send_message, uid, "Соперник найден! Отправь: камень / ножницы / бумага")
+        outbox.post(PRIORITY_NOTIFY, bot.send_message, peer, "Соперник найден! Отправь: камень / ножницы / бумага")
+    else:
+        await query.answer("Добавлено в очередь RPS. Подождите соперника.", show_alert=True)
+
+@callbacks.route("game_guess")
+async def cb_game_guess(query: types.CallbackQuery):
+    await query.message.edit_text("Найди соперника для 'Угадай число' (1-10).", reply_markup=GUESS_KB)
+
+@callbacks.route("find_guess")
+async def cb_find_guess(query: types.CallbackQuery):
+    uid = query.from_user.id
+    if uid in games.sessions or uid in remote_games:
+        await query.answer("Вы уже в игре.", show_alert=True)
+        return
+    if uid in active_chats:
+        await query.answer("Вы в чате. Сначала отключитесь.", show_alert=True)
+        return
+    peer = await matchmake("guess", uid)
+    if peer:
+        session = start_game("guess", uid, peer)
+        # the player who completed the pair sets the secret, the waiting one guesses
+        session.secret = secrets.randbelow(10) + 1
+        session.guesser = peer
+        outbox.post(PRIORITY_NOTIFY, bot.send_message, uid, "Вы загадали число (секрет установлен). Соперник должен угадать.")
+        outbox.post(PRIORITY_NOTIFY, bot.send_message, peer, "Соперник загадал число от 1 до 10. Отправьте вашу догадку (число).")
     else:
         await query.answer("Добавлено в очередь 'Guess'. Подождите соперника.", show_alert=True)
 
 # handle messages for games moves
-@dp.message()
-async def handle_game_moves(msg: types.Message):
+def in_game(msg: types.Message):
+    return (msg.from_user is not None and (msg.from_user.id in games.sessions or msg.from_user.id in remote_games)
+            and not (msg.text or "").startswith("/"))
+
+@dp.message(in_game)
+async def handle_game_moves(msg: types.Message, event_update: types.Update):
     uid = msg.from_user.id
-    # check if user is in games table with peer
-    r = db_execute("SELECT game_type, state, peer_id FROM games WHERE user_id = ?", (uid,), fetch=True)
-    if not r:
-        return  # not in any game here
-    game_type, state, peer = r[0]
+    session = games.sessions.get(uid)
+    if session is None:
+        owner = remote_games.get(uid)
+        if owner is not None:
+            # the session lives in the worker of the player who completed the pair
+            shard_link.send_to_shard(owner, {"op": "update", "update": dump_update(event_update)})
+        return
+    peer = session.peer_of(uid)
     text = (msg.text or "").lower().strip()
-    if game_type == "rps":
-        if state != "waiting":
-            await msg.reply("Игра не готова.")
-            return
-        if text not in ("камень", "ножницы", "бумага"):
+    if session.game_type == "rps":
+        if text not in RPS_MOVES:
             await msg.reply("Отправь: камень / ножницы / бумага")
             return
-        # store move in state column as JSON-like: {"move":"камень"}
-        db_execute("UPDATE games SET state = ? WHERE user_id = ?", (text, uid))
-        # check peer's move
-        pr = db_execute("SELECT state FROM games WHERE user_id = ?", (peer,), fetch=True)
-        if pr and pr[0][0] in ("камень", "ножницы", "бумага"):
-            m1 = text
-            m2 = pr[0][0]
-            # determine winner
-            if m1 == m2:
-                res_text = "Ничья."
-            elif (m1 == "камень" and m2 == "ножницы") or (m1 == "ножницы" and m2 == "бумага") or (m1 == "бумага" and m2 == "камень"):
-                res_text = f"Победил {uid}"
-                db_execute("UPDATE users SET reputation = reputation + 1 WHERE user_id = ?", (uid,))
-            else:
-                res_text = f"Победил {peer}"
-                db_execute("UPDATE users SET reputation = reputation + 1 WHERE user_id = ?", (peer,))
-            # cleanup
-            db_execute("DELETE FROM games WHERE user_id IN (?, ?)", (uid, peer))
-            await bot.send_message(uid, f"Результат: {res_text}")
-            await bot.send_message(peer, f"Результат: {res_text}")
-        else:
+        session.moves[uid] = text
+        session.touched = time.monotonic()
+        if peer not in session.moves:
             await msg.reply("Ваш ход принят. Ожидаем ход соперника.")
+            return
+        m1, m2 = text, session.moves[peer]
+        # determine winner
+        if m1 == m2:
+            winner = None
+        elif RPS_BEATS[m1] == m2:
+            winner = uid
+        else:
+            winner = peer
+        games.end(session)
+        release_players(session)
+        await record_game_result(session, winner)
+        res_text = "Ничья." if winner is None else f"Победил {winner}"
+        outbox.post(PRIORITY_NOTIFY, bot.send_message, uid, f"Результат: {res_text}")
+        outbox.post(PRIORITY_NOTIFY, bot.send_message, peer, f"Результат: {res_text}")
         return
 
-    if game_type == "guess":
-        if state == "guessing":
-            # this player should guess; peer has secret in their state
-            try:
-                guess = int(text)
-            except Exception:
-                await msg.reply("Отправьте число от 1 до 10.")
-                return
-            # find secret
-            pr = db_execute("SELECT state FROM games WHERE user_id = ?", (peer,), fetch=True)
-            if not pr:
-                await msg.reply("Ошибка игры.")
-                return
-            secret = int(pr[0][0])
-            if guess == secret:
-                await bot.send_message(uid, "Вы угадали! Победа!")
-                await bot.send_message(peer, "Вас угадали. Вы проиграли.")
-                db_execute("UPDATE users SET reputation = reputation + 1 WHERE user_id = ?", (uid,))
-            else:
-                await bot.send_message(uid, "Не угадали. Попробуйте снова или завершите.")
-                await bot.send_message(peer, f"Соперник попытался угадать: {guess}")
-            # For simplicity, end game after guess (could be extended)
-            db_execute("DELETE FROM games WHERE user_id IN (?, ?)", (uid, peer))
-        else:
+    if session.game_type == "guess":
+        if uid != session.guesser:
             await msg.reply("Ожидайте инструкций.")
+            return
+        try:
+            guess = int(text)
+        except Exception:
+            await msg.reply("Отправьте число от 1 до 10.")
+            return
+        if guess == session.secret:
+            outbox.post(PRIORITY_NOTIFY, bot.send_message, uid, "Вы угадали! Победа!")
+            outbox.post(PRIORITY_NOTIFY, bot.send_message, peer, "Вас угадали. Вы проиграли.")
+        else:
+            outbox.post(PRIORITY_NOTIFY, bot.send_message, uid, "Не угадали. Попробуйте снова или завершите.")
+            outbox.post(PRIORITY_NOTIFY, bot.send_message, peer, f"Соперник попытался угадать: {guess}")
+        # For simplicity, end game after guess (could be extended)
+        games.end(session)
+        release_players(session)
+        await record_game_result(session, winner=uid if guess == session.secret else None)
         return
 
 # ============================
 # === Admin commands =========
 # ============================
+# the filter code rides in the page buttons' callback_data ("an:<cursor>:<code>")
+USER_FILTER_CODE_MAX = CALLBACK_DATA_LIMIT - len("an::") - 20
+REPUTATION_RANGE = (-2**31, 2**31 - 1)  # users.reputation is a 32-bit INTEGER in PostgreSQL
+
+def _rep_bound(text: str):
+    if not text:
+        return ""
+    value = int(text)
+    if not REPUTATION_RANGE[0] <= value <= REPUTATION_RANGE[1]:
+        raise ValueError(text)
+    return value
+
+def parse_user_filter(args):
+    """Turn `/admin_panel` arguments (banned, vip, rep:MIN..MAX) into a compact filter code.
+
+    Raises ValueError for unknown arguments, out-of-range bounds or a code too long to
+    fit in callback_data.
+    """
+    parts = []
+    for arg in args:
+        arg = arg.lower()
+        if arg == "banned":
+            parts.append("b")
+        elif arg == "vip":
+            parts.append("v")
+        elif arg.startswith("rep:"):
+            lo, _, hi = arg[4:].partition("..")
+            parts.append(f"r{_rep_bound(lo)}:{_rep_bound(hi)}")
+        else:
+            raise ValueError(arg)
+    code = ",".join(parts)
+    if len(code) > USER_FILTER_CODE_MAX:
+        raise ValueError(code)
+    return code
+
+async def render_user_page(code: str, after: int = None, before: int = None):
+    """One keyset page of users: ids > after (forward) or < before (backward)."""
+    flt = UserFilter.from_code(code)
+    if before is not None:
+        rows = await storage.users.page(flt, ADMIN_PAGE_SIZE + 1, before=before)
+        has_prev = len(rows) > ADMIN_PAGE_SIZE
+        rows = rows[:ADMIN_PAGE_SIZE][::-1]
+        has_next = True
+    else:
+        after = after or 0
+        rows = await storage.users.page(flt, ADMIN_PAGE_SIZE + 1, after=after)
+        has_next = len(rows) > ADMIN_PAGE_SIZE
+        rows = rows[:ADMIN_PAGE_SIZE]
+        has_prev = after > 0
+    if not rows:
+        return "Пользователи не найдены.", None
+    text = f"Пользователи ({code or 'все'}):\n"
+    for u in rows:
+        text += f"{u[0]} | @{u[1]} | {(u[2] or '')[:32]} | rep:{u[3]} | bal:{u[4]} | vip:{fmt_ts(u[5])} | banned:{u[6]}\n"
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=cb_data("ap", UserPage(rows[0][0], code))))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=cb_data("an", UserPage(rows[-1][0], code))))
+    return text, InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+
 @dp.message(Command("admin_panel"))
 async def cmd_admin_panel(msg: types.Message):
     if not is_admin(msg.from_user.id):
         await msg.reply("Нет доступа.")
         return
-    users = db_execute("SELECT user_id, username, display_name, reputation, balance, vip_until, banned FROM users", fetch=True)
-    text = "Пользователи:\n"
-    for u in users:
-        text += f"{u[0]} | @{u[1]} | {u[2]} | rep:{u[3]} | bal:{u[4]} | vip:{u[5]} | banned:{u[6]}\n"
-    await msg.reply(text)
+    try:
+        code = parse_user_filter((msg.text or "").split()[1:])
+    except ValueError:
+        await msg.reply("Использование: /admin_panel [banned] [vip] [rep:MIN..MAX]")
+        return
+    text, kb = await render_user_page(code)
+    await msg.reply(text, reply_markup=kb)
+
+@callbacks.route("an", UserPage)
+async def cb_admin_next(query: types.CallbackQuery, page: UserPage):
+    if not is_admin(query.from_user.id):
+        await query.answer("Только администратор.", show_alert=True)
+        return
+    text, kb = await render_user_page(page.code, after=page.cursor)
+    await query.message.edit_text(text, reply_markup=kb)
+
+@callbacks.route("ap", UserPage)
+async def cb_admin_prev(query: types.CallbackQuery, page: UserPage):
+    if not is_admin(query.from_user.id):
+        await query.answer("Только администратор.", show_alert=True)
+        return
+    text, kb = await render_user_page(page.code, before=page.cursor)
+    await query.message.edit_text(text, reply_markup=kb)
+
+@dp.message(Command("admin_export"))
+async def cmd_admin_export(msg: types.Message):
+    if not is_admin(msg.from_user.id):
+        await msg.reply("Нет доступа.")
+        return
+    try:
+        code = parse_user_filter((msg.text or "").split()[1:])
+    except ValueError:
+        await msg.reply("Использование: /admin_export [banned] [vip] [rep:MIN..MAX]")
+        return
+    fd, path = tempfile.mkstemp(prefix="users_", suffix=".csv")
+    os.close(fd)
+    try:
+        # rows are written to disk by the storage backend, then uploaded from the file
+        count = await storage.users.export_csv(UserFilter.from_code(code), path)
+        await msg.answer_document(FSInputFile(path, filename="users.csv"), caption=f"Пользователей: {count}")
+    finally:
+        os.remove(path)
 
 @dp.message(Command("ban"))
 async def cmd_ban(msg: types.Message):
@@ -696,7 +3705,8 @@ async def cmd_ban(msg: types.Message):
         return
     try:
         target = int(parts[1])
-        db_execute("UPDATE users SET banned = 1 WHERE user_id = ?", (target,))
+        await storage.users.set_banned(target, True)
+        user_event(target, "state", banned=1)
         await msg.reply("Пользователь заблокирован.")
     except Exception:
         await msg.reply("Ошибка.")
@@ -712,7 +3722,8 @@ async def cmd_unban(msg: types.Message):
         return
     try:
         target = int(parts[1])
-        db_execute("UPDATE users SET banned = 0 WHERE user_id = ?", (target,))
+        await storage.users.set_banned(target, False)
+        user_event(target, "state", banned=0)
         await msg.reply("Пользователь разбанен.")
     except Exception:
         await msg.reply("Ошибка.")
@@ -729,8 +3740,9 @@ async def cmd_mute(msg: types.Message):
     try:
         target = int(parts[1])
         minutes = int(parts[2])
-        until = (datetime.utcnow() + timedelta(minutes=minutes)).isoformat()
-        db_execute("UPDATE users SET muted_until = ? WHERE user_id = ?", (until, target))
+        until = now_ts() + minutes * 60
+        await storage.users.set_muted_until(target, until)
+        user_event(target, "state", muted_until=until)
         await msg.reply("Пользователь замучен.")
     except Exception:
         await msg.reply("Ошибка.")
@@ -746,7 +3758,7 @@ async def cmd_add_balance(msg: types.Message):
         return
     try:
         target = int(parts[1]); amount = int(parts[2])
-        add_balance(target, amount)
+        await add_balance(target, amount)
         await msg.reply("Баланс обновлён.")
     except Exception:
         await msg.reply("Ошибка.")
@@ -762,24 +3774,841 @@ async def cmd_give_vip(msg: types.Message):
         return
     try:
         target = int(parts[1]); days = int(parts[2])
-        give_vip(target, days)
+        await give_vip(target, days)
         await msg.reply("VIP выдан.")
     except Exception:
         await msg.reply("Ошибка.")
 
+@dp.message(Command("db_stats"))
+async def cmd_db_stats(msg: types.Message):
+    if not is_admin(msg.from_user.id):
+        await msg.reply("Нет доступа.")
+        return
+    m = storage.metrics()
+    m.update({f"cache_{k}": v for k, v in user_cache.stats().items()})
+    m.update({f"profile_cache_{k}": v for k, v in profile_cards.stats().items()})
+    await msg.reply("\n".join(f"{k}: {v}" for k, v in m.items()))
+
+@dp.message(Command("outbox_stats"))
+async def cmd_outbox_stats(msg: types.Message):
+    if not is_admin(msg.from_user.id):
+        await msg.reply("Нет доступа.")
+        return
+    m = outbox.metrics()
+    await msg.reply("\n".join(f"{k}: {v}" for k, v in m.items()))
+
+def render_perf_report(top: int = 10):
+    handlers = metrics.series("bot_handler_seconds")
+    db_calls = metrics.series("bot_db_calls_per_update")
+    lines = ["Обработчики (вызовы | ср. мс | p95 мс | запросов к БД):"]
+    for labels, (count, total, p95) in sorted(handlers.items(), key=lambda kv: -kv[1][1])[:top]:
+        calls = db_calls.get(labels, (count, 0, 0))[1]
+        lines.append(f"{labels[0][1]}: {count} | {total / count * 1000:.1f} | ≤{p95 * 1000:g} | {calls / count:.1f}")
+    lines.append("")
+    lines.append("Запросы к БД (вызовы | всего мс | ср. мс):")
+    statements = metrics.series("bot_db_statement_seconds")
+    for labels, (count, total, _) in sorted(statements.items(), key=lambda kv: -kv[1][1])[:top]:
+        lines.append(f"{labels[0][1][:60]}: {count} | {total * 1000:.0f} | {total / count * 1000:.2f}")
+    errors = {k[1][0][1]: v for k, v in metrics.counters.items() if k[0] == "bot_handler_errors_total"}
+    if errors:
+        lines.append("")
+        lines.append("Ошибки: " + ", ".join(f"{name}={n}" for name, n in sorted(errors.items())))
+    return "\n".join(lines)
+
+@dp.message(Command("perf"))
+async def cmd_perf(msg: types.Message):
+    if not is_admin(msg.from_user.id):
+        await msg.reply("Нет доступа.")
+        return
+    await msg.reply(render_perf_report())
+
+# ============================
+# === Broadcasts =============
+# ============================
+# A broadcast walks the users table in user_id order. Sends complete out of order, so
+# the checkpoint is the highest user_id below which every send has finished; after a
+# restart the broadcast resumes from there, and only the sends that were still in
+# flight (at most BROADCAST_CONCURRENCY) can be delivered twice.
+BROADCAST_TITLES = {
+    BROADCAST_RUNNING: "📣 Рассылка #{} идёт",
+    BROADCAST_DONE: "✅ Рассылка #{} завершена",
+    BROADCAST_STOPPED: "⏹ Рассылка #{} остановлена",
+    BROADCAST_FAILED: "⚠️ Рассылка #{} прервана из-за ошибки",
+}
+
+def render_broadcast_status(broadcast: Broadcast, state: int):
+    handled = broadcast.sent + broadcast.failed + broadcast.blocked
+    return (f"{BROADCAST_TITLES[state].format(broadcast.id)}\n"
+            f"Обработано: {handled} из {broadcast.total}\n"
+            f"Доставлено: {broadcast.sent}\n"
+            f"Заблокировали бота: {broadcast.blocked}\n"
+            f"Ошибок: {broadcast.failed}")
+
+async def edit_status_message(chat_id: int, message_id: int, text: str):
+    return await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+
+async def deliver_broadcast(user_id: int, text: str):
+    """Send one broadcast message; returns "sent", "blocked" or "failed"."""
+    try:
+        await outbox.submit(PRIORITY_BULK, bot.send_message, user_id, text)
+    except TelegramForbiddenError:
+        return "blocked"
+    except Exception as e:
+        logger.debug("Broadcast to %s failed: %s", user_id, e)
+        return "failed"
+    return "sent"
+
+async def run_broadcast(broadcast: Broadcast):
+    """Send ``broadcast`` to every recipient after its checkpoint."""
+    limit = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    inflight = deque()  # (user_id, task) in user_id order
+    blocked_users = []
+    counts = {"sent": broadcast.sent, "failed": broadcast.failed, "blocked": broadcast.blocked}
+    done_upto = broadcast.last_user_id
+    next_report = time.monotonic() + BROADCAST_STATUS_INTERVAL
+
+    def collect():
+        nonlocal done_upto
+        while inflight and inflight[0][1].done():
+            user_id, task = inflight.popleft()
+            outcome = task.result()
+            counts[outcome] += 1
+            if outcome == "blocked":
+                blocked_users.append(user_id)
+            done_upto = user_id
+
+    async def report(state: int):
+        """Checkpoint and show the progress; False once an admin has stopped the broadcast."""
+        nonlocal broadcast, next_report
+        broadcast = broadcast._replace(last_user_id=done_upto, **counts)
+        running = await storage.broadcasts.checkpoint(broadcast, blocked_users)
+        for user_id in blocked_users:
+            user_event(user_id, "state", blocked_bot=1)  # so /start knows to clear it
+        blocked_users.clear()
+        if not running:
+            state = BROADCAST_STOPPED
+        elif state != BROADCAST_RUNNING:
+            await storage.broadcasts.finish(broadcast.id, state, now_ts())
+        outbox.post(PRIORITY_NOTIFY, edit_status_message, broadcast.status_chat, broadcast.status_message,
+                    render_broadcast_status(broadcast, state))
+        next_report = time.monotonic() + BROADCAST_STATUS_INTERVAL
+        return running
+
+    async def give_up():
+        """Mark the broadcast failed, so the admin sees it and /broadcast is free again."""
+        try:
+            await report(BROADCAST_FAILED)
+        except Exception:
+            # storage still down: the row stays running and resumes on the next start
+            outbox.post(PRIORITY_NOTIFY, edit_status_message, broadcast.status_chat, broadcast.status_message,
+                        render_broadcast_status(broadcast._replace(last_user_id=done_upto, **counts), BROADCAST_FAILED))
+
+    async def send_from(after: int):
+        """Queue a send for every recipient > after; False once an admin has stopped the broadcast."""
+        while True:
+            chunk = await storage.broadcasts.recipients(after, BROADCAST_CHUNK)
+            if not chunk:
+                return True
+            for user_id in chunk:
+                await limit.acquire()
+                task = asyncio.ensure_future(deliver_broadcast(user_id, broadcast.text))
+                task.add_done_callback(lambda _: limit.release())
+                inflight.append((user_id, task))
+                collect()
+                if time.monotonic() >= next_report and not await report(BROADCAST_RUNNING):
+                    return False
+            after = chunk[-1]
+
+    retries, failed_at = iter(BROADCAST_RETRY_DELAYS), None
+    try:
+        while True:
+            try:
+                if not await send_from(done_upto):
+                    logger.info("Broadcast %d stopped by an admin.", broadcast.id)
+                    return
+                await asyncio.gather(*(task for _, task in inflight))
+                collect()
+                await report(BROADCAST_DONE)
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # storage error (e.g. database is locked): let the queued sends finish
+                # (deliver_broadcast never raises), so the retry starts right after them
+                await asyncio.gather(*(task for _, task in inflight))
+                collect()
+                if done_upto != failed_at:  # progress since the last error: start the backoff over
+                    retries, failed_at = iter(BROADCAST_RETRY_DELAYS), done_upto
+                delay = next(retries, None)
+                if delay is None:
+                    logger.exception("Broadcast %d failed after %d retries.", broadcast.id, len(BROADCAST_RETRY_DELAYS))
+                    await give_up()
+                    return
+                logger.warning("Broadcast %d: %s; retrying in %s s.", broadcast.id, e, delay)
+                await asyncio.sleep(delay)
+        logger.info("Broadcast %d finished: %s.", broadcast.id, counts)
+    except asyncio.CancelledError:
+        # shutdown: keep the checkpoint and stay running, so the next start resumes
+        collect()
+        await report(BROADCAST_RUNNING)
+        raise
+    finally:
+        for _, task in inflight:
+            task.cancel()
+
+def start_broadcast(broadcast: Broadcast):
+    start_background(run_broadcast(broadcast), f"broadcast-{broadcast.id}")
+
+async def resume_broadcasts():
+    for broadcast in await storage.broadcasts.unfinished():
+        logger.info("Resuming broadcast %d after user %d.", broadcast.id, broadcast.last_user_id)
+        start_broadcast(broadcast)
+
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(msg: types.Message):
+    if not is_admin(msg.from_user.id):
+        await msg.reply("Нет доступа.")
+        return
+    parts = (msg.text or "").split(maxsplit=1)
+    if len(parts) < 2:
+        await msg.reply("Использование: /broadcast <текст>")
+        return
+    running = await storage.broadcasts.unfinished()
+    if running:
+        await msg.reply(f"Рассылка #{running[0].id} ещё идёт. Остановить: /broadcast_stop")
+        return
+    status = await msg.answer("📣 Рассылка: подготовка…")
+    broadcast = await storage.broadcasts.create(msg.from_user.id, parts[1], status.chat.id, status.message_id, now_ts())
+    await status.edit_text(render_broadcast_status(broadcast, BROADCAST_RUNNING))
+    start_broadcast(broadcast)
+
+@dp.message(Command("broadcast_stop"))
+async def cmd_broadcast_stop(msg: types.Message):
+    if not is_admin(msg.from_user.id):
+        await msg.reply("Нет доступа.")
+        return
+    # the sender notices at its next checkpoint, in whichever process it runs
+    stopped = [b.id for b in await storage.broadcasts.unfinished()
+               if await storage.broadcasts.finish(b.id, BROADCAST_STOPPED, now_ts())]
+    await msg.reply(f"Остановлено: {', '.join(f'#{i}' for i in stopped)}" if stopped else "Активных рассылок нет.")
+
+# ============================
+# === Maintenance ============
+# ============================
+async def reap_searches():
+    """End searches nobody matched within SEARCH_TTL; drop pairing rows left without a searcher."""
+    orphans = []
+    if PAIRING_DURABLE_LOG:
+        # read before the expiry below queues its own deletes; one batch per pass, since
+        # removals are queued writes and a second read could still see them
+        orphans = [u for u in await storage.pairing.stale(now_ts() - SEARCH_TTL, MAINTENANCE_BATCH) if u not in matchmaker]
+        if orphans:
+            storage.pairing.remove(*orphans)
+    expired = 0
+    for _ in range(MAINTENANCE_MAX_BATCHES):
+        stale = matchmaker.waiting_since(time.monotonic() - SEARCH_TTL, MAINTENANCE_BATCH)
+        for user_id in stale:
+            await queue_remove(user_id)
+            outbox.post(PRIORITY_NOTIFY, bot.send_message, user_id,
+                        "Собеседник так и не нашёлся, поиск остановлен. Попробуйте позже.", reply_markup=MAIN_KB)
+        expired += len(stale)
+        if len(stale) < MAINTENANCE_BATCH:
+            break
+    return {"searches": expired, "pairing_rows": len(orphans)}
+
+async def reap_chats():
+    """Close chats whose peer blocked the bot, was banned or is gone, and tell the side left behind."""
+    closed, after = 0, 0
+    for _ in range(MAINTENANCE_MAX_BATCHES):
+        sides = await storage.chats.abandoned(after, MAINTENANCE_BATCH)
+        if not sides:
+            break
+        after = sides[-1][0]
+        if shard_link is not None:
+            sides = [side for side in sides if shard_link.owns(side[0])]
+        for user_id, peer in sides:
+            if active_chats.get(user_id) == peer:
+                del active_chats[user_id]
+            user_event(peer, "chat_close", peer=user_id)
+            outbox.post(PRIORITY_NOTIFY, bot.send_message, user_id, "Собеседник покинул чат.", reply_markup=MAIN_KB)
+        if sides:
+            await storage.chats.delete_sides(sides + [(peer, user_id) for user_id, peer in sides])
+        closed += len(sides)
+    return {"chats": closed}
+
+async def reap_user_flags():
+    # cached copies of these values are already in the past, which reads the same as NULL
+    mutes = vips = 0
+    for _ in range(MAINTENANCE_MAX_BATCHES):
+        m, v = await storage.users.clear_expired(now_ts(), MAINTENANCE_BATCH)
+        mutes, vips = mutes + m, vips + v
+        if m < MAINTENANCE_BATCH and v < MAINTENANCE_BATCH:
+            break
+    return {"mutes": mutes, "vips": vips}
+
+async def maintenance_pass(number: int):
+    """One reaper pass; a worker only has chats, the front process everything else."""
+    t0 = time.perf_counter()
+    report = {}
+    if not isinstance(shard_link, ShardClient):
+        report.update(await reap_searches())
+        report.update(await reap_user_flags())
+    if not isinstance(shard_link, ShardHub):
+        report.update(await reap_chats())
+    if not isinstance(shard_link, ShardClient):
+        report.update(await storage.optimize(analyze=number % MAINTENANCE_ANALYZE_EVERY == 0))
+    for name, value in report.items():
+        if value and not isinstance(value, bool):
+            metrics.inc("bot_reaped_total", (("kind", name),), value)
+    logger.info("Maintenance pass %d in %.0f ms: %s", number, (time.perf_counter() - t0) * 1000,
+                ", ".join(f"{name}={value}" for name, value in report.items()))
+
+async def maintenance_reaper():
+    number = 0
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        number += 1
+        try:
+            await maintenance_pass(number)
+        except Exception:
+            logger.exception("Maintenance pass %d failed", number)
+
+# ============================
+# === Message routing ========
+# ============================
+# Catch-all handler: must stay the last message handler registered, otherwise it
+# swallows commands and game moves registered after it.
+@dp.message()
+async def handle_messages(msg: types.Message):
+    uid = msg.from_user.id
+    await ensure_user(msg.from_user)
+    # if user is admin and sends commands in private chat, allow admin panel
+    if msg.text and msg.text.startswith("/admin"):
+        if not is_admin(uid):
+            await msg.reply("Недостаточно прав.")
+            return
+    # if user is in a chat, forward message to peer (text and simple media)
+    peer = await get_peer(uid)
+    if peer:
+        if await is_muted(uid):
+            await msg.reply("Вы временно заблокированы и не можете отправлять сообщения.")
+            return
+        await relay_to_peer(msg, peer)
+        return
+
+    # if not in chat — interpret commands
+    text = msg.text or ""
+    if text.startswith("/profile_edit"):
+        # quick inline edit: "/profile_edit меня зовут Вася|25|про меня"
+        try:
+            _, payload = text.split(" ", 1)
+            parts = payload.split("|", 2)
+            display = parts[0]
+            about = parts[1] if len(parts) > 1 else ""
+            await storage.users.update_profile(uid, display, about)
+            profile_cards.invalidate(uid)
+            await msg.reply("Профиль обновлён.")
+        except Exception:
+            await msg.reply("Неправильный формат. Пример: /profile_edit Вася|Про меня")
+        return
+
+    if text.startswith("/start") and not peer:
+        await msg.reply("Используйте кнопки меню.", reply_markup=MAIN_KB)
+        return
+
+    # If user typed "игры" etc — show games menu
+    if text.lower().startswith("игры") or text.lower().startswith("/games"):
+        await msg.reply("Игры меню:", reply_markup=GAMES_KB)
+        return
+
+    # Fallback
+    await msg.reply("Чтобы начать — нажми 'Найти собеседника'.", reply_markup=MAIN_KB)
+
+# ============================
+# === Sharded workers ========
+# ============================
+# WORKERS > 1: the front process receives updates and forwards each one to the worker
+# owning its user (consistent hash of user_id). Workers run the regular `dp` handlers
+# for their users only; per-user in-memory state (active_chats, caches, game sessions)
+# lives in the owning worker. The front keeps the global search and game queues.
+# Each worker has two local socket connections to the front, carrying length-prefixed
+# JSON messages: "updates" (front -> worker, the worker stops reading when it is busy,
+# which throttles polling) and "control" (match / leave / forward requests from the
+# worker, replies and per-user events back), which is always read so replies can never
+# get stuck behind queued updates.
+# Handlers call user_event / matchmake / leave_search, which act locally in a single
+# process and go over IPC in sharded mode.
+
+def _ring_hash(key: str):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+class ShardRing:
+    """Consistent hash ring; SHARD_VNODES points per worker keep the load even, and
+    changing the worker count only moves about 1/N of the users."""
+
+    def __init__(self, shards: int, vnodes: int = SHARD_VNODES):
+        points = sorted((_ring_hash(f"shard-{s}-{v}"), s) for s in range(shards) for v in range(vnodes))
+        self._keys = [h for h, _ in points]
+        self._shards = [s for _, s in points]
+
+    def shard_of(self, user_id: int):
+        i = bisect.bisect(self._keys, _ring_hash(str(user_id)))
+        return self._shards[i % len(self._shards)]
+
+def dump_update(update: types.Update):
+    return update.model_dump(mode="json", exclude_unset=True, by_alias=True)
+
+class ShardChannel:
+    """One side of a front <-> worker socket: 4-byte length + JSON per message."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    def send(self, msg: dict):
+        data = json.dumps(msg, separators=(",", ":")).encode()
+        self.writer.write(struct.pack(">I", len(data)) + data)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def recv(self):
+        """Next message, or None once the other side has gone away."""
+        try:
+            header = await self.reader.readexactly(4)
+            return json.loads(await self.reader.readexactly(struct.unpack(">I", header)[0]))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    def close(self):
+        self.writer.close()
+
+class ShardHub:
+    """Front side: accepts the workers, routes updates, answers matchmaking requests
+    and relays per-user events to the worker that owns the user."""
+
+    shard = None  # the front owns no users
+
+    def __init__(self, workers: int, path: str):
+        self.ring = ShardRing(workers)
+        self.workers = workers
+        self.path = path
+        self.channels = {}  # shard -> control channel
+        self.updates = {}   # shard -> updates channel
+        self.ready = asyncio.Event()
+        self.dispatcher = None  # the front's update-routing dispatcher, set by run_sharded
+        self._server = None
+        self._tasks = set()
+
+    def owns(self, user_id: int):
+        return False
+
+    async def start(self):
+        self._server = await asyncio.start_unix_server(self._accept, path=self.path)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+        for channel in [*self.channels.values(), *self.updates.values()]:
+            channel.close()  # workers and the reader loops see EOF and finish
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _accept(self, reader, writer):
+        channel = ShardChannel(reader, writer)
+        hello = await channel.recv()
+        if not hello or hello.get("op") != "hello":
+            channel.close()
+            return
+        shard = hello["shard"]
+        if hello["role"] == "updates":
+            self.updates[shard] = channel
+        else:
+            self.channels[shard] = channel
+            logger.info("Worker %d connected.", shard)
+        if len(self.channels) == len(self.updates) == self.workers:
+            self.ready.set()
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            while True:
+                msg = await channel.recv()
+                if msg is None:
+                    break
+                try:
+                    await self._handle(channel, msg)
+                except Exception:
+                    logger.exception("Shard message failed: %s", msg.get("op"))
+        finally:
+            self._tasks.discard(task)
+            if self.channels.get(shard) is channel:
+                del self.channels[shard]
+                logger.warning("Worker %d disconnected.", shard)
+            if self.updates.get(shard) is channel:
+                del self.updates[shard]
+
+    async def _handle(self, channel: ShardChannel, msg: dict):
+        op = msg["op"]
+        if op == "match":
+            partner = await match_locally(msg["kind"], msg["user"], msg.get("vip", False), msg.get("rep", 0))
+            channel.send({"op": "reply", "id": msg["id"], "result": partner})
+        elif op == "leave":
+            await queue_remove(msg["user"])
+        elif op == "forward":
+            shard = msg["shard"] if msg.get("shard") is not None else self.ring.shard_of(msg["user"])
+            self.send_to_shard(shard, msg["msg"])
+
+    def send_to_shard(self, shard: int, msg: dict):
+        channel = self.channels.get(shard)
+        if channel is None:
+            logger.warning("Worker %d is down, dropped %s.", shard, msg["op"])
+            return
+        channel.send(msg)
+
+    def send_to_owner(self, user_id: int, msg: dict):
+        self.send_to_shard(self.ring.shard_of(user_id), msg)
+
+    async def route_update(self, handler, event: types.Update, data):
+        """Outer middleware of the front dispatcher: hand the update to its user's worker."""
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        key = user.id if user is not None else chat.id if chat is not None else 0
+        channel = self.updates.get(self.ring.shard_of(key))
+        if channel is None:
+            logger.warning("No worker for update %d, dropped.", event.update_id)
+            return
+        channel.send({"op": "update", "update": dump_update(event)})
+        # blocks only while the worker's socket buffer is full: backpressure on polling
+        await channel.drain()
+
+class ShardClient:
+    """Worker side of the front socket."""
+
+    def __init__(self, shard: int, workers: int):
+        self.shard = shard
+        self.ring = ShardRing(workers)
+        self.channel = None   # control
+        self.updates = None
+        self._replies = {}
+        self._next_id = 0
+        self._limit = asyncio.Semaphore(WORKER_MAX_CONCURRENT_UPDATES)
+
+    def owns(self, user_id: int):
+        return self.ring.shard_of(user_id) == self.shard
+
+    async def connect(self, path: str):
+        self.channel = ShardChannel(*await asyncio.open_unix_connection(path))
+        self.channel.send({"op": "hello", "shard": self.shard, "role": "control"})
+        self.updates = ShardChannel(*await asyncio.open_unix_connection(path))
+        self.updates.send({"op": "hello", "shard": self.shard, "role": "updates"})
+
+    async def request(self, op: str, **fields):
+        self._next_id += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._replies[self._next_id] = fut
+        self.channel.send({"op": op, "id": self._next_id, **fields})
+        return await fut
+
+    def send(self, op: str, **fields):
+        self.channel.send({"op": op, **fields})
+
+    def send_to_shard(self, shard: int, msg: dict):
+        self.send("forward", shard=shard, msg=msg)
+
+    def send_to_owner(self, user_id: int, msg: dict):
+        self.send("forward", user=user_id, msg=msg)
+
+    async def serve(self):
+        """Process messages from the front until it goes away."""
+        control = asyncio.ensure_future(self._serve_control())
+        try:
+            while True:
+                msg = await self.updates.recv()
+                if msg is None:
+                    break
+                await self._limit.acquire()
+                start_background(self._feed(msg["update"], self._limit), "update")
+        finally:
+            control.cancel()
+            await asyncio.gather(control, return_exceptions=True)
+            for fut in self._replies.values():
+                fut.cancel()
+
+    async def _serve_control(self):
+        while True:
+            msg = await self.channel.recv()
+            if msg is None:
+                break
+            op = msg["op"]
+            if op == "reply":
+                fut = self._replies.pop(msg["id"], None)
+                if fut is not None and not fut.done():
+                    fut.set_result(msg["result"])
+            elif op == "update":
+                # a game move forwarded by another worker; never wait here
+                start_background(self._feed(msg["update"]), "update")
+            else:
+                apply_user_event(op, msg["user"], msg)
+
+    async def _feed(self, raw: dict, limit: asyncio.Semaphore = None):
+        try:
+            await dp.feed_update(bot, types.Update.model_validate(raw, context={"bot": bot}))
+        except Exception:
+            logger.exception("Update handling failed")
+        finally:
+            if limit is not None:
+                limit.release()
+
+shard_link = None  # ShardHub in the front process, ShardClient in a worker, None otherwise
+
+# user_id -> worker holding the user's game session, for games paired across workers
+remote_games = {}
+
+def current_shard():
+    return shard_link.shard if shard_link is not None else None
+
+def apply_user_event(op: str, user_id: int, fields: dict):
+    if op == "chat_open":
+        active_chats[user_id] = fields["peer"]
+    elif op == "chat_close":
+        if active_chats.get(user_id) == fields["peer"]:
+            del active_chats[user_id]
+    elif op == "state":
+        user_cache.update(user_id, **{k: fields[k] for k in ("banned", "muted_until", "vip_until", "blocked_bot")
+                                      if k in fields})
+    elif op == "reputation":
+        user_cache.add(user_id, "reputation", fields["delta"])
+    elif op == "profile":
+        profile_cards.invalidate(user_id)
+    elif op == "game_owner":
+        if fields["shard"] != current_shard():
+            remote_games[user_id] = fields["shard"]
+    elif op == "game_over":
+        remote_games.pop(user_id, None)
+
+def user_event(user_id: int, op: str, **fields):
+    """Apply a change to ``user_id``'s in-memory state wherever that user lives."""
+    if shard_link is None or shard_link.owns(user_id):
+        apply_user_event(op, user_id, fields)
+    else:
+        shard_link.send_to_owner(user_id, {"op": op, "user": user_id, **fields})
+
+async def match_locally(kind: str, user_id: int, vip: bool = False, reputation: int = 0):
+    if kind == "chat":
+        return await queue_match(user_id, vip, reputation)
+    return games.pair(kind, user_id)
+
+async def matchmake(kind: str, user_id: int):
+    """Partner for ``user_id`` from the chat ("chat") or a game queue, or None if now waiting."""
+    # ranked where the user's state is cached, so the front never reads it
+    vip, reputation = await search_profile(user_id) if kind == "chat" else (False, 0)
+    if isinstance(shard_link, ShardClient):
+        return await shard_link.request("match", kind=kind, user=user_id, vip=vip, rep=reputation)
+    return await match_locally(kind, user_id, vip, reputation)
+
+async def leave_search(user_id: int):
+    if isinstance(shard_link, ShardClient):
+        shard_link.send("leave", user=user_id)
+    else:
+        await queue_remove(user_id)
+
+def start_game(game_type: str, first: int, second: int):
+    """Open the session in this process; the other player's worker forwards their moves here."""
+    session = games.start(game_type, first, second)
+    user_event(second, "game_owner", shard=current_shard())
+    return session
+
+def release_players(session: GameSession):
+    for player in session.players:
+        user_event(player, "game_over")
+
+def worker_main(shard: int, workers: int, path: str):
+    logging.basicConfig(level=LOG_LEVEL, format=f"%(levelname)s:worker{shard}:%(name)s:%(message)s", force=True)
+    try:
+        asyncio.run(run_worker(shard, workers, path))
+    except KeyboardInterrupt:
+        pass
+
+async def run_worker(shard: int, workers: int, path: str):
+    global shard_link, outbox
+    shard_link = ShardClient(shard, workers)
+    # every process sends on its own; split the bot-wide rate between them
+    outbox = OutboundScheduler(global_rate=OUTBOX_GLOBAL_RATE / (workers + 1))
+    await storage.open()
+    try:
+        await load_active_chats()
+        outbox.start()
+        start_background(game_sweeper(), "game-sweeper")
+        start_background(maintenance_reaper(), "maintenance")
+        if METRICS_PORT:
+            start_background(run_metrics_server(METRICS_PORT + 1 + shard), "metrics-server")
+        await shard_link.connect(path)
+        await shard_link.serve()
+    finally:
+        albums.flush_all()
+        await stop_background()
+        await outbox.stop()
+        await bot.session.close()
+        await storage.close()
+
+async def run_sharded(polling_timeout: int = 10):
+    """Front process: start the workers, then receive updates and route them.
+    The caller stops background tasks, the outbox and storage afterwards (see main)."""
+    global shard_link
+    if STORAGE_BACKEND == "memory":
+        raise RuntimeError("WORKERS > 1 needs a shared storage backend (sqlite or postgres)")
+    path = SHARD_SOCKET or os.path.join(tempfile.mkdtemp(prefix="bot_shards_"), "front.sock")
+    hub = shard_link = ShardHub(WORKERS, path)
+    await storage.open()
+    # the front owns the queues; chats, caches and game sessions live in the workers
+    await load_pairing_queue()
+    outbox.start()
+    start_search_sweeper()
+    await resume_broadcasts()
+    start_background(game_sweeper(), "game-sweeper")
+    start_background(invoice_settler(), "invoice-settler")
+    start_background(maintenance_reaper(), "maintenance")
+    if METRICS_PORT:
+        start_background(run_metrics_server(), "metrics-server")
+    await hub.start()
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=worker_main, args=(i, WORKERS, path), name=f"worker{i}", daemon=True)
+             for i in range(WORKERS)]
+    for proc in procs:
+        proc.start()
+    front = hub.dispatcher = Dispatcher()
+    front.update.outer_middleware(hub.route_update)
+    try:
+        await asyncio.wait_for(hub.ready.wait(), 60)
+        logger.info("Front process routing updates to %d workers.", WORKERS)
+        if RUN_MODE == "webhook":
+            await run_webhook(front)
+        else:
+            # sequential hand-off keeps each user's updates in order
+            await front.start_polling(bot, handle_as_tasks=False, handle_signals=False, polling_timeout=polling_timeout,
+                                      allowed_updates=dp.resolve_used_update_types())
+    finally:
+        await hub.close()  # workers exit when the socket closes
+        for proc in procs:
+            await asyncio.get_running_loop().run_in_executor(None, proc.join, 10)
+            if proc.is_alive():
+                proc.terminate()
+        if os.path.exists(path):
+            os.remove(path)
+
 # ============================
 # === Startup & main ========
 # ============================
+background_tasks = set()
+
+def start_background(coro, name: str):
+    task = asyncio.get_running_loop().create_task(coro, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def stop_background():
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+
+def runtime_gauges():
+    gauges = {f"bot_db_{k}": v for k, v in storage.metrics().items()}
+    gauges.update({f"bot_outbox_{k}": v for k, v in outbox.metrics().items()})
+    gauges.update({f"bot_user_cache_{k}": v for k, v in user_cache.stats().items()})
+    gauges.update({f"bot_profile_cache_{k}": v for k, v in profile_cards.stats().items()})
+    gauges["bot_active_chat_sides"] = len(active_chats)
+    gauges["bot_albums_pending"] = len(albums)
+    gauges["bot_flood_tracked_users"] = len(flood)
+    gauges["bot_search_queue"] = len(matchmaker)
+    gauges["bot_game_sessions"] = len(games.sessions)
+    return gauges
+
+async def handle_metrics(request: web.Request):
+    return web.Response(text=metrics.render(runtime_gauges()), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+async def run_metrics_server(port: int = METRICS_PORT):
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logger.info("Metrics endpoint on http://%s:%s/metrics", METRICS_HOST, port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 async def on_startup():
-    init_db()
-    logger.info("Bot starting... DB initialized.")
+    await storage.open()
+    await load_pairing_queue()
+    await load_active_chats()
+    outbox.start()
+    start_search_sweeper()
+    await resume_broadcasts()
+    start_background(game_sweeper(), "game-sweeper")
+    start_background(invoice_settler(), "invoice-settler")
+    start_background(maintenance_reaper(), "maintenance")
+    if METRICS_PORT:
+        start_background(run_metrics_server(), "metrics-server")
+    logger.info("Bot starting... %s storage ready.", STORAGE_BACKEND)
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """Webhook handler that answers 200 immediately and processes updates in the
+    background, with at most WEBHOOK_MAX_CONCURRENT_UPDATES running at once."""
+
+    def __init__(self, *args, max_concurrent: int = WEBHOOK_MAX_CONCURRENT_UPDATES, **kwargs):
+        super().__init__(*args, handle_in_background=True, **kwargs)
+        self._limit = asyncio.Semaphore(max_concurrent)
+
+    async def _background_feed_update(self, bot: Bot, update):
+        async with self._limit:
+            await super()._background_feed_update(bot, update)
+
+def build_webhook_app(dispatcher: Dispatcher = dp):
+    if not WEBHOOK_SECRET:
+        # without it anyone who finds the URL can post forged updates
+        raise RuntimeError("RUN_MODE=webhook needs WEBHOOK_SECRET (checked against X-Telegram-Bot-Api-Secret-Token)")
+    app = web.Application()
+    handler = LimitedRequestHandler(dispatcher=dispatcher, bot=bot, secret_token=WEBHOOK_SECRET)
+    handler.register(app, path=WEBHOOK_PATH)
+    return app
+
+async def run_webhook(dispatcher: Dispatcher = dp):
+    runner = web.AppRunner(build_webhook_app(dispatcher))
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info("Webhook server listening on %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 async def main():
-    await on_startup()
     try:
-        await dp.start_polling(bot)
+        if WORKERS > 1:
+            await run_sharded()
+            return
+        await on_startup()
+        if RUN_MODE == "webhook":
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
     finally:
+        albums.flush_all()
+        await stop_background()
+        await outbox.stop()
         await bot.session.close()
+        if crypto_pay is not None:
+            await crypto_pay.close()
+        await storage.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks for bot_full's data-access helpers (no Telegram needed).
+
+Seeds a temporary SQLite database per size, then times the hot helpers
+(db_execute, ensure_user, is_banned, is_muted, get_peer, queue_add/queue_match,
+create_chat/end_chat) and the helper sequences the busiest handlers run.
+Results are written as JSON; with --baseline they are compared against an
+earlier run and the script exits with 1 if any case got slower than allowed.
+
+Usage:
+    python tools/bench.py [--sizes 10000,100000,1000000] [--ops 2000]
+                          [--output bench.json] [--baseline baseline.json]
+                          [--tolerance 0.25] [--min-delta-us 2]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SEED = 1337
+SEED_BATCH = 50000
+# share of seeded users that are banned / muted / VIP / waiting in the queue / chatting
+BANNED_SHARE = 0.01
+MUTED_SHARE = 0.01
+VIP_SHARE = 0.05
+PAIRING_ROWS = 500
+CHAT_PAIRS = 2000
+
+
+def user(user_id):
+    # ensure_user only needs these attributes of types.User
+    return SimpleNamespace(id=user_id, username=f"u{user_id}", full_name=f"User {user_id}")
+
+
+def seed_db(path, size, rng):
+    """Fill a fresh database with ``size`` users plus queue and chat rows, in bulk."""
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = OFF")
+    now = int(time.time())
+    for start in range(1, size + 1, SEED_BATCH):
+        rows = []
+        for uid in range(start, min(start + SEED_BATCH, size + 1)):
+            r = rng.random()
+            rows.append((
+                uid, f"u{uid}", f"User {uid}", "", now - rng.randrange(86400 * 365),
+                rng.randrange(-5, 50), rng.randrange(100),
+                now + 86400 * 30 if r < VIP_SHARE else None,
+                1 if rng.random() < BANNED_SHARE else 0,
+                now + 3600 if rng.random() < MUTED_SHARE else None,
+            ))
+        conn.executemany(
+            "INSERT INTO users (user_id, username, display_name, about, created_at, reputation, balance,"
+            " vip_until, banned, muted_until) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.executemany("INSERT INTO pairing (user_id, looking_since) VALUES (?, ?)",
+                     [(uid, now - i) for i, uid in enumerate(rng.sample(range(1, size + 1), PAIRING_ROWS))])
+    chat_users = rng.sample(range(1, size + 1), CHAT_PAIRS * 2)
+    pairs = list(zip(chat_users[::2], chat_users[1::2]))
+    conn.executemany("INSERT INTO chats (user_id, peer_id) VALUES (?, ?)",
+                     [row for a, b in pairs for row in ((a, b), (b, a))])
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    return pairs
+
+
+def reset_bot_state(path):
+    """Point bot_full at a new database file and drop all in-memory state."""
+    import bot_full
+
+    bot_full.adb.stop()
+    bot_full.db.close()
+    bot_full.db.path = path
+    bot_full.user_cache.__init__(bot_full.USER_CACHE_SIZE)
+    bot_full.matchmaker.__init__()
+    bot_full.active_chats.clear()
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    n = len(samples)
+    total = sum(samples)
+    return {
+        "ops": n,
+        "ops_per_s": round(n / total, 1) if total else None,
+        "mean_us": round(total / n * 1e6, 2),
+        "p50_us": round(statistics.median(samples) * 1e6, 2),
+        "p95_us": round(samples[min(n - 1, int(n * 0.95))] * 1e6, 2),
+        "p99_us": round(samples[min(n - 1, int(n * 0.99))] * 1e6, 2),
+    }
+
+
+async def timed(ops, fn):
+    """Call ``await fn(i)`` for i in range(ops) and return the per-call timings."""
+    samples = []
+    clock = time.perf_counter
+    for i in range(ops):
+        t0 = clock()
+        await fn(i)
+        samples.append(clock() - t0)
+    return samples
+
+
+async def run_size(size, ops, workdir):
+    import bot_full
+
+    rng = random.Random(SEED + size)
+    path = os.path.join(workdir, f"bench_{size}.db")
+    reset_bot_state(path)
+    bot_full.init_db()
+    bot_full.migrate_db()
+    t0 = time.perf_counter()
+    pairs = seed_db(path, size, rng)
+    logging.info("seeded %d users in %.1fs", size, time.perf_counter() - t0)
+    bot_full.adb.start()
+    await bot_full.load_pairing_queue()
+    await bot_full.load_active_chats()
+
+    ids = [rng.randrange(1, size + 1) for _ in range(ops)]
+    new_ids = iter(range(size + 1, size + 1 + ops * 10))
+    chatting = [a for a, _ in pairs]
+    results = {}
+
+    async def case(name, fn, setup=None):
+        if setup:
+            setup()
+        results[name] = summarize(await timed(ops, fn))
+
+    def cold_cache():
+        bot_full.user_cache.__init__(bot_full.USER_CACHE_SIZE)
+
+    # --- raw statements ---
+    async def db_point_select(i):
+        bot_full.db_execute("SELECT reputation FROM users WHERE user_id = ?", (ids[i],), fetch=True)
+
+    await case("db_execute.point_select", db_point_select)
+    await case("adb_execute.point_select", lambda i: bot_full.adb_execute(
+        "SELECT reputation FROM users WHERE user_id = ?", (ids[i],), fetch=True))
+    await case("adb_execute.update", lambda i: bot_full.adb_execute(
+        "UPDATE users SET reputation = reputation + 1 WHERE user_id = ?", (ids[i],)))
+
+    # --- per-user state ---
+    await case("ensure_user.new", lambda i: bot_full.ensure_user(user(next(new_ids))))
+    await case("ensure_user.known_cold", lambda i: bot_full.ensure_user(user(ids[i])), cold_cache)
+    await case("ensure_user.known_warm", lambda i: bot_full.ensure_user(user(ids[i])))
+    await case("is_banned.cold", lambda i: bot_full.is_banned(ids[i]), cold_cache)
+    await case("is_banned.warm", lambda i: bot_full.is_banned(ids[i]))
+    await case("is_muted.warm", lambda i: bot_full.is_muted(ids[i]))
+    await case("get_peer", lambda i: bot_full.get_peer(chatting[i % len(chatting)]))
+
+    # --- matchmaking and chats ---
+    async def queue_add(i):
+        await bot_full.queue_add(next(new_ids))
+
+    async def queue_match(i):
+        await bot_full.queue_match(next(new_ids))
+
+    async def chat_cycle(i):
+        a, b = next(new_ids), next(new_ids)
+        await bot_full.create_chat(a, b)
+        await bot_full.end_chat(a)
+
+    await case("queue_add", queue_add)
+    await case("queue_match", queue_match)
+    await case("create_chat+end_chat", chat_cycle)
+
+    # --- helper sequences of the busiest handlers (what they do before any API call) ---
+    async def find_sequence(i):
+        u = user(next(new_ids))
+        await bot_full.ensure_user(u)
+        if await bot_full.is_banned(u.id) or await bot_full.is_muted(u.id) or await bot_full.get_peer(u.id):
+            return
+        partner = await bot_full.queue_match(u.id)
+        if partner:
+            await bot_full.create_chat(u.id, partner)
+
+    async def relay_sequence(i):
+        uid = chatting[i % len(chatting)]
+        await bot_full.ensure_user(user(uid))
+        if await bot_full.get_peer(uid):
+            await bot_full.is_muted(uid)
+
+    async def stop_sequence(i):
+        a, b = next(new_ids), next(new_ids)
+        await bot_full.create_chat(a, b)
+        await bot_full.end_chat(a)
+        await bot_full.ensure_user(user(b))
+
+    await case("handler.find", find_sequence, cold_cache)
+    # the cold pass loads every chatting user, so the warm one is the steady-state relay path
+    await case("handler.relay_cold", relay_sequence, cold_cache)
+    await case("handler.relay_warm", relay_sequence)
+    await case("handler.stop", stop_sequence)
+
+    bot_full.adb.stop()
+    bot_full.db.close()
+    return results
+
+
+def compare(results, baseline, tolerance, min_delta_us):
+    """Return a list of regressions: cases whose p50 grew by more than ``tolerance``
+    and by at least ``min_delta_us`` (sub-microsecond cases are mostly timer noise)."""
+    regressions = []
+    for size, cases in baseline.get("results", {}).items():
+        for name, old in cases.items():
+            new = results.get(size, {}).get(name)
+            if new is None:
+                continue
+            ratio = new["p50_us"] / old["p50_us"] if old["p50_us"] else 1.0
+            marker = ""
+            if ratio > 1 + tolerance and new["p50_us"] - old["p50_us"] >= min_delta_us:
+                regressions.append(f"{size} {name}: p50 {old['p50_us']}us -> {new['p50_us']}us (x{ratio:.2f})")
+                marker = "  <-- REGRESSION"
+            print(f"  {size:>8} {name:<28} x{ratio:.2f}{marker}")
+    return regressions
+
+
+async def run(sizes, ops, output, baseline_path, tolerance, min_delta_us):
+    with tempfile.TemporaryDirectory(prefix="bot_bench_") as workdir:
+        os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+        os.environ["DB_FILE"] = os.path.join(workdir, "bootstrap.db")
+        import bot_full
+
+        logging.getLogger("bot_full").setLevel(logging.WARNING)
+        results = {}
+        for size in sizes:
+            results[str(size)] = await run_size(size, ops, workdir)
+        await bot_full.bot.session.close()
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "ops": ops,
+            "created": int(time.time()),
+        },
+        "results": results,
+    }
+    for size, cases in results.items():
+        print(f"users={size}")
+        for name, r in cases.items():
+            print(f"  {name:<28} p50={r['p50_us']:>9}us p95={r['p95_us']:>9}us p99={r['p99_us']:>9}us "
+                  f"{r['ops_per_s']:>10} ops/s")
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {output}")
+
+    if not baseline_path:
+        return 0
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"compared with {baseline_path} (tolerance {tolerance:.0%}):")
+    regressions = compare(results, baseline, tolerance, min_delta_us)
+    for r in regressions:
+        print("FAIL:", r)
+    print("OK" if not regressions else "FAILED")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000",
+                        help="comma-separated user counts to seed (e.g. 10000,100000,1000000)")
+    parser.add_argument("--ops", type=int, default=2000, help="timed calls per case")
+    parser.add_argument("--output", default="", help="write JSON results to this file")
+    parser.add_argument("--baseline", default="", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed p50 slowdown against the baseline (0.25 = 25%%)")
+    parser.add_argument("--min-delta-us", type=float, default=2.0,
+                        help="ignore p50 slowdowns smaller than this many microseconds")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    sys.exit(asyncio.run(run(sizes, args.ops, args.output, args.baseline, args.tolerance,
+                                 args.min_delta_us)))
+
+
+if __name__ == "__main__":
+    main()
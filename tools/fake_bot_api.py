@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Minimal local stand-in for the Telegram Bot API, for offline testing.
+
+Point the bot at it with TELEGRAM_API_BASE=http://127.0.0.1:<port>. Every call is
+recorded in ``FakeBotAPI.calls`` as ``(method, params)``; responses are shaped just
+enough for aiogram to parse them. Updates queued with ``push_update`` are served to
+long polling through ``getUpdates``, and ``wait_for`` lets a test wait until the bot
+calls a method for a given chat. Chats in ``blocked`` answer sends with 403, like a
+user who blocked the bot.
+"""
+
+import asyncio
+import itertools
+import json
+import time
+from collections import defaultdict, deque
+
+from aiohttp import web
+
+
+class FakeBotAPI:
+    def __init__(self, bot_id: int = 42):
+        self.bot_id = bot_id
+        self.calls = []
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._updates = deque()
+        self._updates_ready = asyncio.Event()
+        self._waiters = defaultdict(list)  # chat_id -> [(method, predicate, future)]
+        self.blocked = set()  # chat ids that have blocked the bot
+        self._runner = None
+        self.port = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def count(self, method: str):
+        return sum(1 for m, _ in self.calls if m == method)
+
+    def push_update(self, update: dict):
+        """Queue an update for getUpdates; assigns and returns its update_id."""
+        update["update_id"] = next(self._update_ids)
+        self._updates.append(update)
+        self._updates_ready.set()
+        return update["update_id"]
+
+    def wait_for(self, chat_id: int, method: str = "sendMessage", predicate=None, timeout: float = 30.0):
+        """Wait until the bot calls ``method`` for ``chat_id`` (and ``predicate(params)`` holds).
+
+        Only calls made after this is invoked count. Returns the call params.
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id].append((method, predicate, fut))
+        return asyncio.wait_for(fut, timeout)
+
+    def _notify(self, method: str, params: dict):
+        try:
+            chat_id = int(params.get("chat_id", 0))
+        except ValueError:
+            return
+        waiters = self._waiters.get(chat_id)
+        if not waiters:
+            return
+        keep = []
+        for entry in waiters:
+            wanted, predicate, fut = entry
+            if fut.done():
+                continue
+            if wanted == method and (predicate is None or predicate(params)):
+                fut.set_result(params)
+            else:
+                keep.append(entry)
+        if keep:
+            self._waiters[chat_id] = keep
+        else:
+            del self._waiters[chat_id]
+
+    async def _get_updates(self, params: dict):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+        if not self._updates and timeout > 0:
+            self._updates_ready.clear()
+            try:
+                await asyncio.wait_for(self._updates_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self._updates, limit))
+
+    async def start(self, port: int = 0):
+        app = web.Application()
+        app.router.add_route("POST", "/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _message(self, params):
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    async def _handle(self, request: web.Request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls.append((method, params))
+        self._notify(method, params)
+        if (method.startswith("send") or method.startswith("copyMessage")) and int(params.get("chat_id", 0)) in self.blocked:
+            return web.json_response({"ok": False, "error_code": 403,
+                                      "description": "Forbidden: bot was blocked by the user"}, status=403)
+        result = await self.respond(method, params)
+        return web.json_response({"ok": True, "result": result})
+
+    async def respond(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": self.bot_id, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method in ("sendMessage", "editMessageText", "sendSticker", "sendPhoto", "sendVoice", "sendVideo",
+                      "sendDocument", "sendAudio", "sendAnimation"):
+            return self._message(params)
+        if method == "copyMessage":
+            return {"message_id": next(self._message_ids)}
+        if method == "copyMessages":
+            return [{"message_id": next(self._message_ids)} for _ in json.loads(params["message_ids"])]
+        return True
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Minimal local stand-in for the Crypto Pay API, for offline testing of payments.
+
+Implements createInvoice and getInvoices (token-checked, JSON in / JSON out).
+Invoices are paid or expired by calling ``pay``/``expire`` from a test, or over
+HTTP when run standalone:
+
+    python tools/fake_crypto_pay.py --port 8081 --token test
+    CRYPTO_PAY_TOKEN=test CRYPTO_PAY_API=http://127.0.0.1:8081/api python bot_full.py
+    curl -X POST http://127.0.0.1:8081/stub/pay/1      # mark invoice 1 as paid
+"""
+
+import argparse
+import asyncio
+import itertools
+
+from aiohttp import web
+
+
+class FakeCryptoPay:
+    def __init__(self, token: str = "test"):
+        self.token = token
+        self.invoices = {}  # invoice_id -> invoice dict
+        self.calls = []
+        self._ids = itertools.count(1)
+        self._runner = None
+        self.port = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/api"
+
+    def count(self, method: str):
+        return sum(1 for m, _ in self.calls if m == method)
+
+    def pay(self, invoice_id: int):
+        self.invoices[invoice_id]["status"] = "paid"
+
+    def expire(self, invoice_id: int):
+        self.invoices[invoice_id]["status"] = "expired"
+
+    async def start(self, port: int = 0):
+        app = web.Application()
+        app.router.add_route("*", "/api/{method}", self._handle)
+        app.router.add_post("/stub/{action}/{invoice_id}", self._handle_stub)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request: web.Request):
+        method = request.match_info["method"]
+        if request.headers.get("Crypto-Pay-API-Token") != self.token:
+            return web.json_response({"ok": False, "error": {"code": 401, "name": "UNAUTHORIZED"}}, status=401)
+        params = dict(request.query)
+        if request.can_read_body:
+            params.update(await request.json())
+        self.calls.append((method, params))
+        if method == "createInvoice":
+            invoice_id = next(self._ids)
+            invoice = {
+                "invoice_id": invoice_id,
+                "hash": f"IV{invoice_id}",
+                "asset": params.get("asset"),
+                "amount": str(params.get("amount")),
+                "payload": params.get("payload"),
+                "status": "active",
+                "bot_invoice_url": f"https://t.me/CryptoBot?start=IV{invoice_id}",
+            }
+            self.invoices[invoice_id] = invoice
+            return web.json_response({"ok": True, "result": invoice})
+        if method == "getInvoices":
+            ids = [int(i) for i in str(params.get("invoice_ids", "")).split(",") if i]
+            items = [self.invoices[i] for i in ids if i in self.invoices]
+            return web.json_response({"ok": True, "result": {"items": items}})
+        return web.json_response({"ok": False, "error": {"code": 405, "name": "METHOD_NOT_FOUND"}}, status=405)
+
+    async def _handle_stub(self, request: web.Request):
+        action = request.match_info["action"]
+        invoice_id = int(request.match_info["invoice_id"])
+        if invoice_id not in self.invoices or action not in ("pay", "expire"):
+            raise web.HTTPNotFound()
+        getattr(self, action)(invoice_id)
+        return web.json_response(self.invoices[invoice_id])
+
+
+async def serve(port: int, token: str):
+    stub = FakeCryptoPay(token)
+    await stub.start(port)
+    print(f"fake Crypto Pay API on {stub.base_url} (token {token!r})")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--token", default="test")
+    args = parser.parse_args()
+    asyncio.run(serve(args.port, args.token))
+
+
+if __name__ == "__main__":
+    main()
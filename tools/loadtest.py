@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""End-to-end load test of bot_full against a local fake Bot API (offline).
+
+Runs the real dispatcher in long-polling mode against tools/fake_bot_api.py and
+simulates users going through find -> chat -> stop -> game flows. Reports the
+update throughput and p50/p95/p99 latency per handler, both for the handler
+itself and end to end (update queued for getUpdates -> handler finished).
+
+By default the outbound Telegram rate limits are lifted, so the numbers show
+what the bot itself can carry; pass --telegram-limits to keep them.
+
+With --workers N the bot runs in sharded mode (front process + N workers); the
+handlers then run in other processes, so only throughput is reported.
+
+Usage:
+    python tools/loadtest.py [--users 2000] [--messages 10] [--games 1] [--storage memory] [--workers 4]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+STEP_TIMEOUT = 60.0
+
+
+class Recorder:
+    """Collects handler timings from an inner middleware on the dispatcher."""
+
+    def __init__(self):
+        self.pushed = {}                    # update_id -> perf_counter when queued
+        self.handler = defaultdict(list)    # handler name -> seconds spent in the handler
+        self.end_to_end = defaultdict(list) # handler name -> seconds since the update was queued
+        self.errors = defaultdict(int)
+        self.handled = 0
+
+    async def middleware(self, handler, event, data):
+        import bot_full
+
+        name = data["handler"].callback.__name__
+        stats = bot_full.current_update_stats.get()
+        failed = False
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            t1 = time.perf_counter()
+            if stats is not None:
+                name = stats["handler"]  # callbacks go through one router handler that names the route
+            if failed:
+                self.errors[name] += 1
+            self.handled += 1
+            self.handler[name].append(t1 - t0)
+            pushed = self.pushed.pop(data["event_update"].update_id, None)
+            if pushed is not None:
+                self.end_to_end[name].append(t1 - pushed)
+
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+class SimUser:
+    def __init__(self, api: FakeBotAPI, recorder: Recorder, user_id: int):
+        self.api = api
+        self.recorder = recorder
+        self.id = user_id
+        self.message_ids = iter(range(1, 10 ** 9))
+
+    def _sender(self):
+        return {"id": self.id, "is_bot": False, "first_name": f"user{self.id}"}
+
+    def _push(self, update):
+        update_id = self.api.push_update(update)
+        self.recorder.pushed[update_id] = time.perf_counter()
+
+    def send_text(self, text: str):
+        self._push({"message": {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": self.id, "type": "private"},
+            "from": self._sender(),
+            "text": text,
+        }})
+
+    def press(self, data: str):
+        self._push({"callback_query": {
+            "id": f"{self.id}-{time.perf_counter_ns()}",
+            "from": self._sender(),
+            "chat_instance": str(self.id),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": self.id, "type": "private"},
+                "text": "menu",
+            },
+        }})
+
+    def expect(self, contains: str):
+        return self.api.wait_for(self.id, "sendMessage", lambda p: contains in p.get("text", ""), STEP_TIMEOUT)
+
+    async def run(self, messages: int, game_rounds: int, think: float):
+        async def pause():
+            await asyncio.sleep(random.uniform(0, think))
+
+        waiting = self.expect("Привет")
+        self.send_text("/start")
+        await waiting
+
+        # find -> chat -> stop
+        await pause()
+        matched = self.expect("Собеседник найден")
+        self.press("find")
+        await matched
+        for i in range(messages):
+            await pause()
+            self.send_text(f"message {i} from {self.id}")
+        await pause()
+        self.press("stop")
+
+        # rps games: both players queue, then move
+        for _ in range(game_rounds):
+            await pause()
+            found = self.expect("Соперник найден")
+            self.press("find_rps")
+            await found
+            result = self.expect("Результат")
+            self.send_text(random.choice(("камень", "ножницы", "бумага")))
+            await result
+
+
+async def run(users, messages, game_rounds, think, telegram_limits, storage, workers):
+    api = FakeBotAPI()
+    await api.start()
+    tmp = tempfile.mkdtemp(prefix="loadtest_")
+    os.environ.update({
+        "BOT_TOKEN": "123456:LOADTEST",
+        "DB_FILE": os.path.join(tmp, "loadtest.db"),
+        "TELEGRAM_API_BASE": api.base_url,
+        "STORAGE_BACKEND": storage,
+        "WORKERS": str(workers),
+        "LOG_LEVEL": "WARNING",  # worker processes configure their own logging
+    })
+    if not telegram_limits:
+        # the fake API has no flood control; measure the bot, not Telegram's limits
+        # (through the environment, so worker processes pick it up too)
+        os.environ.update({"OUTBOX_GLOBAL_RATE": "1000000", "OUTBOX_CHAT_RATE": "1000000",
+                           "OUTBOX_CHAT_BURST": "1000000"})
+    import bot_full
+
+    for name in ("aiohttp.access", "aiogram.event", "aiogram.dispatcher", "bot_full"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    recorder = Recorder()
+    if workers > 1:
+        polling = asyncio.create_task(bot_full.run_sharded(polling_timeout=1))
+        while bot_full.shard_link is None or not bot_full.shard_link.ready.is_set():
+            await asyncio.sleep(0.05)  # workers are up before the clock starts
+    else:
+        bot_full.dp.message.middleware(recorder.middleware)
+        bot_full.dp.callback_query.middleware(recorder.middleware)
+        await bot_full.on_startup()
+        polling = asyncio.create_task(bot_full.dp.start_polling(bot_full.bot, handle_signals=False, polling_timeout=1))
+
+    sims = [SimUser(api, recorder, 1000 + i) for i in range(users)]
+    t0 = time.perf_counter()
+    outcomes = await asyncio.gather(*(s.run(messages, game_rounds, think) for s in sims), return_exceptions=True)
+    elapsed = time.perf_counter() - t0
+    # let the last relays and result notifications drain
+    await asyncio.sleep(0.5)
+
+    front = bot_full.shard_link.dispatcher if workers > 1 else bot_full.dp
+    await front.stop_polling()
+    await polling
+    await bot_full.stop_background()
+    await bot_full.outbox.stop()
+    await bot_full.storage.close()
+    await bot_full.bot.session.close()
+    await api.stop()
+
+    failed = [o for o in outcomes if isinstance(o, BaseException)]
+    print(f"users: {users}, chat messages per user: {messages}, rps rounds per user: {game_rounds}, "
+          f"storage: {storage}, workers: {workers}")
+    handled = recorder.handled if workers <= 1 else len(recorder.pushed)
+    print(f"elapsed: {elapsed:.2f}s, updates handled: {handled} ({handled / elapsed:.0f} updates/s)")
+    print(f"Bot API calls: sendMessage={api.count('sendMessage')} copyMessage={api.count('copyMessage')} "
+          f"editMessageText={api.count('editMessageText')} answerCallbackQuery={api.count('answerCallbackQuery')}")
+    print(f"{'handler':<20} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} | "
+          f"{'e2e p50':>8} {'e2e p95':>8} {'e2e p99':>8} {'errors':>7}")
+    for name in sorted(recorder.handler):
+        h = sorted(recorder.handler[name])
+        e = sorted(recorder.end_to_end[name]) or [0.0]
+        print(f"{name:<20} {len(h):>7} {statistics.median(h) * 1000:>8.2f} {percentile(h, 0.95) * 1000:>8.2f} "
+              f"{percentile(h, 0.99) * 1000:>8.2f} | {statistics.median(e) * 1000:>8.2f} "
+              f"{percentile(e, 0.95) * 1000:>8.2f} {percentile(e, 0.99) * 1000:>8.2f} "
+              f"{recorder.errors.get(name, 0):>7}")
+    for o in failed[:5]:
+        print("FAIL:", type(o).__name__, o)
+    if failed:
+        print(f"{len(failed)} of {users} simulated users did not finish")
+    ok = not failed and not recorder.errors
+    print("OK" if ok else "FAILED")
+    return 0 if ok else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=10, help="chat messages each user sends to their peer")
+    parser.add_argument("--games", type=int, default=1, help="rps rounds each user plays after the chat")
+    parser.add_argument("--think", type=float, default=0.05, help="max random pause between user actions, seconds")
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="keep the outbound Telegram rate limits (slow: ~30 messages/s)")
+    parser.add_argument("--storage", default="sqlite", choices=("sqlite", "memory", "postgres"),
+                        help="storage backend (postgres uses POSTGRES_DSN)")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes (sharded mode when > 1)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    sys.exit(asyncio.run(run(args.users, args.messages, args.games, args.think, args.telegram_limits,
+                             args.storage, args.workers)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Replay a chat-search arrival trace against each matchmaking policy (offline).
+
+The trace is JSON lines as written by the bot with MATCH_TRACE_FILE set:
+{"t": epoch seconds, "event": "search" | "leave", "user": id, "vip": bool, "rep": int}.
+Each policy gets its own bot_full.MatchmakingQueue on a virtual clock, swept every
+MATCH_SWEEP_INTERVAL seconds like the bot does. Reported per policy: pairs made,
+searches that gave up, wait-time p50/p95/p99 (overall, VIP and others) and the
+mean reputation gap inside a pair.
+
+Without --trace a synthetic trace is generated (Poisson arrivals, a share of VIPs,
+normally distributed reputation, users who give up after an exponential patience);
+--record saves it for later replays.
+
+Usage:
+    python tools/matchsim.py [--trace searches.jsonl] [--policies fifo,vip,bands]
+    python tools/matchsim.py --searches 20000 --rate 5 [--record synthetic.jsonl]
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def generate(searches, rate, vip_share, rep_sigma, patience, seed):
+    """Synthetic trace: one search per user, plus a leave if they would give up."""
+    rng = random.Random(seed)
+    events = []
+    t = 0.0
+    for user in range(1, searches + 1):
+        t += rng.expovariate(rate)
+        events.append({"t": round(t, 3), "event": "search", "user": user,
+                       "vip": rng.random() < vip_share, "rep": int(rng.gauss(0, rep_sigma))})
+        events.append({"t": round(t + rng.expovariate(1 / patience), 3), "event": "leave", "user": user})
+    events.sort(key=lambda e: e["t"])
+    return events
+
+
+def load_trace(path):
+    with open(path, encoding="utf-8") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    events.sort(key=lambda e: e["t"])
+    return events
+
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))] if samples else 0.0
+
+
+def replay(bot_full, policy, events, sweep_interval):
+    queue = bot_full.MatchmakingQueue(policy)
+    searching = {}  # user -> (search start, vip, rep) while in the queue
+    waits = {True: [], False: []}
+    gaps = []
+    gave_up = 0
+
+    def paired(user, partner, now, vip, rep):
+        since, partner_vip, partner_rep = searching.pop(partner)
+        waits[vip].append(now - searching.pop(user, (now,))[0])
+        waits[partner_vip].append(now - since)
+        gaps.append(abs(rep - partner_rep))
+
+    next_sweep = (events[0]["t"] if events else 0.0) + sweep_interval
+    for event in events:
+        now = event["t"]
+        while next_sweep <= now:
+            for user, partner in queue.sweep(next_sweep):
+                _, vip, rep = searching[user]
+                paired(user, partner, next_sweep, vip, rep)
+            next_sweep += sweep_interval
+        user = event["user"]
+        if event["event"] == "leave":
+            if queue.remove(user):
+                del searching[user]
+                gave_up += 1
+            continue
+        if user in queue:
+            continue
+        vip, rep = bool(event.get("vip")), int(event.get("rep", 0))
+        partner = queue.pop_partner(user, vip, rep, now)
+        if partner is None:
+            queue.add(user, vip, rep, now)
+            searching[user] = (now, vip, rep)
+        else:
+            paired(user, partner, now, vip, rep)
+    return {
+        "pairs": len(gaps),
+        "gave_up": gave_up,
+        "still_waiting": len(queue),
+        "waits": {"all": sorted(waits[True] + waits[False]), "vip": sorted(waits[True]), "other": sorted(waits[False])},
+        "rep_gap": statistics.mean(gaps) if gaps else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--trace", help="JSON-lines search trace (MATCH_TRACE_FILE); synthetic if omitted")
+    parser.add_argument("--policies", default="fifo,vip,bands")
+    parser.add_argument("--searches", type=int, default=20000, help="synthetic: number of searches")
+    parser.add_argument("--rate", type=float, default=2.0, help="synthetic: searches per second")
+    parser.add_argument("--vip-share", type=float, default=0.1)
+    parser.add_argument("--rep-sigma", type=float, default=15.0, help="synthetic: reputation spread")
+    parser.add_argument("--patience", type=float, default=60.0, help="synthetic: mean seconds before giving up")
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--record", help="write the synthetic trace here")
+    args = parser.parse_args()
+
+    os.environ.setdefault("BOT_TOKEN", "123456:MATCHSIM")
+    import bot_full
+
+    if args.trace:
+        events = load_trace(args.trace)
+    else:
+        events = generate(args.searches, args.rate, args.vip_share, args.rep_sigma, args.patience, args.seed)
+        if args.record:
+            with open(args.record, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(e) + "\n" for e in events)
+    searches = sum(1 for e in events if e["event"] == "search")
+    print(f"searches: {searches}, band: {bot_full.MATCH_REP_BAND} rep, widen every {bot_full.MATCH_WIDEN_SECONDS}s, "
+          f"sweep every {bot_full.MATCH_SWEEP_INTERVAL}s")
+    print(f"{'policy':<7} {'pairs':>6} {'gave up':>8} {'waiting':>8} {'rep gap':>8} | "
+          f"{'p50 s':>7} {'p95 s':>7} {'p99 s':>7} | {'VIP p50':>7} {'VIP p95':>7} | {'oth p50':>7} {'oth p95':>7}")
+    for name in args.policies.split(","):
+        r = replay(bot_full, bot_full.MATCH_POLICIES[name], events, bot_full.MATCH_SWEEP_INTERVAL)
+        w = r["waits"]
+        print(f"{name:<7} {r['pairs']:>6} {r['gave_up']:>8} {r['still_waiting']:>8} {r['rep_gap']:>8.1f} | "
+              f"{percentile(w['all'], 0.5):>7.1f} {percentile(w['all'], 0.95):>7.1f} {percentile(w['all'], 0.99):>7.1f} | "
+              f"{percentile(w['vip'], 0.5):>7.1f} {percentile(w['vip'], 0.95):>7.1f} | "
+              f"{percentile(w['other'], 0.5):>7.1f} {percentile(w['other'], 0.95):>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
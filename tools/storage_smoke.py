@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""Run every storage repository method against one backend and diff it with MemoryStorage.
+
+The same scripted sequence of calls (users, pairing log, chats, complaints, games,
+invoices, broadcasts, maintenance helpers) runs against the in-memory reference and
+against the backend under test; every result is compared and mismatches are printed.
+Exits with 1 on any mismatch or error.
+
+SQLite runs on a temporary file. PostgreSQL uses POSTGRES_DSN and needs an empty,
+scratch database: the script refuses to touch one that already has users unless
+--reset is given, which empties the bot's tables first.
+
+Usage:
+    python tools/storage_smoke.py [--storage sqlite]
+    POSTGRES_DSN=postgresql://localhost/scratch python tools/storage_smoke.py --storage postgres [--reset]
+"""
+
+import argparse
+import asyncio
+import csv
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+T0 = 1_700_000_000  # fixed clock, so both backends see the same timestamps
+POSTGRES_TABLES = ("users", "pairing", "chats", "complaints", "invoices", "game_results", "broadcasts")
+
+
+async def settle(bot_full, storage):
+    """Wait for fire-and-forget writes (the pairing log) to land."""
+    if isinstance(storage, bot_full.PostgresStorage):
+        await asyncio.gather(*storage._pending)
+    elif isinstance(storage, bot_full.SQLiteStorage):
+        await bot_full.adb_transaction(lambda conn: None)  # queued behind them on the writer
+
+
+def normalize(value):
+    if isinstance(value, (list, tuple)):
+        return [normalize(v) for v in value]
+    if hasattr(value, "_asdict"):
+        return normalize(tuple(value))
+    return value
+
+
+async def script(bot_full, storage, tmp):
+    """Yield (step, result) pairs; unordered results are sorted."""
+    users, pairing, chats = storage.users, storage.pairing, storage.chats
+    flt = bot_full.UserFilter
+    for uid in range(1, 9):
+        await users.create(uid, f"u{uid}", f"User {uid}", T0 + uid)
+    await users.create(1, "dup", "dup", T0)
+    yield "get_state", [await users.get_state(uid) for uid in (1, 99)]
+    await users.update_profile(2, "Вася", "про меня")
+    await users.add_balance(2, 50)
+    await users.set_vip_until(3, T0 + 10_000)
+    await users.set_vip_until(4, T0 - 10)
+    await users.set_banned(5, True)
+    await users.set_muted_until(6, T0 - 5)
+    await users.set_muted_until(7, T0 + 500)
+    await users.set_blocked_bot(8, True)
+    await users.set_blocked_bot(8, True)
+    yield "get_profile", [await users.get_profile(uid) for uid in (2, 3, 99)]
+    yield "get_balance", [await users.get_balance(uid) for uid in (2, 99)]
+    yield "page", await users.page(flt(), 3, after=1)
+    yield "page_before", await users.page(flt(), 3, before=6)
+    yield "page_banned", await users.page(flt(banned=True), 10)
+    yield "page_rep", await users.page(flt(rep_min=0, rep_max=0), 10, after=4)
+    path = os.path.join(tmp, f"export_{type(storage).__name__}.csv")
+    yield "export_csv", await users.export_csv(flt(), path)
+    with open(path, newline="", encoding="utf-8") as f:
+        # parsed, not raw: COPY quotes empty strings ("") to tell them apart from NULL
+        yield "export_csv_rows", list(csv.reader(f))
+
+    pairing.add(1, T0 - 4000)
+    pairing.add(2, T0 - 100)
+    pairing.add(3, T0 - 50)
+    pairing.remove(3)
+    await settle(bot_full, storage)
+    yield "pairing_load", await pairing.load()
+    yield "pairing_stale", await pairing.stale(T0 - 1000, 10)
+    await pairing.clear()
+    yield "pairing_cleared", await pairing.load()
+
+    await chats.create(1, 2)
+    await chats.create(3, 5)   # 5 is banned
+    await chats.create(6, 7)
+    await chats.create(7, 4)   # 6 -> 7 is now half-open
+    yield "chats_load", sorted(await chats.load())
+    yield "chats_abandoned", await chats.abandoned(0, 10)
+    yield "chats_abandoned_after", await chats.abandoned(3, 1)
+    await chats.delete_sides([(3, 5), (5, 3), (6, 7)])
+    await chats.delete(1, 2)
+    yield "chats_after_delete", sorted(await chats.load())
+
+    await storage.complaints.create(1, 2, "spam", T0)
+    await storage.games.record_result("rps", 1, 3, 3, T0)
+    await storage.games.record_result("guess", 1, 3, None, T0)
+    yield "reputation", [(await users.get_profile(uid))[3] for uid in (1, 2, 3)]
+
+    invoices = storage.invoices
+    await invoices.create("a", 1, 10, T0 - 100, remote_id=101)
+    await invoices.create("b", 1, 20, T0 - 50, remote_id=102)
+    await invoices.create("c", 2, 30, T0 - 7200)
+    await invoices.create("d", 2, 40, T0 - 10, remote_id=104)
+    yield "invoice_get", [await invoices.get(i) for i in ("a", "zz")]
+    yield "invoice_settle", [await invoices.settle("c"), await invoices.settle("c")]
+    yield "pending_remote", await invoices.pending_remote((0, ""), 10)
+    yield "pending_remote_after", await invoices.pending_remote((T0 - 100, "a"), 1)
+    yield "apply_remote", await invoices.apply_remote(["a"], ["b"])
+    yield "expire_older_than", await invoices.expire_older_than(T0)
+    yield "settle_expired", [await invoices.settle("b"), await invoices.settle("b", include_expired=True)]
+    yield "balances", [await users.get_balance(uid) for uid in (1, 2)]
+
+    broadcasts = storage.broadcasts
+    first = await broadcasts.create(1, "hi", 1, 77, T0)
+    yield "broadcast_create", first
+    yield "recipients", await broadcasts.recipients(0, 3)
+    yield "recipients_after", await broadcasts.recipients(6, 10)
+    progressed = first._replace(last_user_id=3, sent=2, blocked=1)
+    yield "checkpoint", await broadcasts.checkpoint(progressed, [2])
+    yield "unfinished", await broadcasts.unfinished()
+    yield "recipients_blocked", await broadcasts.recipients(0, 10)
+    yield "finish", [await broadcasts.finish(first.id, bot_full.BROADCAST_STOPPED, T0),
+                     await broadcasts.finish(first.id, bot_full.BROADCAST_DONE, T0)]
+    yield "checkpoint_stopped", await broadcasts.checkpoint(progressed, [])
+    await users.set_blocked_bot(2, False)
+    yield "unblocked", await broadcasts.recipients(1, 1)
+
+    yield "clear_expired", await users.clear_expired(T0, 10)
+    yield "clear_expired_again", await users.clear_expired(T0, 10)
+    yield "states_after_expiry", [await users.get_state(uid) for uid in (3, 4, 6, 7)]
+    yield "optimize", isinstance(await storage.optimize(analyze=True), dict)
+
+
+async def collect(bot_full, storage, tmp):
+    results = {}
+    async for step, value in script(bot_full, storage, tmp):
+        results[step] = normalize(value)
+    return results
+
+
+async def reset_postgres(storage, force):
+    rows = await storage.fetch("SELECT COUNT(*) FROM users")
+    if rows[0][0] and not force:
+        raise SystemExit("POSTGRES_DSN points at a database with users; use a scratch database or pass --reset")
+    await storage.execute(f"TRUNCATE {', '.join(POSTGRES_TABLES)} RESTART IDENTITY")
+
+
+async def run(backend, reset):
+    tmp = tempfile.mkdtemp(prefix="storage_smoke_")
+    os.environ.setdefault("BOT_TOKEN", "123456:SMOKE")
+    os.environ["DB_FILE"] = os.path.join(tmp, "smoke.db")
+    import bot_full
+
+    bot_full.now_ts = lambda: T0  # the broadcast/VIP filters read the clock
+    reference = bot_full.MemoryStorage()
+    expected = await collect(bot_full, reference, tmp)
+
+    if backend == "postgres":
+        storage = bot_full.PostgresStorage(bot_full.POSTGRES_DSN)
+    elif backend == "sqlite":
+        storage = bot_full.SQLiteStorage()
+    else:
+        storage = bot_full.MemoryStorage()
+    await storage.open()
+    try:
+        if backend == "postgres":
+            await reset_postgres(storage, reset)
+        actual = await collect(bot_full, storage, tmp)
+    finally:
+        await storage.close()
+
+    failures = 0
+    for step, want in expected.items():
+        got = actual.get(step)
+        if got != want:
+            failures += 1
+            print(f"MISMATCH {step}:\n  memory:  {want!r}\n  {backend}: {got!r}")
+    print(f"{backend}: {len(expected) - failures}/{len(expected)} steps match the memory backend")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--storage", default="sqlite", choices=("sqlite", "memory", "postgres"),
+                        help="backend under test (postgres uses POSTGRES_DSN)")
+    parser.add_argument("--reset", action="store_true", help="postgres: empty the bot's tables first")
+    args = parser.parse_args()
+    if args.storage == "postgres" and not os.getenv("POSTGRES_DSN"):
+        raise SystemExit("--storage postgres needs POSTGRES_DSN")
+    sys.exit(1 if asyncio.run(run(args.storage, args.reset)) else 0)
+
+
+if __name__ == "__main__":
+    main()
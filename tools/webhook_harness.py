@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Local test harness for webhook mode (no Telegram needed).
+
+Starts a fake Bot API, runs bot_full's webhook app on a local port and POSTs
+synthetic updates to it. Checks that:
+- requests without the secret token are rejected with 401;
+- every update is acknowledged with 200 quickly (processing happens in background);
+- updates are actually processed (replies / relays reach the fake Bot API).
+
+Usage:
+    python tools/webhook_harness.py [--users 200] [--messages 5]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+SECRET = "harness-secret"
+
+
+def message_update(update_id, user_id, text, message_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        },
+    }
+
+
+async def wait_for(predicate, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        await asyncio.sleep(0.05)
+    return predicate()
+
+
+async def run(users: int, messages: int):
+    api = FakeBotAPI()
+    await api.start()
+    tmp = tempfile.mkdtemp(prefix="webhook_harness_")
+    os.environ.update({
+        "BOT_TOKEN": "123456:HARNESS",
+        "DB_FILE": os.path.join(tmp, "harness.db"),
+        "TELEGRAM_API_BASE": api.base_url,
+        "WEBHOOK_SECRET": SECRET,
+        "WEBHOOK_HOST": "127.0.0.1",
+        "WEBHOOK_PORT": "0",
+    })
+    import bot_full
+    from aiohttp import web
+
+    for name in ("aiohttp.access", "aiogram.event"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    await bot_full.on_startup()
+    runner = web.AppRunner(bot_full.build_webhook_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}{bot_full.WEBHOOK_PATH}"
+
+    failures = []
+    latencies = []
+    update_id = 0
+    async with aiohttp.ClientSession() as http:
+        # 1. secret token is enforced
+        async with http.post(url, json=message_update(0, 1, "/start", 1)) as resp:
+            if resp.status != 401:
+                failures.append(f"missing secret: expected 401, got {resp.status}")
+
+        async def post(update):
+            t0 = time.perf_counter()
+            async with http.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as resp:
+                latencies.append(time.perf_counter() - t0)
+                if resp.status != 200:
+                    failures.append(f"update {update['update_id']}: HTTP {resp.status}")
+
+        # 2. every user sends /start
+        batch = []
+        for uid in range(1, users + 1):
+            update_id += 1
+            batch.append(post(message_update(update_id, uid, "/start", update_id)))
+        await asyncio.gather(*batch)
+        if not await wait_for(lambda: api.count("sendMessage") >= users):
+            failures.append(f"/start replies: expected {users}, got {api.count('sendMessage')}")
+
+        # 3. pair users up and relay chat messages
+        for uid in range(1, users, 2):
+            await bot_full.create_chat(uid, uid + 1)
+        batch = []
+        for uid in range(1, users + 1 - users % 2):
+            for _ in range(messages):
+                update_id += 1
+                batch.append(post(message_update(update_id, uid, f"hello {update_id}", update_id)))
+        await asyncio.gather(*batch)
+        expected = (users - users % 2) * messages
+        if not await wait_for(lambda: api.count("copyMessage") >= expected, timeout=60 + expected / 20):
+            failures.append(f"relayed messages: expected {expected}, got {api.count('copyMessage')}")
+
+    await runner.cleanup()
+    await bot_full.outbox.stop()
+    await bot_full.storage.close()
+    await api.stop()
+
+    latencies.sort()
+    print(f"updates posted: {len(latencies)}")
+    if latencies:
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f"ack latency ms: p50={statistics.median(latencies) * 1000:.1f} p99={p99 * 1000:.1f}")
+    print(f"Bot API calls: sendMessage={api.count('sendMessage')} copyMessage={api.count('copyMessage')}")
+    for f in failures:
+        print("FAIL:", f)
+    print("OK" if not failures else "FAILED")
+    return 0 if not failures else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=5)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args.users, args.messages)))
+
+
+if __name__ == "__main__":
+    main()